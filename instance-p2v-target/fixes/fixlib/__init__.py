@@ -25,6 +25,7 @@ can be unit tested but also run with run-parts.
 
 """
 
+import re
 import subprocess
 
 
@@ -47,3 +48,20 @@ def FindTargetHardDrive():
     if status == 0:
       return hd
   raise FixError("Could not locate a hard drive.")
+
+
+def ReadBlockDevices():
+  """Find the tags of every block device, with a single run of blkid.
+
+  @rtype: dict
+  @return: Tags reported by blkid, such as UUID and TYPE, as a dict for each
+    device file.
+
+  """
+  devices = {}
+  p = subprocess.Popen(["blkid"], stdout=subprocess.PIPE)
+  for line in p.communicate()[0].splitlines():
+    dev, _, values = line.partition(":")
+    if dev.startswith("/"):
+      devices[dev] = dict(re.findall(r'([A-Z_]+)="([^"]*)"', values))
+  return devices
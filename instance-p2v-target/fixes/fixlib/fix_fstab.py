@@ -23,14 +23,17 @@ import re
 import fixlib
 
 
-def FixFstab(fname_in="/target/etc/fstab", fname_out="/target/etc/fstab"):
+def FixFstab(fname_in="/target/etc/fstab", fname_out="/target/etc/fstab",
+             mounts_file="/proc/mounts", target="/target"):
   """Alter the fstab to refer to new filesystems.
 
-  This function edits the fstab file found at fname_in, locating the filesystem
-  mounted on / and replacing the device with the string UUID=<new_uuid>. Since
-  there may have been more partitions before the transfer, comment out any
-  lines that:
-  - are not the root or swap partition
+  This function edits the fstab file found at fname_in. The filesystems that
+  were transferred are the ones mounted below target, so the line of each of
+  them gets the device string UUID=<new_uuid> and the type of the partition
+  mounted there. The root filesystem is taken to be on /dev/${device}1 if
+  nothing is mounted on target, and swap lines get the UUID of the swap
+  partition. Since there may have been more partitions before the transfer,
+  comment out any other lines that:
   - are not set as "noauto"
   - AND refer to actual block devices.
 
@@ -38,35 +41,33 @@ def FixFstab(fname_in="/target/etc/fstab", fname_out="/target/etc/fstab"):
   @param fname_in: The fstab file to read.
   @type fname_out: string
   @param fname_out: Where to write the modified file.
+  @type mounts_file: string
+  @param mounts_file: List of mounted filesystems, in the format of
+    /proc/mounts.
+  @type target: string
+  @param target: Directory the transferred root filesystem is mounted on.
 
   """
-  # Note: This assumes a particular partition layout (root partition on
-  # /dev/${device}1, swap partition on /dev/${device}2). This is only a problem
-  # if we allow configurable partition layouts, so we'll let it stand for now,
-  # but for the future, the bootstrap OS's /etc/mtab probably contains enough
-  # information to reconstruct the whole partitioning scheme.
   uuids = {}
   fstypes = {}
   disk_name = fixlib.FindTargetHardDrive()
-  root_dev = "%s1" % disk_name
-  swap_dev = "%s2" % disk_name
-
-  p = subprocess.Popen(["blkid"], stdout=subprocess.PIPE)
 
-  devregex = re.compile("^(%s[0-9]):" % disk_name)
-  uuidregex = re.compile("UUID=\"([-a-z0-9]+)\"")
-  typeregex = re.compile("TYPE=\"(.+)\"")
+  partregex = re.compile("%s[0-9]+$" % disk_name)
+  for partname, tags in fixlib.ReadBlockDevices().items():
+    if partregex.match(partname) and tags.get("UUID") and tags.get("TYPE"):
+      uuids[partname] = tags["UUID"]
+      fstypes[partname] = tags["TYPE"]
 
-  for line in p.communicate()[0].splitlines():
-    devmatch = devregex.search(line)
-    uuidmatch = uuidregex.search(line)
-    typematch = typeregex.search(line)
-    if devmatch and uuidmatch and typematch:
-      partname = devmatch.group(1)
-      uuids[partname] = uuidmatch.group(1)
-      fstypes[partname] = typematch.group(1)
+  devices = ReadTargetMounts(mounts_file, target, disk_name)
+  if "/" not in devices:
+    devices["/"] = "%s1" % disk_name
+  swap_dev = "%s2" % disk_name
+  for partname in sorted(fstypes):
+    if fstypes[partname] == "swap":
+      swap_dev = partname
+      break
 
-  if root_dev not in uuids or swap_dev not in uuids:
+  if devices["/"] not in uuids or swap_dev not in uuids:
     raise fixlib.FixError("Could not determine UUID of root and swap"
                           " filesystems. Found filesystems were: %s\n"
                           "/etc/fstab may need to be edited by hand." % uuids)
@@ -76,13 +77,15 @@ def FixFstab(fname_in="/target/etc/fstab", fname_out="/target/etc/fstab"):
   for line in fstab_file:
     parts = line.split()
     if len(parts) >= 2 and parts[0][0] != "#":  # Line containing a filesystem
-      if parts[1] == "/":  # root partition
-        parts[0] = "UUID=%s" % uuids[root_dev]
-        parts[2] = fstypes[root_dev]
-        line = "\t".join(parts) + "\n"
-      elif parts[2] == "swap":  # swap partition
+      mount_point = parts[1].rstrip("/") or "/"
+      if len(parts) >= 3 and parts[2] == "swap":  # swap partition
         parts[0] = "UUID=%s" % uuids[swap_dev]
         line = "\t".join(parts) + "\n"
+      elif mount_point in devices and devices[mount_point] in uuids:
+        dev = devices[mount_point]
+        parts[0] = "UUID=%s" % uuids[dev]
+        parts[2] = fstypes[dev]
+        line = "\t".join(parts) + "\n"
       elif IsAutomountedBlockDevice(parts):
         line = "# " + line
     new_fstab += line
@@ -92,6 +95,37 @@ def FixFstab(fname_in="/target/etc/fstab", fname_out="/target/etc/fstab"):
   fstab_file.close()
 
 
+def ReadTargetMounts(mounts_file, target, disk_name):
+  """Find the partitions of the target disk mounted below target.
+
+  @type mounts_file: string
+  @param mounts_file: List of mounted filesystems, in the format of
+    /proc/mounts.
+  @type target: string
+  @param target: Directory the transferred root filesystem is mounted on.
+  @type disk_name: string
+  @param disk_name: Device file of the target disk.
+  @rtype: dict
+  @return: Partition device files, by mount point on the transferred system.
+
+  """
+  devices = {}
+  try:
+    mounts = open(mounts_file, "r")
+  except IOError:
+    return devices
+  for line in mounts:
+    parts = line.split()
+    if len(parts) < 2 or not re.match("%s[0-9]+$" % disk_name, parts[0]):
+      continue
+    if parts[1] == target:
+      devices["/"] = parts[0]
+    elif parts[1].startswith(target + "/"):
+      devices[parts[1][len(target):]] = parts[0]
+  mounts.close()
+  return devices
+
+
 def IsAutomountedBlockDevice(fstab_cols):
   """Returns whether a fstab line specifies a block device that is automounted.
 
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Content-addressed store of file chunks shared by P2V transfers.
+
+This script is meant to be run on a ganeti node, as the forced command of an
+SSH key that the bootstrap OS of P2V instances uses to log in. Before files
+are copied to an instance, the instance fetches the chunks of them that are
+already in the store, so that they don't need to be sent by the source
+machine. After the copy, it adds the chunks the store was missing. When
+many similar machines are migrated, most of the data only crosses the network
+from the source machines once.
+
+Chunks are named by the hex SHA-1 of their contents. The least recently used
+chunks are removed when the store grows beyond its size limit.
+
+Commands, read from the command line or from SSH_ORIGINAL_COMMAND:
+
+  - get: reads hex chunk names, one per line, until end of input, then writes
+    for each of them, in order, a 4 byte big-endian length followed by the
+    chunk, or the length 0xffffffff if the chunk isn't in the store.
+  - put: reads records of a 20 byte binary SHA-1, a 4 byte big-endian length
+    and the chunk, until end of input, and stores the chunks.
+  - evict: removes chunks until the store is within its size limit.
+
+"""
+
+import hashlib
+import optparse
+import os
+import re
+import struct
+import sys
+import tempfile
+
+COMMANDS = ["get", "put", "evict"]
+
+_MISSING = 0xffffffff
+# Largest chunk accepted by put
+_MAX_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+class Error(Exception):
+  pass
+
+
+class ChunkStore(object):
+  """A directory of chunks named by the SHA-1 of their contents.
+
+  Each chunk is kept in a subdirectory named after the first two characters
+  of its name, to keep directories small. The modification time of a chunk
+  is updated whenever it is read, and is used to find the least recently used
+  chunks.
+
+  """
+  def __init__(self, path, max_bytes):
+    """Open a store, creating its directory if necessary.
+
+    @type path: str
+    @param path: Directory of the store.
+    @type max_bytes: int
+    @param max_bytes: Size limit of the store in bytes.
+
+    """
+    self.path = path
+    self.max_bytes = max_bytes
+    if not os.path.isdir(path):
+      os.makedirs(path, 0700)
+
+  def _ChunkPath(self, name):
+    if not re.match("[0-9a-f]{40}$", name):
+      raise Error("Invalid chunk name %r" % name)
+    return os.path.join(self.path, name[:2], name)
+
+  def Get(self, name):
+    """Read a chunk, marking it as recently used.
+
+    @type name: str
+    @param name: Hex SHA-1 of the chunk.
+    @rtype: str
+    @return: The chunk, or None if it isn't in the store.
+
+    """
+    path = self._ChunkPath(name)
+    try:
+      chunk_file = open(path, "rb")
+      try:
+        data = chunk_file.read()
+      finally:
+        chunk_file.close()
+      os.utime(path, None)
+    except (IOError, OSError):
+      return None
+    return data
+
+  def Put(self, name, data):
+    """Add a chunk to the store.
+
+    @type name: str
+    @param name: Hex SHA-1 of the chunk.
+    @type data: str
+    @param data: The chunk.
+    @raise Error: The name doesn't match the contents.
+
+    """
+    path = self._ChunkPath(name)
+    if hashlib.sha1(data).hexdigest() != name:
+      raise Error("Chunk %s does not match its contents" % name)
+    if os.path.exists(path):
+      os.utime(path, None)
+      return
+
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+      try:
+        os.mkdir(dirname, 0700)
+      except OSError:
+        pass  # Created by another transfer in the meantime
+    # Written under a temporary name, so that a chunk is never seen half
+    # written
+    handle, temp_path = tempfile.mkstemp(dir=dirname)
+    try:
+      os.write(handle, data)
+      os.close(handle)
+      os.rename(temp_path, path)
+    except:
+      os.remove(temp_path)
+      raise
+
+  def Evict(self):
+    """Remove the least recently used chunks to bring the store within its
+    size limit.
+
+    @rtype: int
+    @return: Number of chunks removed.
+
+    """
+    chunks = []
+    total = 0
+    for dirname in os.listdir(self.path):
+      dirpath = os.path.join(self.path, dirname)
+      if not os.path.isdir(dirpath):
+        continue
+      for name in os.listdir(dirpath):
+        path = os.path.join(dirpath, name)
+        try:
+          stats = os.stat(path)
+        except OSError:
+          continue
+        chunks.append((stats.st_mtime, stats.st_size, path))
+        total += stats.st_size
+
+    removed = 0
+    chunks.sort()
+    for _, size, path in chunks:
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      total -= size
+      removed += 1
+    return removed
+
+
+def ServeGet(store, infile, outfile):
+  """Answer a get command.
+
+  All names are read before any chunk is written, so that the client can send
+  its whole request before reading the reply without either side blocking.
+
+  """
+  names = [line.strip() for line in infile.read().splitlines() if line.strip()]
+  for name in names:
+    data = store.Get(name)
+    if data is None:
+      outfile.write(struct.pack(">I", _MISSING))
+    else:
+      outfile.write(struct.pack(">I", len(data)))
+      outfile.write(data)
+  outfile.flush()
+
+
+def ServePut(store, infile):
+  """Answer a put command.
+
+  @rtype: int
+  @return: Number of chunks received.
+
+  """
+  count = 0
+  while True:
+    header = infile.read(24)
+    if not header:
+      break
+    if len(header) != 24:
+      raise Error("Chunk stream ended unexpectedly")
+    digest, length = struct.unpack(">20sI", header)
+    if length > _MAX_CHUNK_BYTES:
+      raise Error("Chunk of %d bytes is too large" % length)
+    data = infile.read(length)
+    if len(data) != length:
+      raise Error("Chunk stream ended unexpectedly")
+    store.Put(digest.encode("hex"), data)
+    count += 1
+  store.Evict()
+  return count
+
+
+def ParseOptions(argv):
+  """Parse the command line.
+
+  @param argv: the argv the program received on the command line
+
+  @returns: (options, command)
+
+  """
+  parser = optparse.OptionParser(usage="%prog [options] get|put|evict")
+  parser.add_option("-s", "--store", dest="store",
+                    default="/var/cache/ganeti-instance-p2v-target/chunks",
+                    help="directory of the chunk store [%default]")
+  parser.add_option("-m", "--max-size", type="int", dest="max_size",
+                    default=10240, metavar="MB",
+                    help="size limit of the store in megabytes [%default]")
+
+  (options, args) = parser.parse_args(argv[1:])
+
+  # As an SSH forced command, the command given by the client is only
+  # available from the environment
+  if not args and os.environ.get("SSH_ORIGINAL_COMMAND"):
+    args = os.environ["SSH_ORIGINAL_COMMAND"].split()[-1:]
+  if len(args) != 1 or args[0] not in COMMANDS:
+    parser.print_help()
+    sys.exit(1)
+
+  return options, args[0]
+
+
+def main(argv):
+  options, command = ParseOptions(argv)
+  try:
+    store = ChunkStore(options.store, options.max_size * 1024 * 1024)
+    if command == "get":
+      ServeGet(store, sys.stdin, sys.stdout)
+    elif command == "put":
+      ServePut(store, sys.stdin)
+    else:
+      store.Evict()
+  except (Error, EnvironmentError), e:
+    sys.stderr.write("%s\n" % e)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -73,6 +73,49 @@ class FixFstabTest(unittest.TestCase):
     self.mox.VerifyAll()
 
 
+  def testFixFstabRewritesEveryTransferredFilesystem(self):
+    mock_popen = self.mox.CreateMock(fix_fstab.subprocess.Popen)
+
+    self.mox.StubOutWithMock(fix_fstab.fixlib, "FindTargetHardDrive")
+    self.mox.StubOutWithMock(fix_fstab.subprocess, "Popen",
+                             use_mock_anything=True)
+
+    fix_fstab.fixlib.FindTargetHardDrive().AndReturn("/dev/xvda")
+    call = fix_fstab.subprocess.Popen(["blkid"],
+                                       stdout=fix_fstab.subprocess.PIPE)
+    call.AndReturn(mock_popen)
+    blkid_str = ("/dev/xvda1: UUID=\"11111111-1111-1111-1111-111111111111\""
+                 " TYPE=\"ext4\"\n/dev/xvda2: UUID=\"22222222-2222-2222-2222"
+                 "-222222222222\" TYPE=\"swap\"\n/dev/xvda3: UUID=\"33333333-"
+                 "3333-3333-3333-333333333333\" TYPE=\"ext4\"\n")
+    mock_popen.communicate().AndReturn((blkid_str, ""))
+
+    self.mox.ReplayAll()
+
+    handle, mounts_file = tempfile.mkstemp()
+    os.write(handle, "rootfs / rootfs rw 0 0\n"
+             "/dev/xvda1 /target ext4 rw 0 0\n"
+             "/dev/xvda3 /target/usr ext4 rw 0 0\n")
+    os.close(handle)
+    fname_in = os.path.join(self.TESTDATA, "fstab_uuid_in")
+    handle_out, fname_out = tempfile.mkstemp()
+    os.close(handle_out)
+    try:
+      fix_fstab.FixFstab(fname_in, fname_out, mounts_file)
+      out_data = open(fname_out, "r").read()
+    finally:
+      os.remove(mounts_file)
+      os.remove(fname_out)
+    self.mox.VerifyAll()
+
+    lines = out_data.splitlines()
+    self.assertTrue("UUID=11111111-1111-1111-1111-111111111111\t/\text4\t"
+                    "errors=remount-ro\t0\t1" in lines)
+    self.assertTrue("UUID=33333333-3333-3333-3333-333333333333\t/usr\text4\t"
+                    "defaults\t0\t2" in lines)
+    self.assertTrue("UUID=22222222-2222-2222-2222-222222222222\tnone\tswap\t"
+                    "sw\t0\t0" in lines)
+
   def testFixFstabHandlesDeviceMissing(self):
     # stub out blkid call
     mock_popen = self.mox.CreateMock(fix_fstab.subprocess.Popen)
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Tests for p2v_chunk_store."""
+
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import StringIO
+
+import p2v_chunk_store
+
+
+class ChunkStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.store_dir = tempfile.mkdtemp()
+    self.store = p2v_chunk_store.ChunkStore(self.store_dir, 10)
+
+  def tearDown(self):
+    shutil.rmtree(self.store_dir)
+
+  def _Name(self, data):
+    return hashlib.sha1(data).hexdigest()
+
+  def testPutAndGet(self):
+    name = self._Name("abc")
+    self.assertEqual(self.store.Get(name), None)
+    self.store.Put(name, "abc")
+    self.assertEqual(self.store.Get(name), "abc")
+    self.failUnless(os.path.exists(os.path.join(self.store_dir, name[:2],
+                                                name)))
+
+  def testPutRejectsWrongName(self):
+    self.assertRaises(p2v_chunk_store.Error, self.store.Put,
+                      self._Name("abc"), "abd")
+
+  def testInvalidName(self):
+    self.assertRaises(p2v_chunk_store.Error, self.store.Get, "../../etc/passwd")
+
+  def testEvictRemovesLeastRecentlyUsed(self):
+    names = []
+    for i, data in enumerate(["aaaa", "bbbb", "cccc"]):
+      name = self._Name(data)
+      self.store.Put(name, data)
+      path = os.path.join(self.store_dir, name[:2], name)
+      os.utime(path, (1000 + i, 1000 + i))
+      names.append(name)
+    # Reading the oldest chunk makes it the most recently used
+    self.store.Get(names[0])
+
+    self.assertEqual(self.store.Evict(), 1)
+    self.assertEqual(self.store.Get(names[1]), None)
+    self.assertEqual(self.store.Get(names[0]), "aaaa")
+    self.assertEqual(self.store.Get(names[2]), "cccc")
+
+  def testServeGet(self):
+    self.store.Put(self._Name("abc"), "abc")
+    request = StringIO.StringIO("%s\n%s\n" % (self._Name("abc"),
+                                              self._Name("xyz")))
+    reply = StringIO.StringIO()
+    p2v_chunk_store.ServeGet(self.store, request, reply)
+    self.assertEqual(reply.getvalue(),
+                     struct.pack(">I", 3) + "abc" +
+                     struct.pack(">I", 0xffffffff))
+
+  def testServePut(self):
+    stream = ""
+    for data in ["abc", "defg"]:
+      stream += struct.pack(">20sI", hashlib.sha1(data).digest(), len(data))
+      stream += data
+    count = p2v_chunk_store.ServePut(self.store, StringIO.StringIO(stream))
+    self.assertEqual(count, 2)
+    self.assertEqual(self.store.Get(self._Name("defg")), "defg")
+
+  def testServePutTruncated(self):
+    stream = struct.pack(">20sI", hashlib.sha1("abc").digest(), 3) + "ab"
+    self.assertRaises(p2v_chunk_store.Error, p2v_chunk_store.ServePut,
+                      self.store, StringIO.StringIO(stream))
+
+  def testParseOptionsForcedCommand(self):
+    os.environ["SSH_ORIGINAL_COMMAND"] = "p2v_chunk_store.py get"
+    try:
+      options, command = p2v_chunk_store.ParseOptions(
+        ["p2v_chunk_store.py", "--max-size", "5"])
+    finally:
+      del os.environ["SSH_ORIGINAL_COMMAND"]
+    self.assertEqual(command, "get")
+    self.assertEqual(options.max_size, 5)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,303 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Runs many physical to virtual transfers at once.
+
+This script is run from an administrator's workstation. It reads a manifest
+of source machines, which must already be booted into the transfer OS, and
+their target instances, and runs p2v_transfer.py on each source machine over
+SSH. Transfers run concurrently, within a limit on the total number of
+transfers, a limit on the number of transfers to instances on the same ganeti
+node, and a total bandwidth budget that is shared between them.
+
+"""
+
+
+import optparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+# How long to sleep between checks whether any transfer has finished
+_POLL_INTERVAL = 1.0
+
+
+class BatchError(Exception):
+  """Generic error class for problems with the batch."""
+  pass
+
+
+class Migration(object):
+  """One line of the manifest, and the state of its transfer."""
+  def __init__(self, source, root_dev, target, keyfile, node):
+    self.source = source
+    self.root_dev = root_dev
+    self.target = target
+    self.keyfile = keyfile
+    self.node = node
+    self.status = "pending"
+    self.start_time = None
+    self.end_time = None
+    self.log_file = None
+
+  def Duration(self):
+    """Time taken by the transfer so far, in seconds."""
+    if self.start_time is None:
+      return 0
+    if self.end_time is None:
+      return time.time() - self.start_time
+    return self.end_time - self.start_time
+
+
+def ParseOptions(argv):
+  usage = "Usage: %prog [options] manifest"
+
+  parser = optparse.OptionParser(usage=usage)
+
+  parser.add_option("--ssh-key", dest="ssh_key", default=None,
+                    help=("Private key used to log in as root on the transfer"
+                          " OS of the source machines"))
+  parser.add_option("--max-parallel", type="int", dest="max_parallel",
+                    default=4, metavar="N",
+                    help="Run up to N transfers at once [default: %default]")
+  parser.add_option("--per-node", type="int", dest="per_node", default=1,
+                    metavar="N",
+                    help=("Run up to N transfers at once to instances on the"
+                          " same ganeti node [default: %default]"))
+  parser.add_option("--bandwidth", type="int", dest="bandwidth", default=0,
+                    metavar="KBPS",
+                    help=("Total bandwidth, in kilobytes per second, shared"
+                          " by all running transfers. 0 means no limit"
+                          " [default: %default]"))
+  parser.add_option("--log-dir", dest="log_dir", default=".",
+                    help=("Directory for the output of each transfer"
+                          " [default: %default]"))
+  parser.add_option("--report", dest="report", default=None,
+                    help="Also write the final status report to this file")
+  parser.add_option("--transfer-args", dest="transfer_args", default="",
+                    help=("Additional options for p2v_transfer.py, e.g."
+                          " \"--parallel 4\""))
+
+  options, args = parser.parse_args(argv[1:])
+
+  if len(args) != 1:
+    parser.print_help()
+    sys.exit(1)
+
+  if options.max_parallel < 1 or options.per_node < 1:
+    raise BatchError("--max-parallel and --per-node must be at least 1")
+
+  return options, args
+
+
+def ParseManifest(manifest_data):
+  """Read the list of transfers to make.
+
+  Each non-empty line that isn't a comment describes one transfer, with the
+  whitespace-separated fields::
+
+    source_host root_dev target_host private_key [node]
+
+  where private_key is the path of the instance key on the source machine,
+  and node is the ganeti node of the target instance. Transfers without a node
+  are not subject to the per-node limit.
+
+  @type manifest_data: str
+  @param manifest_data: Contents of the manifest file.
+  @rtype: list
+  @return: List of L{Migration} objects.
+  @raise BatchError: A line is not in the right format.
+
+  """
+  migrations = []
+  for lineno, line in enumerate(manifest_data.splitlines()):
+    words = line.split()
+    if not words or words[0].startswith("#"):
+      continue
+    if len(words) not in [4, 5]:
+      raise BatchError("Line %d of the manifest should have 4 or 5 fields" %
+                       (lineno + 1))
+    for word in words:
+      # Everything ends up on a remote command line
+      if not re.match("[-a-zA-Z0-9_.:/=@]+$", word):
+        raise BatchError("Invalid value %r on line %d of the manifest" %
+                         (word, lineno + 1))
+    if len(words) == 4:
+      words.append(None)
+    migrations.append(Migration(*words))
+  return migrations
+
+
+def BuildCommand(migration, ssh_key, bwlimit, transfer_args):
+  """Build the command that runs a transfer on its source machine.
+
+  @type migration: L{Migration}
+  @param migration: The transfer to run.
+  @type ssh_key: str
+  @param ssh_key: Private key for logging into the source machine, or None to
+    use the default.
+  @type bwlimit: int
+  @param bwlimit: Bandwidth limit for the transfer in KB/s, or 0.
+  @type transfer_args: list
+  @param transfer_args: Additional arguments for p2v_transfer.py.
+  @rtype: list
+  @return: The command, as a list of arguments.
+
+  """
+  command = ["ssh", "-o", "BatchMode=yes"]
+  if ssh_key:
+    command.extend(["-i", ssh_key])
+  command.extend(["root@%s" % migration.source, "p2v_transfer.py",
+                  "--auto-add-host-key"])
+  if bwlimit:
+    command.append("--bwlimit=%d" % bwlimit)
+  command.extend(transfer_args)
+  command.extend([migration.root_dev, migration.target, migration.keyfile])
+  return command
+
+
+def RunBatch(migrations, options):
+  """Run all the transfers, respecting the concurrency limits.
+
+  Transfers are started in manifest order, except that one which would exceed
+  the per-node limit is passed over until a transfer to that node finishes.
+  The bandwidth budget is divided evenly between the transfers that may run
+  at the same time.
+
+  @type migrations: list
+  @param migrations: List of L{Migration} objects. Their status is updated.
+  @param options: Options returned by L{ParseOptions}.
+
+  """
+  slots = min(options.max_parallel, len(migrations))
+  bwlimit = 0
+  if options.bandwidth and slots:
+    bwlimit = max(options.bandwidth / slots, 1)
+  transfer_args = options.transfer_args.split()
+
+  pending = list(migrations)
+  running = []
+  node_counts = {}
+
+  while pending or running:
+    for migration in list(pending):
+      if len(running) >= options.max_parallel:
+        break
+      if (migration.node and
+          node_counts.get(migration.node, 0) >= options.per_node):
+        continue
+      pending.remove(migration)
+      node_counts[migration.node] = node_counts.get(migration.node, 0) + 1
+
+      migration.log_file = os.path.join(options.log_dir,
+                                        "%s.log" % migration.source)
+      log = open(migration.log_file, "w")
+      command = BuildCommand(migration, options.ssh_key, bwlimit,
+                             transfer_args)
+      devnull = open(os.devnull, "r")
+      proc = subprocess.Popen(command, stdin=devnull, stdout=log,
+                              stderr=subprocess.STDOUT)
+      devnull.close()
+      log.close()
+      migration.status = "running"
+      migration.start_time = time.time()
+      running.append((migration, proc))
+      print "Started %s -> %s" % (migration.source, migration.target)
+      sys.stdout.flush()
+
+    # Only the transfers started here are waited for
+    finished = [item for item in running if item[1].poll() is not None]
+    if not finished:
+      time.sleep(_POLL_INTERVAL)
+      continue
+    for migration, proc in finished:
+      running.remove((migration, proc))
+      node_counts[migration.node] -= 1
+      migration.end_time = time.time()
+      if proc.returncode == 0:
+        migration.status = "done"
+      else:
+        migration.status = "failed"
+      print "Finished %s -> %s: %s" % (migration.source, migration.target,
+                                       migration.status)
+      sys.stdout.flush()
+
+
+def FormatReport(migrations):
+  """Format the status of every transfer as a table.
+
+  @type migrations: list
+  @param migrations: List of L{Migration} objects.
+  @rtype: str
+  @return: The report.
+
+  """
+  rows = [("Source", "Target", "Node", "Status", "Time", "Log")]
+  for migration in migrations:
+    minutes, seconds = divmod(int(migration.Duration()), 60)
+    rows.append((migration.source, migration.target, migration.node or "-",
+                 migration.status, "%d:%02d" % (minutes, seconds),
+                 migration.log_file or "-"))
+
+  widths = [max([len(row[col]) for row in rows]) for col in range(6)]
+  lines = []
+  for row in rows:
+    lines.append("  ".join([value.ljust(width)
+                            for value, width in zip(row, widths)]).rstrip())
+  return "\n".join(lines) + "\n"
+
+
+def main(argv):
+  try:
+    options, args = ParseOptions(argv)
+    try:
+      manifest = open(args[0], "r")
+      manifest_data = manifest.read()
+      manifest.close()
+    except IOError, e:
+      raise BatchError("Could not read manifest: %s" % e)
+    migrations = ParseManifest(manifest_data)
+    if not os.path.isdir(options.log_dir):
+      os.makedirs(options.log_dir)
+  except BatchError, e:
+    print e
+    sys.exit(1)
+
+  try:
+    RunBatch(migrations, options)
+  finally:
+    report = FormatReport(migrations)
+    print
+    print report,
+    if options.report:
+      report_file = open(options.report, "w")
+      report_file.write(report)
+      report_file.close()
+
+  for migration in migrations:
+    if migration.status != "done":
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -28,20 +28,326 @@ necessary to gain access to the bootstrap OS.
 """
 
 
+import Queue
 import binascii
+import collections
+import ctypes
+import ctypes.util
 import errno
+import hashlib
+import json
+import mmap
 import re
+import select
+import shutil
+import socket
 import stat
+import struct
 import sys
 import optparse
 import os
 import paramiko
+import pipes
 import subprocess
+import tempfile
+import threading
 import time
+import zlib
 
 
 TARGET_MOUNT = "/target"
 SOURCE_MOUNT = "/source"
+JOURNAL_DIR = "/var/lib/p2v-transfer"
+
+COMPRESSION_CHOICES = ["auto", "none", "zlib", "zstd", "lz4"]
+MODE_CHOICES = ["file", "block"]
+ENGINE_CHOICES = ["rsync", "native"]
+LAYOUT_CHOICES = ["single", "mirror"]
+
+# Disk devices the instance's hard drive may appear as, in order of preference
+_TARGET_DISKS = ["/dev/xvda", "/dev/vda", "/dev/sda"]
+# Tools needed on the instance for every transfer, and for --mode=block
+_REQUIRED_TOOLS = ["sfdisk", "mkfs.ext3", "mkswap", "rsync"]
+_BLOCK_MODE_TOOLS = ["python", "e2fsck", "resize2fs"]
+_NATIVE_ENGINE_TOOLS = ["tar"]
+_DEDUP_TOOLS = ["python", "ssh"]
+_VERIFY_TOOLS = ["xargs", "sha1sum"]
+_RANGE_TOOLS = ["python", "truncate", "touch"]
+_INVENTORY_TOOLS = (_REQUIRED_TOOLS + _BLOCK_MODE_TOOLS + _NATIVE_ENGINE_TOOLS +
+                    _VERIFY_TOOLS + ["mkfs.ext2", "mkfs.ext4", "ssh",
+                                     "truncate", "touch"])
+
+# Rules added by each --exclude-preset, in the syntax of --exclude
+_EXCLUDE_PRESETS = {
+  "common": ["/tmp/*", "/var/tmp/*", "/var/crash/*",
+             "/var/lib/systemd/coredump/*", "/swapfile", "/swap.img"],
+  "debian": ["/var/cache/apt/archives/*.deb",
+             "/var/cache/apt/archives/partial/*", "/var/cache/apt/*.bin",
+             "/var/lib/apt/lists/*_*"],
+  "redhat": ["/var/cache/yum/*", "/var/cache/dnf/*"],
+  "suse": ["/var/cache/zypp/packages/*"],
+  }
+
+# (codec, level) pairs tried by --compression=auto
+_COMPRESSION_CANDIDATES = [
+  ("zlib", 1),
+  ("zlib", 6),
+  ("zstd", 1),
+  ("zstd", 3),
+  ("lz4", 1),
+  ]
+_SAMPLE_BYTES = 8 * 1024 * 1024
+_SAMPLE_CHUNK_BYTES = 64 * 1024
+_SAMPLE_FILES_PER_DIR = 200
+_LINK_TEST_BYTES = 4 * 1024 * 1024
+
+# ext2/3/4 on-disk format constants
+_EXT_SUPERBLOCK_OFFSET = 1024
+_EXT_MAGIC = 0xEF53
+_EXT_FEATURE_COMPAT_RESIZE_INODE = 0x10
+_EXT_FEATURE_INCOMPAT_META_BG = 0x10
+_EXT_FEATURE_INCOMPAT_64BIT = 0x80
+_EXT_FEATURE_RO_COMPAT_SPARSE_SUPER = 0x1
+_EXT_FEATURE_RO_COMPAT_GDT_CSUM = 0x10
+_EXT_FEATURE_RO_COMPAT_METADATA_CSUM = 0x400
+_EXT_BG_BLOCK_UNINIT = 0x2
+
+_STREAM_BUFFER_BYTES = 1024 * 1024
+
+# pax archives written by the native engine: block size, largest values that
+# fit in the numeric fields of a ustar header, and the smallest amount of
+# header data sent over the network at once
+_TAR_BLOCK = 512
+_TAR_MAX_SIZE = 077777777777
+_TAR_MAX_ID = 07777777
+_TAR_MIN_SEND_BYTES = 64 * 1024
+# Holes in files are found with lseek; all-zero blocks of this size in files
+# that have holes are left out as well
+_SEEK_DATA = 3
+_SEEK_HOLE = 4
+_SPARSE_BLOCK = 4096
+# Files below the --batch-small-files threshold are sent in archives of up to
+# this many bytes or files, each unpacked by its own tar on the instance
+_BATCH_SEGMENT_BYTES = 64 * 1024 * 1024
+_BATCH_SEGMENT_FILES = 10000
+# Files above the --split-large-files threshold are sent in ranges of this
+# size, by at least this many channels at once
+_RANGE_BYTES = 64 * 1024 * 1024
+_RANGE_THREADS = 4
+# Unpacks a tar stream from stdin on the instance, keeping everything rsync
+# -aHAX would
+_TAR_EXTRACT = ("tar --numeric-owner --xattrs --xattrs-include='*'"
+                " -xp%sf - -C %s")
+
+# Capacity of the ext3 root partition made by PartitionTargetDisks: the
+# fraction taken by the journal and other metadata, which is a little
+# generous, and the bytes per inode, mke2fs's default. Swap is shrunk down to
+# the minimum if that makes the data fit.
+_TARGET_FS_OVERHEAD = 0.05
+_TARGET_BYTES_PER_INODE = 16384
+_MIN_SWAP_MEGS = 64
+# Space left unallocated for each logical partition, as sfdisk may need to
+# round their start up
+_LOGICAL_PARTITION_SLACK_MEGS = 8
+# Threads used to measure the source files when statvfs isn't precise enough
+_SCAN_THREADS = 8
+
+# mke2fs options that leave the inode tables and the journal to be zeroed
+# later, by filesystem type. Only ext4 records which inode tables are not yet
+# initialized, so ext3 can only skip zeroing the journal.
+_LAZY_INIT_OPTIONS = {
+  "ext3": "lazy_journal_init=1",
+  "ext4": "lazy_itable_init=1,lazy_journal_init=1",
+  }
+
+# Most steps of the transfer run at the same time by L{PhaseScheduler}
+_MAX_RUNNING_PHASES = 4
+# Most source filesystems mounted, checked or unmounted at once
+_MOUNT_THREADS = 8
+
+# --verify: threads hashing the source files, files hashed by each sha1sum
+# process, and most differing files named in an error. The source files are
+# hashed at idle I/O priority, so as not to slow down the transfer.
+_HASH_THREADS = 4
+_HASH_FILES_PER_COMMAND = 64
+_HASH_IO_PRIORITY = ["ionice", "-c", "3"]
+_MAX_REPORTED_MISMATCHES = 20
+
+# Remote commands: how much output to read at once, how long to sleep at most
+# between checks of the exit status, and how long to wait for quick probes
+_RECV_BYTES = 32 * 1024
+_SELECT_INTERVAL = 1.0
+_PROBE_TIMEOUT = 120
+# Local commands run side by side: how long to sleep between checks whether
+# any of them has exited
+_POLL_INTERVAL = 0.2
+
+# How often the bandwidth limit is looked up again, in seconds
+_BWLIMIT_CHECK_INTERVAL = 5
+# How often progress is shown, and the space used on the instance measured
+_PROGRESS_INTERVAL = 10
+
+# --dedup-cache: files are split into chunks of this size for the chunk cache,
+# and files smaller than the minimum are left to rsync
+_DEDUP_CHUNK_BYTES = 1024 * 1024
+_DEDUP_MIN_FILE_BYTES = 64 * 1024
+# Key the instance uses to log into the chunk cache, installed by the
+# install-fixes hook
+_CHUNK_STORE_KEY = "/root/.ssh/p2v_chunk_store_key"
+
+# Runs on the instance. Reads (offset, length, data) records from stdin and
+# writes each one at its offset in the file named on the command line, until a
+# record of length zero is received.
+_EXTENT_WRITER = """
+import os, struct, sys
+stdin = getattr(sys.stdin, "buffer", sys.stdin)
+fd = os.open(sys.argv[1], os.O_WRONLY)
+while True:
+  header = stdin.read(16)
+  if len(header) != 16:
+    sys.exit("Extent stream ended unexpectedly")
+  offset, length = struct.unpack(">QQ", header)
+  if not length:
+    break
+  os.lseek(fd, offset, 0)
+  while length:
+    data = stdin.read(min(length, 1048576))
+    if not data:
+      sys.exit("Extent stream ended unexpectedly")
+    length -= len(data)
+    while data:
+      data = data[os.write(fd, data):]
+os.fsync(fd)
+os.close(fd)
+"""
+
+# Runs on the instance, talking to the chunk cache through the command given
+# on the command line. In seed mode, reads a manifest made by _ChunkManifest
+# from stdin, and writes the chunks the cache has into the files under the
+# target directory that don't exist yet. Files that are complete get the
+# source size and mtime, so that rsync skips them, and the others are left for
+# rsync to complete by delta transfer. In fill mode, after the transfer, sends
+# the chunks that the cache was missing from the target files to the cache.
+_CHUNK_CLIENT = """
+import hashlib, os, struct, subprocess, sys
+mode, store, state, target = sys.argv[1:5]
+chunk_bytes = int(sys.argv[5])
+manifest_path = os.path.join(state, "chunk_manifest")
+missing_path = os.path.join(state, "chunk_missing")
+
+def ReadManifest(data):
+  files = []
+  pos = 0
+  while pos < len(data):
+    name_len = struct.unpack(">I", data[pos:pos + 4])[0]
+    name = data[pos + 4:pos + 4 + name_len]
+    pos += 4 + name_len
+    size, mtime, count = struct.unpack(">QdI", data[pos:pos + 20])
+    pos += 20
+    digests = [data[pos + 20 * i:pos + 20 * i + 20] for i in range(count)]
+    pos += 20 * count
+    files.append((os.path.join(target, name), size, mtime, digests))
+  return files
+
+def ReadFull(stream, length):
+  data = stream.read(length)
+  if len(data) != length:
+    sys.exit("Chunk cache reply ended unexpectedly")
+  return data
+
+def WriteAt(path, offset, data):
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT, 384)
+  os.lseek(fd, offset, 0)
+  while data:
+    data = data[os.write(fd, data):]
+  os.close(fd)
+
+if mode == "seed":
+  data = sys.stdin.read()
+  if not os.path.isdir(state):
+    os.makedirs(state)
+  out = open(manifest_path, "wb")
+  out.write(data)
+  out.close()
+  files = [f for f in ReadManifest(data) if not os.path.lexists(f[0])]
+  places = {}
+  wanted = []
+  for path, size, mtime, digests in files:
+    for i, digest in enumerate(digests):
+      if digest not in places:
+        places[digest] = []
+        wanted.append(digest)
+      places[digest].append((path, i * chunk_bytes))
+  # The cache reads the whole request before replying
+  proc = subprocess.Popen(store + " get", shell=True, stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE)
+  proc.stdin.write("".join([d.encode("hex") + "\\n" for d in wanted]))
+  proc.stdin.close()
+  found = set()
+  for digest in wanted:
+    length = struct.unpack(">I", ReadFull(proc.stdout, 4))[0]
+    if length == 0xffffffff:
+      continue
+    chunk = ReadFull(proc.stdout, length)
+    if hashlib.sha1(chunk).digest() != digest:
+      continue
+    found.add(digest)
+    for path, offset in places[digest]:
+      WriteAt(path, offset, chunk)
+  proc.stdout.close()
+  if proc.wait():
+    sys.exit("Could not read from the chunk cache")
+  missing = set()
+  for path, size, mtime, digests in files:
+    if not found.intersection(digests):
+      missing.update(digests)
+      continue
+    missing.update([d for d in digests if d not in found])
+    fd = os.open(path, os.O_WRONLY)
+    os.ftruncate(fd, size)
+    os.close(fd)
+    if found.issuperset(digests):
+      os.utime(path, (mtime, mtime))
+  out = open(missing_path, "w")
+  out.write("".join([d.encode("hex") + "\\n" for d in missing]))
+  out.close()
+  sys.stdout.write("%d of %d chunks found" % (len(found), len(wanted)))
+else:
+  if not os.path.exists(missing_path):
+    sys.exit(0)
+  missing = set([line.strip().decode("hex")
+                 for line in open(missing_path) if line.strip()])
+  files = ReadManifest(open(manifest_path, "rb").read())
+  proc = subprocess.Popen(store + " put", shell=True, stdin=subprocess.PIPE)
+  sent = 0
+  for path, size, mtime, digests in files:
+    if not missing.intersection(digests):
+      continue
+    try:
+      source = open(path, "rb")
+    except IOError:
+      continue
+    for i, digest in enumerate(digests):
+      if digest not in missing:
+        continue
+      source.seek(i * chunk_bytes)
+      chunk = source.read(chunk_bytes)
+      # The file may have changed since the manifest was made
+      if hashlib.sha1(chunk).digest() != digest:
+        continue
+      proc.stdin.write(struct.pack(">20sI", digest, len(chunk)) + chunk)
+      missing.discard(digest)
+      sent += 1
+    source.close()
+  proc.stdin.close()
+  if proc.wait():
+    sys.exit("Could not add chunks to the chunk cache")
+  os.remove(missing_path)
+  os.remove(manifest_path)
+  sys.stdout.write("%d chunks added" % sent)
+"""
 
 
 class P2VError(Exception):
@@ -49,6 +355,1117 @@ class P2VError(Exception):
   pass
 
 
+class CheckpointJournal(object):
+  """Record of the parts of a transfer that have been completed.
+
+  Each completed step is appended as a line to a file on the transfer OS, and
+  the same file is kept on the bootstrap OS, so that the record survives a
+  reboot of either machine. The first line identifies the transfer, so that a
+  journal isn't used to resume a different one.
+
+  """
+  def __init__(self, path, header, client=None, remote_path=None):
+    """Create a journal object. Nothing is read or written until L{Load} or
+    L{Reset} is called.
+
+    @type path: str
+    @param path: Location of the journal on the transfer OS.
+    @type header: str
+    @param header: String identifying the transfer.
+    @type client: paramiko.SSHClient
+    @param client: SSH client object used to connect to the instance, or None
+      to keep no copy on the instance.
+    @type remote_path: str
+    @param remote_path: Location of the journal on the instance.
+
+    """
+    self.path = path
+    self.header = header
+    self.client = client
+    self.remote_path = remote_path
+    self.entries = []
+
+  def Load(self):
+    """Read the journal of an earlier run.
+
+    Uses the copy on the instance if the local one is missing.
+
+    @raise P2VError: There is no journal, or it is for a different transfer.
+
+    """
+    try:
+      journal_file = open(self.path, "r")
+      data = journal_file.read()
+      journal_file.close()
+    except IOError:
+      data = ""
+      if self.client:
+        stdin, stdout, stderr = self.client.exec_command("cat %s" %
+                                                         self.remote_path)
+        data = stdout.read()
+
+    lines = data.splitlines()
+    if not lines:
+      raise P2VError("No record of an earlier transfer was found, so it can't"
+                     " be resumed")
+    if lines[0] != self.header:
+      raise P2VError("The earlier transfer was %r, not %r, so it can't be"
+                     " resumed" % (lines[0], self.header))
+    self.entries = lines[1:]
+
+    # Make sure both copies are complete again
+    self._Write(data, "w")
+
+  def Reset(self):
+    """Start a new, empty journal."""
+    self.entries = []
+    self._Write(self.header + "\n", "w")
+
+  def Remove(self):
+    """Delete the local journal once the transfer is complete."""
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+
+  def IsDone(self, entry):
+    """Whether a step has been recorded as complete."""
+    return entry in self.entries
+
+  def Values(self, key):
+    """Get the values recorded with entries of the form "key value".
+
+    @rtype: list
+    @return: The values, in the order they were recorded.
+
+    """
+    prefix = key + " "
+    return [entry[len(prefix):] for entry in self.entries
+            if entry.startswith(prefix)]
+
+  def MarkDone(self, entry):
+    """Record that a step is complete."""
+    self.entries.append(entry)
+    self._Write(entry + "\n", "a")
+
+  def _Write(self, data, mode):
+    """Write or append data to both copies of the journal."""
+    dirname = os.path.dirname(self.path)
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    journal_file = open(self.path, mode)
+    journal_file.write(data)
+    journal_file.flush()
+    os.fsync(journal_file.fileno())
+    journal_file.close()
+
+    if self.client:
+      if mode == "a":
+        redirect = ">>"
+      else:
+        redirect = ">"
+      stdin, stdout, stderr = self.client.exec_command(
+        "mkdir -p %s && cat %s %s && sync" %
+        (os.path.dirname(self.remote_path), redirect, self.remote_path))
+      stdin.write(data)
+      stdin.flush()
+      stdin.channel.shutdown_write()
+      if stdout.channel.recv_exit_status() != 0:
+        raise P2VError("Could not write the journal on the instance: %s" %
+                       stderr.read())
+
+
+class BandwidthLimiter(object):
+  """Limit on the rate at which data is sent to the instance.
+
+  The limit in force at any moment comes from, in order of preference, the
+  control file, the first rule of the schedule that covers the current time of
+  day, and the default rate. It is looked up again every few seconds, so it
+  can be changed while the transfer is running by writing a new value into the
+  control file.
+
+  Streams sent by this script are throttled with a token bucket through
+  L{Throttle}. rsync can't be throttled from outside, so each rsync process is
+  given the limit in force when it starts.
+
+  """
+  def __init__(self, rate=0, schedule=None, control_file=None):
+    """Create a limiter.
+
+    @type rate: int
+    @param rate: Default limit in KB/s, or 0 for no limit.
+    @type schedule: list
+    @param schedule: List of (start minute, end minute, rate) tuples, as
+      returned by L{ParseBandwidthSchedule}.
+    @type control_file: str
+    @param control_file: File which, if it exists, holds the limit in KB/s.
+
+    """
+    self.default_rate = rate
+    self.schedule = schedule or []
+    self.control_file = control_file
+    self.rate = None
+    self._checked = None
+    self._tokens = 0.0
+    self._filled = None
+    self._lock = threading.Lock()
+
+  def CurrentRate(self):
+    """Return the limit in force now, in KB/s, or 0 for no limit."""
+    now = time.time()
+    if self._checked is None or now - self._checked >= _BWLIMIT_CHECK_INTERVAL:
+      self._checked = now
+      rate = self._LookUpRate(now)
+      if self.rate is not None and rate != self.rate:
+        if rate:
+          DisplayCommandProgress("Bandwidth limit is now %d KB/s" % rate)
+        else:
+          DisplayCommandProgress("Bandwidth limit removed")
+      self.rate = rate
+    return self.rate
+
+  def Throttle(self, nbytes):
+    """Wait until nbytes more may be sent without exceeding the limit.
+
+    Up to one second's worth of unused allowance is saved up, so that short
+    pauses in the stream don't lower the average rate. Streams sent from
+    several threads share the limit.
+
+    """
+    self._lock.acquire()
+    try:
+      rate = self.CurrentRate()
+      now = time.time()
+      if not rate:
+        self._filled = now
+        return
+
+      bytes_per_sec = rate * 1024.0
+      if self._filled is not None:
+        self._tokens = min(self._tokens + (now - self._filled) * bytes_per_sec,
+                           bytes_per_sec)
+      self._filled = now
+      self._tokens -= nbytes
+      if self._tokens < 0:
+        # Other threads wait for the lock, so they are held up as well
+        time.sleep(-self._tokens / bytes_per_sec)
+    finally:
+      self._lock.release()
+
+  def _LookUpRate(self, now):
+    if self.control_file:
+      try:
+        control = open(self.control_file, "r")
+        try:
+          return max(int(control.read().strip()), 0)
+        finally:
+          control.close()
+      except (IOError, ValueError):
+        pass  # Missing or being rewritten, so fall back to the schedule
+
+    local = time.localtime(now)
+    minute = local.tm_hour * 60 + local.tm_min
+    for start, end, rate in self.schedule:
+      if start <= end:
+        in_rule = start <= minute < end
+      else:  # Runs past midnight
+        in_rule = minute >= start or minute < end
+      if in_rule:
+        return rate
+
+    return self.default_rate
+
+
+class ProgressReporter(object):
+  """Progress and timing of the steps of the transfer.
+
+  Progress is shown on the terminal and, if a log file is given, written to it
+  as one JSON object per line, each with a "time" and an "event" field:
+
+    - phase_start: a step of the transfer, given in "phase", has begun.
+    - phase_end: a step has ended; "status" is "done" or "failed" and
+      "seconds" is how long it took.
+    - progress: "bytes" and "files" have been copied so far, out of
+      "total_bytes" and "total_files". "rate" is the throughput since the
+      previous event and "avg_rate" since the start of the step, both in bytes
+      per second, "eta" is the estimated number of seconds left, and "cpu" is
+      the percentage of time the CPUs of the source machine were busy since
+      the previous event. Values that aren't known are null.
+
+  When profiling, the resources used by each step are measured as well, and
+  added to its phase_end event: CPU time of this script and of the commands
+  it ran, bytes read from the disks of the source machine, bytes sent and
+  received over the network, and the number of remote commands started and
+  how long the instance took to accept them.
+
+  Progress may be reported from another thread than the one running the
+  steps, and several steps may run at the same time. The resources measured
+  for steps that overlap include those used by each other.
+
+  """
+  def __init__(self, log_path=None, interval=_PROGRESS_INTERVAL,
+               profile=False):
+    """Create a reporter.
+
+    @type log_path: str
+    @param log_path: File to append JSON events to, or None.
+    @type interval: float
+    @param interval: Minimum number of seconds between progress events.
+    @type profile: bool
+    @param profile: Whether to measure the resources used by each step.
+    @raise P2VError: The log file can't be opened.
+
+    """
+    self.interval = interval
+    self.profile = profile
+    self.timings = []
+    self.profiles = []
+    self.phase = None
+    self.total_bytes = None
+    self.total_files = None
+    self.sparse_bytes = 0
+    self._log = None
+    self._lock = threading.Lock()
+    # Start time, resources and remote command latencies of running steps
+    self._phases = {}
+    self._first = None
+    self._last = None
+    self._cpu = None
+    if log_path:
+      try:
+        self._log = open(log_path, "a")
+      except IOError, e:
+        raise P2VError("Could not open progress log: %s" % e)
+
+  def StartPhase(self, name):
+    """Record that a step of the transfer has begun."""
+    resources = None
+    if self.profile:
+      resources = _SampleResources()
+    self._lock.acquire()
+    try:
+      self.phase = name
+      self._phases[name] = (time.time(), resources, [])
+    finally:
+      self._lock.release()
+    self._Emit("phase_start", phase=name)
+
+  def EndPhase(self, name, status="done"):
+    """Record that a step of the transfer has ended."""
+    self._lock.acquire()
+    try:
+      start, resources, latencies = self._phases.pop(name)
+      seconds = time.time() - start
+      self.timings.append((name, seconds, status))
+      if self.phase == name:
+        self.phase = None
+    finally:
+      self._lock.release()
+    usage = {}
+    if self.profile:
+      end = _SampleResources()
+      for key, value in end.items():
+        if value is None or resources.get(key) is None:
+          usage[key] = None
+        else:
+          usage[key] = value - resources[key]
+      usage["remote_commands"] = len(latencies)
+      usage["remote_latency_avg"] = None
+      usage["remote_latency_max"] = None
+      if latencies:
+        usage["remote_latency_avg"] = sum(latencies) / len(latencies)
+        usage["remote_latency_max"] = max(latencies)
+      profile = {"phase": name, "status": status, "seconds": seconds}
+      profile.update(usage)
+      self.profiles.append(profile)
+    self._Emit("phase_end", phase=name, status=status, seconds=seconds,
+               **usage)
+
+  def TimeRemoteCommands(self, client):
+    """Measure how long each command started through client takes to start.
+
+    @type client: paramiko.SSHClient
+    @param client: SSH client object used to connect to the instance.
+
+    """
+    exec_command = client.exec_command
+
+    def _TimedExecCommand(*args, **kwargs):
+      start = time.time()
+      try:
+        return exec_command(*args, **kwargs)
+      finally:
+        latency = time.time() - start
+        self._lock.acquire()
+        try:
+          for _, _, latencies in self._phases.values():
+            latencies.append(latency)
+        finally:
+          self._lock.release()
+
+    client.exec_command = _TimedExecCommand
+
+  def SetTotals(self, total_bytes, total_files=None):
+    """Set the amount of data to copy, and start measuring throughput."""
+    self.total_bytes = total_bytes
+    self.total_files = total_files
+    self._first = None
+    self._last = None
+
+  def Update(self, done_bytes, done_files=None, force=False):
+    """Report how much has been copied.
+
+    Calls more frequent than the reporting interval are ignored, unless force
+    is set.
+
+    """
+    now = time.time()
+    if self._first is None:
+      self._first = self._last = (now, done_bytes)
+      self._cpu = _ReadCpuTimes()
+      if not force:
+        return
+    elif not force and now - self._last[0] < self.interval:
+      return
+
+    rate = avg_rate = eta = cpu = None
+    if now > self._last[0]:
+      rate = (done_bytes - self._last[1]) / (now - self._last[0])
+    if now > self._first[0]:
+      avg_rate = (done_bytes - self._first[1]) / (now - self._first[0])
+    if avg_rate and self.total_bytes is not None:
+      eta = max(self.total_bytes - done_bytes, 0) / avg_rate
+    cpu_times = _ReadCpuTimes()
+    if cpu_times and self._cpu and cpu_times[1] > self._cpu[1]:
+      cpu = (100.0 * (cpu_times[0] - self._cpu[0]) /
+             (cpu_times[1] - self._cpu[1]))
+    self._last = (now, done_bytes)
+    self._cpu = cpu_times
+
+    self._Emit("progress", phase=self.phase, bytes=done_bytes,
+               files=done_files, total_bytes=self.total_bytes,
+               total_files=self.total_files, rate=rate, avg_rate=avg_rate,
+               eta=eta, cpu=cpu)
+
+    message = _FormatBytes(done_bytes)
+    if self.total_bytes:
+      message += " of %s (%d%%)" % (_FormatBytes(self.total_bytes),
+                                    min(100 * done_bytes / self.total_bytes,
+                                        100))
+    if done_files is not None:
+      message += ", %d files" % done_files
+    if rate is not None:
+      message += ", %s/s now, %s/s average" % (_FormatBytes(max(rate, 0)),
+                                               _FormatBytes(avg_rate))
+    if eta is not None:
+      message += ", %s left" % _FormatDuration(eta)
+    if cpu is not None:
+      message += ", CPU %d%%" % cpu
+    DisplayCommandProgress(message)
+
+  def AddSparseBytes(self, nbytes):
+    """Record that holes or zeros in files were not copied."""
+    self._lock.acquire()
+    try:
+      self.sparse_bytes += nbytes
+    finally:
+      self._lock.release()
+
+  def DisplaySummary(self):
+    """Show how long each step of the transfer took, and how much data was
+    skipped as holes in sparse files."""
+    if self.sparse_bytes:
+      print "Holes in sparse files not copied: %s" % _FormatBytes(
+        self.sparse_bytes)
+    print "Time taken:"
+    if self.profile:
+      self._DisplayProfile()
+      return
+    for name, seconds, status in self.timings:
+      if status == "done":
+        print "  %-20s %s" % (name, _FormatDuration(seconds))
+      else:
+        print "  %-20s %s (%s)" % (name, _FormatDuration(seconds), status)
+
+  def WriteProfile(self, path, info):
+    """Write the resources used by each step to a JSON file.
+
+    @type path: str
+    @param path: File to write.
+    @type info: dict
+    @param info: Details of the transfer to include in the report.
+
+    """
+    report = dict(info)
+    report["transfer_os"] = " ".join(os.uname())
+    report["phases"] = self.profiles
+    report["sparse_bytes"] = self.sparse_bytes
+    try:
+      report_file = open(path, "w")
+      try:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+        report_file.write("\n")
+      finally:
+        report_file.close()
+    except IOError, e:
+      print "Could not write profile report: %s" % e
+
+  def _DisplayProfile(self):
+    def _Bytes(value):
+      if value is None:
+        return "-"
+      return _FormatBytes(value)
+
+    def _Seconds(value):
+      if value is None:
+        return "-"
+      return "%.1fs" % value
+
+    print "  %-20s %9s %9s %9s %10s %10s %10s %9s" % (
+      "step", "wall", "cpu", "cmd cpu", "disk read", "net sent", "net recv",
+      "remote")
+    for profile in self.profiles:
+      cpu = None
+      if profile["cpu_user"] is not None:
+        cpu = profile["cpu_user"] + profile["cpu_system"]
+      children_cpu = None
+      if profile["children_user"] is not None:
+        children_cpu = profile["children_user"] + profile["children_system"]
+      remote = "%d" % profile["remote_commands"]
+      if profile["remote_latency_avg"] is not None:
+        remote += "/%dms" % (profile["remote_latency_avg"] * 1000)
+      name = profile["phase"]
+      if profile["status"] != "done":
+        name += " (%s)" % profile["status"]
+      print "  %-20s %9s %9s %9s %10s %10s %10s %9s" % (
+        name, _FormatDuration(profile["seconds"]), _Seconds(cpu),
+        _Seconds(children_cpu), _Bytes(profile["disk_read_bytes"]),
+        _Bytes(profile["net_sent_bytes"]),
+        _Bytes(profile["net_received_bytes"]), remote)
+
+  def Close(self):
+    """Close the log file."""
+    if self._log:
+      self._log.close()
+      self._log = None
+
+  def _Emit(self, event, **fields):
+    if not self._log:
+      return
+    fields["time"] = time.time()
+    fields["event"] = event
+    self._lock.acquire()
+    try:
+      self._log.write(json.dumps(fields, sort_keys=True) + "\n")
+      self._log.flush()
+    finally:
+      self._lock.release()
+
+
+class TargetUsageMonitor(threading.Thread):
+  """Thread reporting the space used on the instance while files are copied.
+
+  rsync doesn't report overall progress, so the space and inodes used on
+  the filesystems mounted below /target are measured instead and passed to a
+  L{ProgressReporter}.
+
+  """
+  def __init__(self, client, progress, paths=None):
+    """Create a monitor. It doesn't run until start() is called.
+
+    @type client: paramiko.SSHClient
+    @param client: SSH client object used to connect to the instance.
+    @type progress: L{ProgressReporter}
+    @param progress: Where to report progress.
+    @type paths: list
+    @param paths: Mount points on the instance to measure. Defaults to
+      /target alone.
+
+    """
+    threading.Thread.__init__(self)
+    self.setDaemon(True)
+    self.client = client
+    self.progress = progress
+    self.paths = paths or [TARGET_MOUNT]
+    self._finished = threading.Event()
+
+  def ReadUsage(self):
+    """Return the bytes and inodes used on the filesystems, added up."""
+    out, _ = _RunCommandAndWait(self.client,
+                                "stat -f -c '%%S %%b %%f %%c %%d' %s" %
+                                " ".join(self.paths), timeout=_PROBE_TIMEOUT)
+    used_bytes = 0
+    used_inodes = 0
+    lines = out.splitlines()
+    if len(lines) != len(self.paths):
+      raise P2VError("Unexpected output from stat: %r" % out)
+    for line in lines:
+      try:
+        block_size, blocks, free, inodes, free_inodes = [int(x) for x in
+                                                         line.split()]
+      except ValueError:
+        raise P2VError("Unexpected output from stat: %r" % out)
+      used_bytes += block_size * (blocks - free)
+      used_inodes += inodes - free_inodes
+    return used_bytes, used_inodes
+
+  def run(self):
+    while not self._finished.isSet():
+      try:
+        self.progress.Update(*self.ReadUsage())
+      except (P2VError, paramiko.SSHException, EnvironmentError):
+        pass  # Progress is only informational, so don't stop the transfer
+      self._finished.wait(self.progress.interval)
+
+  def Stop(self):
+    """Stop the thread, after reporting the final usage."""
+    self._finished.set()
+    self.join()
+    try:
+      self.progress.Update(force=True, *self.ReadUsage())
+    except (P2VError, paramiko.SSHException, EnvironmentError):
+      pass
+
+
+class PhaseScheduler(object):
+  """Runs the steps of the transfer that don't depend on each other at once.
+
+  Each step is a function, called with the results of the steps it requires
+  once they have all completed. Steps are started in the order they were
+  added, as soon as their requirements allow, each in a thread of its own.
+  Steps are only started while the main thread waits for one with L{Wait}
+  or L{Result}; those already started carry on in the meantime.
+
+  Once a step fails, no new ones are started, but the ones already running
+  are allowed to finish. Steps that were not started fail with the same
+  error. Long steps may give up early once L{cancelled} is set by L{Stop}.
+
+  """
+  def __init__(self, reporter, max_running=_MAX_RUNNING_PHASES):
+    """Create a scheduler.
+
+    @type reporter: L{ProgressReporter}
+    @param reporter: Where to record the steps, or None.
+    @type max_running: int
+    @param max_running: Maximum number of steps to run at the same time.
+
+    """
+    self.reporter = reporter
+    self.max_running = max_running
+    self._pending = []
+    self._running = 0
+    self._results = {}
+    self._errors = {}
+    self._failure = None
+    self._finished = Queue.Queue()
+    self.cancelled = threading.Event()
+
+  def Add(self, name, func, requires=()):
+    """Add a step.
+
+    @type name: str
+    @param name: Name of the step, under which it is timed.
+    @param func: Function carrying out the step.
+    @type requires: list
+    @param requires: Names of the steps, added before, whose results func is
+      called with.
+
+    """
+    for required in requires:
+      if (required not in self._results and required not in self._errors and
+          required not in [step[0] for step in self._pending]):
+        raise ValueError("Step %s requires unknown step %s" % (name, required))
+    self._pending.append((name, func, list(requires)))
+
+  def Wait(self, names):
+    """Wait for steps to complete, running others in the meantime.
+
+    @type names: list
+    @param names: Names of the steps to wait for.
+    @raise Exception: The error of the first of the steps that failed.
+
+    """
+    self._RunUntil(names)
+    for name in names:
+      if name in self._errors:
+        exc_info = self._errors[name]
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+  def Result(self, name):
+    """Wait for a step to complete and get its result.
+
+    @raise Exception: The error the step failed with.
+
+    """
+    self.Wait([name])
+    return self._results[name]
+
+  def Get(self, name, default=None):
+    """Get the result of a step if it has completed, without waiting."""
+    return self._results.get(name, default)
+
+  def Start(self):
+    """Start the steps that can run now, without waiting for them."""
+    self._StartReady()
+
+  def Stop(self, cancel=False):
+    """Start no more steps, and wait for the running ones to complete.
+
+    Errors of the running steps are ignored.
+
+    @type cancel: bool
+    @param cancel: Whether to set L{cancelled}, so that long steps end early.
+
+    """
+    if cancel:
+      self.cancelled.set()
+    self._pending = []
+    self._RunUntil([])
+
+  def _RunUntil(self, names):
+    while True:
+      self._StartReady()
+      if not self._running:
+        break
+      if not [name for name in names
+              if name not in self._results and name not in self._errors]:
+        break
+      try:
+        # With a timeout, so that Ctrl-C is noticed
+        name, result, exc_info = self._finished.get(True, _SELECT_INTERVAL)
+      except Queue.Empty:
+        continue
+      self._running -= 1
+      if exc_info:
+        self._errors[name] = exc_info
+        if not self._failure:
+          self._failure = exc_info
+      else:
+        self._results[name] = result
+
+  def _StartReady(self):
+    for step in list(self._pending):
+      name, func, requires = step
+      if self._failure:
+        self._pending.remove(step)
+        self._errors[name] = self._failure
+        continue
+      if self._running >= self.max_running:
+        break
+      if [required for required in requires
+          if required not in self._results]:
+        continue
+      self._pending.remove(step)
+      args = [self._results[required] for required in requires]
+      thread = threading.Thread(target=self._Run, args=(name, func, args))
+      thread.setDaemon(True)
+      thread.start()
+      self._running += 1
+
+  def _Run(self, name, func, args):
+    _display.whole_lines = True
+    try:
+      if self.reporter:
+        result = _RunPhase(self.reporter, name, func, *args)
+      else:
+        result = func(*args)
+    except:  # Passed on to the main thread, even if it is SystemExit
+      self._finished.put((name, None, sys.exc_info()))
+    else:
+      self._finished.put((name, result, None))
+
+
+class BlockDeviceIndex(object):
+  """The block devices of this machine, as found by a single scan.
+
+  Devices can be looked up by their file or by a UUID=, LABEL= or PARTUUID=
+  spec, as used in fstab, without running a command for each.
+
+  """
+  TAGS = ["UUID", "LABEL", "PARTUUID"]
+
+  def __init__(self, tags, sizes):
+    """Create an index.
+
+    @type tags: dict
+    @param tags: Tags reported by blkid, such as UUID and TYPE, as a dict for
+      each device file.
+    @type sizes: dict
+    @param sizes: Sizes of the devices in bytes, by kernel name.
+
+    """
+    self.tags = tags
+    self.sizes = sizes
+    self._by_spec = {}
+    for dev, dev_tags in tags.items():
+      for tag in self.TAGS:
+        if dev_tags.get(tag):
+          self._by_spec["%s=%s" % (tag, dev_tags[tag])] = dev
+
+  def Resolve(self, spec):
+    """Get the device file for a spec.
+
+    @type spec: str
+    @param spec: Device file, or UUID=, LABEL= or PARTUUID= spec.
+    @rtype: str
+    @return: The device file, or None if there is no such device.
+
+    """
+    if spec.startswith("/"):
+      return spec
+    return self._by_spec.get(spec)
+
+  def Size(self, dev):
+    """Get the size of a device in bytes, or None if it isn't known."""
+    return self.sizes.get(os.path.basename(os.path.realpath(dev)))
+
+  def FsType(self, dev):
+    """Get the type of the filesystem on a device, or None if not known."""
+    return self.tags.get(dev, {}).get("TYPE")
+
+
+class ExclusionRules(object):
+  """Rules deciding which source files are left out of the transfer.
+
+  Each rule is one of:
+
+    - a glob pattern. One without a slash is matched against the name of
+      each file, one with a slash against its path from the root of the
+      source machine. "*" and "?" don't match slashes, "**" does.
+    - "re:" followed by a regular expression, searched for in the path.
+    - "size>" followed by a size in bytes, with an optional K, M or G suffix.
+      Regular files larger than this are left out.
+
+  A rule preceded by "fs=MOUNT_POINT " only applies to the filesystem
+  mounted there. The glob patterns of each filesystem are compiled into a
+  single regular expression.
+
+  """
+  def __init__(self, rules):
+    """Compile the rules.
+
+    @type rules: list
+    @param rules: The rules, as strings.
+    @raise P2VError: A rule is not valid.
+
+    """
+    self.rules = list(rules)
+    # By mount point, or None for the rules that apply everywhere
+    self._matchers = {}
+
+    parsed = {}
+    for rule in self.rules:
+      mount_point = None
+      pattern = rule
+      if rule.startswith("fs="):
+        try:
+          mount_point, pattern = rule[3:].split(None, 1)
+        except ValueError:
+          raise P2VError("Invalid exclusion rule %r" % rule)
+        mount_point = os.path.normpath(mount_point)
+      names, paths, regexes, sizes = parsed.setdefault(mount_point,
+                                                       ([], [], [], []))
+      if pattern.startswith("re:"):
+        try:
+          regexes.append((re.compile(pattern[3:]), rule))
+        except re.error, e:
+          raise P2VError("Invalid regular expression in exclusion rule %r: %s"
+                         % (rule, e))
+      elif pattern.startswith("size>"):
+        sizes.append((_ParseSize(pattern[5:], rule), rule))
+      elif not pattern:
+        raise P2VError("Invalid exclusion rule %r" % rule)
+      elif "/" in pattern:
+        paths.append((_GlobToRegex(pattern), rule))
+      else:
+        names.append((_GlobToRegex(pattern), rule))
+
+    for mount_point, (names, paths, regexes, sizes) in parsed.items():
+      self._matchers[mount_point] = (_CompileGlobs(names),
+                                     _CompileGlobs(paths), regexes,
+                                     min(sizes or [(None, None)]))
+
+  def Match(self, path, stats, mount_point="/"):
+    """Find the rule that excludes a file, if any.
+
+    @type path: str
+    @param path: Path of the file from the root of the source machine.
+    @type stats: posix.stat_result
+    @param stats: Result of lstat on the file.
+    @type mount_point: str
+    @param mount_point: Mount point of the filesystem the file is on.
+    @rtype: str
+    @return: The rule that excludes the file, or None.
+
+    """
+    for key in [None, mount_point]:
+      matcher = self._matchers.get(key)
+      if not matcher:
+        continue
+      names, paths, regexes, (max_bytes, size_rule) = matcher
+      for regex, globs, value in [names + (os.path.basename(path),),
+                                  paths + (path,)]:
+        if regex:
+          match = regex.match(value)
+          if match:
+            return globs[match.lastindex - 1]
+      for regex, rule in regexes:
+        if regex.search(path):
+          return rule
+      if (max_bytes is not None and stat.S_ISREG(stats.st_mode) and
+          stats.st_size > max_bytes):
+        return size_rule
+    return None
+
+
+def _GlobToRegex(pattern):
+  """Translate a glob pattern into a regular expression.
+
+  Unlike with fnmatch, "*" and "?" don't match slashes, and "**" matches
+  anything. The regular expression has no groups.
+
+  """
+  parts = []
+  i = 0
+  while i < len(pattern):
+    if pattern.startswith("**", i):
+      parts.append(".*")
+      i += 2
+      continue
+    char = pattern[i]
+    # A "]" right after the "[" is part of the set
+    end = pattern.find("]", i + 2)
+    if char == "*":
+      parts.append("[^/]*")
+    elif char == "?":
+      parts.append("[^/]")
+    elif char == "[" and end >= 0:
+      body = pattern[i + 1:end].replace("\\", "\\\\")
+      if body.startswith("!"):
+        body = "^" + body[1:]
+      parts.append("[%s]" % body)
+      i = end
+    else:
+      parts.append(re.escape(char))
+    i += 1
+  return "".join(parts)
+
+
+def _CompileGlobs(globs):
+  """Compile translated glob patterns into one regular expression.
+
+  @type globs: list
+  @param globs: List of (regular expression, rule) tuples.
+  @rtype: (regex, list)
+  @return: The compiled regular expression, whose last matching group is the
+    index of the matching rule plus one, or None if there are no patterns,
+    and the rules.
+
+  """
+  if not globs:
+    return None, []
+  regex = re.compile("|".join(["(%s)\\Z" % glob for glob, _ in globs]),
+                     re.DOTALL)
+  return regex, [rule for _, rule in globs]
+
+
+def _ParseSize(text, rule):
+  """Parse a size in bytes with an optional K, M or G suffix."""
+  match = re.match("([0-9]+)([KMG]?)$", text.upper())
+  if not match:
+    raise P2VError("Invalid size in exclusion rule %r" % rule)
+  units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+  return int(match.group(1)) * units[match.group(2)]
+
+
+# A file listed in a SourceIndex. The fields are named like those of the
+# result of os.lstat, so that it can be used in its place.
+_IndexEntry = collections.namedtuple("_IndexEntry", [
+  "mount_point", "path", "st_mode", "st_nlink", "st_dev", "st_ino",
+  "st_size", "st_blocks", "st_mtime"])
+
+
+class SourceIndex(object):
+  """The files on the source filesystems, as found by one walk, kept on disk.
+
+  Made by L{ScanSource}, and read by the steps that need to look at every
+  source file, rather than each walking the filesystems again. The index is
+  made of parts, one for the top level of each filesystem and one for each
+  directory there, which can be read in parallel. A part is a file of
+  records, each a fixed-size header followed by the path of the file from
+  the root of the source machine, and is read through mmap. Within a part,
+  directories come before their contents.
+
+  """
+  # mode, links, device, inode, size, blocks, mtime, length of the path
+  _HEADER = struct.Struct(">IIQQQQdH")
+
+  def __init__(self, directory):
+    """Create an empty index.
+
+    @type directory: str
+    @param directory: Directory to keep the parts in. It is removed by
+      L{Close}.
+
+    """
+    self.directory = directory
+    # (mount point, filename) of each part, in order
+    self.parts = []
+    # Mount points of the filesystems listed
+    self.mount_points = []
+
+  def AddPart(self, mount_point):
+    """Add a part listing files of the filesystem mounted at mount_point.
+
+    @rtype: file
+    @return: The part, open for writing records from L{Record}.
+
+    """
+    filename = os.path.join(self.directory, str(len(self.parts)))
+    self.parts.append((mount_point, filename))
+    return open(filename, "wb")
+
+  def Record(self, path, stats):
+    """Build the record of a file.
+
+    @type path: str
+    @param path: Path of the file from the root of the source machine.
+    @type stats: posix.stat_result
+    @param stats: Result of lstat on the file.
+    @rtype: str
+
+    """
+    return self._HEADER.pack(stats.st_mode, stats.st_nlink, stats.st_dev,
+                             stats.st_ino, stats.st_size, stats.st_blocks,
+                             stats.st_mtime, len(path)) + path
+
+  def Entries(self, part=None):
+    """Read the files listed in the index.
+
+    @type part: int
+    @param part: Number of the part to read, or None to read all of them.
+    @rtype: generator
+    @return: Generator of L{_IndexEntry} tuples.
+
+    """
+    if part is None:
+      parts = self.parts
+    else:
+      parts = [self.parts[part]]
+    header_bytes = self._HEADER.size
+    for mount_point, filename in parts:
+      if not os.path.getsize(filename):
+        continue  # mmap can't map empty files
+      part_file = open(filename, "rb")
+      try:
+        data = mmap.mmap(part_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+          offset = 0
+          while offset < len(data):
+            fields = self._HEADER.unpack_from(data, offset)
+            offset += header_bytes
+            path = data[offset:offset + fields[-1]]
+            offset += fields[-1]
+            yield _IndexEntry(mount_point, path, *fields[:-1])
+        finally:
+          data.close()
+      finally:
+        part_file.close()
+
+  def Usage(self):
+    """Add up the space and inodes used on each filesystem.
+
+    Files with several hard links are counted once. The root directory of
+    each filesystem counts as an inode.
+
+    @rtype: list
+    @return: List of (mount point, used bytes, used inodes) tuples.
+
+    """
+    seen_links = set()
+    totals = dict([(mount_point, (0, 1)) for mount_point in self.mount_points])
+    for entry in self.Entries():
+      if not stat.S_ISDIR(entry.st_mode) and entry.st_nlink > 1:
+        key = (entry.st_dev, entry.st_ino)
+        if key in seen_links:
+          continue
+        seen_links.add(key)
+      used_bytes, used_inodes = totals[entry.mount_point]
+      totals[entry.mount_point] = (used_bytes + entry.st_blocks * 512,
+                                   used_inodes + 1)
+    return [(mount_point,) + totals[mount_point]
+            for mount_point in self.mount_points]
+
+  def Close(self):
+    """Remove the index from the disk."""
+    shutil.rmtree(self.directory, True)
+
+
+class _XattrReader(object):
+  """Reads the extended attributes of files, including their ACLs.
+
+  Python 2 has no interface to extended attributes, so the C library is
+  called directly. If that isn't possible, no attributes are read.
+
+  """
+  def __init__(self):
+    self._libc = None
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                         use_errno=True)
+      for func in [libc.llistxattr, libc.lgetxattr]:
+        func.restype = ctypes.c_long
+      self._libc = libc
+    except (OSError, AttributeError):
+      pass
+
+  def Read(self, path):
+    """Return the extended attributes of path, not following symlinks.
+
+    @rtype: list
+    @return: List of (name, value) tuples.
+    @raise OSError: The attributes could not be read.
+
+    """
+    if not self._libc:
+      return []
+    names = self._Call(self._libc.llistxattr, path)
+    attributes = []
+    for name in names.split("\0"):
+      if not name:
+        continue
+      try:
+        attributes.append((name, self._Call(self._libc.lgetxattr, path, name)))
+      except OSError, e:
+        if e.errno != errno.ENODATA:  # Removed in the meantime
+          raise
+    return attributes
+
+  def _Call(self, func, *args):
+    """Call a function that fills a buffer, growing it until it fits."""
+    size = 0
+    while True:
+      if size:
+        buf = ctypes.create_string_buffer(size)
+      else:
+        buf = None
+      result = func(*(args + (buf, size)))
+      if result < 0:
+        err = ctypes.get_errno()
+        if err in [errno.ENOTSUP, errno.EOPNOTSUPP]:
+          return ""
+        if err == errno.ERANGE:  # Grew since the size was asked for
+          size = 0
+          continue
+        raise OSError(err, os.strerror(err))
+      if not size:
+        if not result:
+          return ""
+        size = result
+        continue
+      return buf.raw[:result]
+
+
 class AskAddPolicy(paramiko.AutoAddPolicy):
   """Policy that asks the user to confirm a key before adding it."""
   def missing_host_key(self, client, hostname, key):
@@ -72,6 +1489,136 @@ def ParseOptions(argv):
                           " not installed on source machine. Useful if you are"
                           " feeling adventurous, or your instance kernel does"
                           " not use modules."))
+  parser.add_option("--fsck", action="store_true", dest="fsck",
+                    default=False,
+                    help=("Check the source filesystems with fsck before"
+                          " mounting them, all at the same time, and stop if"
+                          " any has errors that fsck can't correct"))
+  parser.add_option("--mode", type="choice", dest="mode",
+                    choices=MODE_CHOICES, default="file",
+                    help=("How to copy the root filesystem: 'file' copies"
+                          " files with rsync, 'block' copies the used blocks"
+                          " of the ext2/3/4 filesystem and then grows it to"
+                          " fill the target partition [default: %default]"))
+  parser.add_option("--engine", type="choice", dest="engine",
+                    choices=ENGINE_CHOICES, default="rsync",
+                    help=("How to copy files: 'rsync' runs rsync over a"
+                          " separate SSH connection, 'native' streams them"
+                          " over the connection this script already has,"
+                          " which is faster for a first copy but always"
+                          " sends every file [default: %default]"))
+  parser.add_option("--compression", type="choice", dest="compression",
+                    choices=COMPRESSION_CHOICES, default="zlib",
+                    help=("Compression used by rsync: one of %s. 'auto'"
+                          " measures the source data and network link to"
+                          " pick the fastest setting [default: %%default]" %
+                          ", ".join(COMPRESSION_CHOICES)))
+  parser.add_option("--parallel", type="int", dest="parallel", default=None,
+                    metavar="N",
+                    help=("Run up to N rsync processes at once, one for each"
+                          " source filesystem. Defaults to 1, or with"
+                          " --layout=mirror to the number of partitions"))
+  parser.add_option("--layout", type="choice", dest="layout",
+                    choices=LAYOUT_CHOICES, default=None,
+                    help=("Partitions for the instance: 'single' puts all"
+                          " filesystems on one ext3 partition, 'mirror'"
+                          " gives each source filesystem its own partition"
+                          " of the same type, scaled to the instance disk."
+                          " With --resume, defaults to the layout of the"
+                          " earlier transfer [default: single]"))
+  parser.add_option("--batch-small-files", type="int",
+                    dest="batch_small_files", default=0, metavar="KB",
+                    help=("Before running rsync, send the files smaller than"
+                          " KB kilobytes in batched archives, which is much"
+                          " faster for many small files. 0 turns this off"
+                          " [default: %default]"))
+  parser.add_option("--split-large-files", type="int",
+                    dest="split_large_files", default=0, metavar="MB",
+                    help=("Before running rsync, send the files of MB"
+                          " megabytes or more in ranges, several at once."
+                          " 0 turns this off [default: %default]"))
+  parser.add_option("--split-dirs", action="store_true", dest="split_dirs",
+                    default=False,
+                    help=("With --parallel, also transfer each top-level"
+                          " directory of a filesystem separately. Hard links"
+                          " between these directories will not be"
+                          " preserved."))
+  parser.add_option("--bwlimit", type="int", dest="bwlimit", default=0,
+                    metavar="KBPS",
+                    help=("Limit the bandwidth used by the transfer to KBPS"
+                          " kilobytes per second, shared between parallel"
+                          " rsync processes. 0 means no limit"
+                          " [default: %default]"))
+  parser.add_option("--bwlimit-schedule", dest="bwlimit_schedule",
+                    default="", metavar="SCHEDULE",
+                    help=("Bandwidth limits for times of day, overriding"
+                          " --bwlimit, e.g. \"08:00-18:00=2000\". Several"
+                          " rules can be separated by commas"))
+  parser.add_option("--bwlimit-file", dest="bwlimit_file", default=None,
+                    metavar="FILE",
+                    help=("While FILE exists, the bandwidth limit in KB/s is"
+                          " read from it, overriding --bwlimit and"
+                          " --bwlimit-schedule. It can be changed during"
+                          " the transfer"))
+  parser.add_option("--auto-add-host-key", action="store_true",
+                    dest="auto_add_host_key", default=False,
+                    help=("Accept the SSH host key of the instance without"
+                          " asking, for unattended transfers"))
+  parser.add_option("--progress-log", dest="progress_log", default=None,
+                    metavar="FILE",
+                    help=("Append progress and the time taken by each step"
+                          " to FILE, as JSON objects, one per line"))
+  parser.add_option("--profile", dest="profile", default=None,
+                    metavar="FILE",
+                    help=("Measure the time and resources used by each step"
+                          " of the transfer, show them at the end and write"
+                          " them to FILE as JSON"))
+  parser.add_option("--warm", action="store_true", dest="warm",
+                    default=False,
+                    help=("Run on the source machine while it is still in"
+                          " use, to copy most of the data ahead of time."
+                          " Afterwards, boot the transfer OS and run again"
+                          " with --resume to copy only what has changed"))
+  parser.add_option("--dedup-cache", dest="dedup_cache", default=None,
+                    metavar="USER@HOST",
+                    help=("Fetch data that is already in the chunk cache on"
+                          " USER@HOST from there rather than sending it from"
+                          " this machine, and add the rest to the cache"
+                          " afterwards. See README for setting up the"
+                          " cache"))
+  parser.add_option("--exclude", action="append", dest="exclude",
+                    default=[], metavar="RULE",
+                    help=("Leave out the source files matching RULE. See"
+                          " README for the rules. May be given several"
+                          " times"))
+  parser.add_option("--exclude-from", action="append", dest="exclude_from",
+                    default=[], metavar="FILE",
+                    help="Read exclusion rules from FILE, one per line")
+  parser.add_option("--exclude-preset", action="append",
+                    dest="exclude_preset", default=[],
+                    choices=sorted(_EXCLUDE_PRESETS.keys()),
+                    help=("Leave out the caches and temporary files of a"
+                          " distribution: %s. May be given several times" %
+                          ", ".join(sorted(_EXCLUDE_PRESETS.keys()))))
+  parser.add_option("--dry-run", action="store_true", dest="dry_run",
+                    default=False,
+                    help=("Only report how much data the exclusion rules"
+                          " leave out, without connecting to the instance"))
+  parser.add_option("--verify", action="store_true", dest="verify",
+                    default=False,
+                    help=("Check the files on the instance against the"
+                          " source after the transfer, and send those that"
+                          " differ again"))
+  parser.add_option("--resume", action="store_true", dest="resume",
+                    default=False,
+                    help=("Continue an earlier transfer to the same instance"
+                          " that was interrupted, skipping the steps that"
+                          " were already completed"))
+  parser.add_option("--index-dir", dest="index_dir", metavar="DIR",
+                    default=JOURNAL_DIR,
+                    help=("Directory on a disk of the source machine to keep"
+                          " the index of the source files in (default: %s)" %
+                          JOURNAL_DIR))
 
   options, args = parser.parse_args(argv[1:])
 
@@ -79,6 +1626,62 @@ def ParseOptions(argv):
     parser.print_help()
     sys.exit(1)
 
+  # Otherwise one rsync for each partition, which may only be known from the
+  # journal
+  if options.parallel is not None and options.parallel < 1:
+    raise P2VError("--parallel must be at least 1")
+  if options.layout == "mirror" and options.mode == "block":
+    raise P2VError("--layout=mirror can't be used with --mode=block")
+  if options.bwlimit < 0:
+    raise P2VError("--bwlimit must not be negative")
+  if options.warm and options.mode == "block":
+    raise P2VError("--warm can't be used with --mode=block, as the blocks of"
+                   " a filesystem in use can't be copied consistently")
+  if options.warm and options.engine == "native":
+    raise P2VError("--warm needs --engine=rsync, so that the final pass only"
+                   " copies changes")
+  if options.batch_small_files < 0:
+    raise P2VError("--batch-small-files must not be negative")
+  if options.batch_small_files and options.engine == "native":
+    raise P2VError("--batch-small-files only applies to --engine=rsync, as"
+                   " the native engine already sends files in archives")
+  if options.split_large_files < 0:
+    raise P2VError("--split-large-files must not be negative")
+  if options.split_large_files and options.engine == "native":
+    raise P2VError("--split-large-files only applies to --engine=rsync")
+  if (options.split_large_files and
+      options.batch_small_files >= options.split_large_files * 1024):
+    raise P2VError("--batch-small-files must be below --split-large-files")
+  if options.dedup_cache:
+    if not re.match("([-a-zA-Z0-9_.]+@)?[-a-zA-Z0-9.]+$", options.dedup_cache):
+      raise P2VError("Invalid chunk cache %s" % options.dedup_cache)
+    if options.mode == "block" or options.engine == "native":
+      raise P2VError("--dedup-cache needs --mode=file and --engine=rsync, as"
+                     " rsync completes the files the cache only has parts of")
+  options.bwlimit_schedule = ParseBandwidthSchedule(options.bwlimit_schedule)
+
+  rules = []
+  for preset in options.exclude_preset:
+    rules.extend(_EXCLUDE_PRESETS[preset])
+  for filename in options.exclude_from:
+    try:
+      rules_file = open(filename, "r")
+      try:
+        for line in rules_file:
+          line = line.strip()
+          if line and not line.startswith("#"):
+            rules.append(line)
+      finally:
+        rules_file.close()
+    except IOError, e:
+      raise P2VError("Could not read exclusion rules: %s" % e)
+  rules.extend(options.exclude)
+  options.exclusions = None
+  if rules:
+    options.exclusions = ExclusionRules(rules)
+  elif options.dry_run:
+    raise P2VError("--dry-run needs exclusion rules to report on")
+
   try:
     stats = os.stat(args[0])
     if not stat.S_ISBLK(stats.st_mode):
@@ -94,6 +1697,39 @@ def ParseOptions(argv):
   return options, args
 
 
+def ParseBandwidthSchedule(spec):
+  """Parse the rules given with --bwlimit-schedule.
+
+  Each rule has the form HH:MM-HH:MM=KBPS. Hours go from 0 to 23, and 24:00
+  stands for midnight. A rule whose end is earlier than its start runs past
+  midnight.
+
+  @type spec: str
+  @param spec: Comma-separated list of rules.
+  @rtype: list
+  @return: List of (start minute, end minute, rate) tuples, where minutes are
+    counted from midnight.
+  @raise P2VError: A rule is not in the right format.
+
+  """
+  schedule = []
+  for rule in spec.split(","):
+    rule = rule.strip()
+    if not rule:
+      continue
+    match = re.match(r"(\d\d?):(\d\d)-(\d\d?):(\d\d)=(\d+)$", rule)
+    if not match:
+      raise P2VError("Invalid bandwidth schedule rule %r, expected"
+                     " HH:MM-HH:MM=KBPS" % rule)
+    start_h, start_m, end_h, end_m, rate = [int(x) for x in match.groups()]
+    start = start_h * 60 + start_m
+    end = end_h * 60 + end_m
+    if start_m > 59 or end_m > 59 or start > 24 * 60 or end > 24 * 60:
+      raise P2VError("Invalid time in bandwidth schedule rule %r" % rule)
+    schedule.append((start, end, rate))
+  return schedule
+
+
 def LoadSSHKey(keyfile):
   """Loads private key into paramiko.
 
@@ -117,7 +1753,7 @@ def LoadSSHKey(keyfile):
   return key
 
 
-def EstablishConnection(user, host, key):
+def EstablishConnection(user, host, key, ask_host_key=True):
   """Creates a connection to the specified host.
 
   Uses a private key to establish an SSH connection to the bootstrap OS, and
@@ -129,6 +1765,9 @@ def EstablishConnection(user, host, key):
   @param host: Hostname of machine to connect to.
   @type key: paramiko.PKey
   @param key: Private key to use for authentication.
+  @type ask_host_key: bool
+  @param ask_host_key: Whether to ask the user to confirm an unknown host key.
+    If not, the key is accepted and saved without asking.
 
   @rtype: paramiko.SSHClient
   @returns: SSHClient object connected to a root shell on the target instance.
@@ -137,7 +1776,10 @@ def EstablishConnection(user, host, key):
   DisplayCommandStart("Connecting to instance...")
 
   client = paramiko.SSHClient()
-  client.set_missing_host_key_policy(AskAddPolicy())
+  if ask_host_key:
+    client.set_missing_host_key_policy(AskAddPolicy())
+  else:
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
   known_hosts_filename = os.path.expanduser("~root/.ssh/known_hosts")
   try:
     # Load from the known_hosts file. Additional keys will be saved back there.
@@ -163,7 +1805,94 @@ def EstablishConnection(user, host, key):
   return client
 
 
-def VerifyKernelMatches(client):
+def GetTargetInventory(client, required_tools=None):
+  """Find out everything needed about the instance in one command.
+
+  Runs a single script on the instance that reports its disks and their
+  sizes, its kernel release, which of the tools we use are installed, the
+  compression codecs supported by its rsync, and its free memory and free
+  space on the (RAM-backed) root filesystem. The result is used by
+  L{FindTargetHardDrive}, L{VerifyKernelMatches}, L{GetDiskSize} and
+  L{ChooseCompression}, so that they don't each need a round trip.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type required_tools: list
+  @param required_tools: Tools that must be installed on the instance.
+  @rtype: dict
+  @return: Dictionary with keys "disks" (list of (device, size in bytes)
+    tuples), "kernel" (str), "tools" (list), "rsync_compressors" (list),
+    "mem_free_kb" (int), "root_free_kb" (int) and "mkfs_lazy_init" (bool,
+    whether mke2fs knows the options that defer zeroing).
+  @raise P2VError: A required tool is missing.
+
+  """
+  DisplayCommandStart("Examining instance...")
+
+  script = "\n".join([
+    "for hd in %s; do" % " ".join(_TARGET_DISKS),
+    "  if test -b $hd; then echo disk $hd $(blockdev --getsize64 $hd); fi",
+    "done",
+    "echo kernel $(uname -r)",
+    "for tool in %s; do" % " ".join(_INVENTORY_TOOLS),
+    "  if command -v $tool >/dev/null 2>&1; then echo tool $tool; fi",
+    "done",
+    "echo rsync_compressors $(rsync --version 2>/dev/null |"
+    " sed -n '/Compress list:/{n;p}')",
+    "echo mem_free_kb $(awk '/^MemFree:/ {print $2}' /proc/meminfo)",
+    "echo root_free_kb $(df -Pk / | awk 'NR == 2 {print $4}')",
+    # -n only shows what would be done, after the options were checked
+    "image=$(mktemp) && if mke2fs -n -F -q -E %s $image 1024 >/dev/null 2>&1;"
+    " then echo mkfs_lazy_init; fi; rm -f $image" %
+    _LAZY_INIT_OPTIONS["ext4"],
+    ])
+  out, _ = _RunCommandAndWait(client, script, timeout=_PROBE_TIMEOUT)
+
+  inventory = {
+    "disks": [],
+    "kernel": "",
+    "tools": [],
+    "rsync_compressors": ["zlib"],
+    "mem_free_kb": 0,
+    "root_free_kb": 0,
+    "mkfs_lazy_init": False,
+    }
+  for line in out.splitlines():
+    words = line.split()
+    if not words:
+      continue
+    key, values = words[0], words[1:]
+    try:
+      if key == "disk" and len(values) == 2:
+        inventory["disks"].append((values[0], int(values[1])))
+      elif key == "kernel" and values:
+        inventory["kernel"] = values[0]
+      elif key == "tool" and values:
+        inventory["tools"].append(values[0])
+      elif key == "rsync_compressors" and values:
+        inventory["rsync_compressors"] = values
+      elif key in ["mem_free_kb", "root_free_kb"] and values:
+        inventory[key] = int(values[0])
+      elif key == "mkfs_lazy_init":
+        inventory[key] = True
+    except ValueError:
+      pass  # A value could not be determined, so leave the default
+
+  missing = [tool for tool in required_tools or []
+             if tool not in inventory["tools"]]
+  if missing:
+    raise P2VError("These programs are missing on the instance: %s" %
+                   ", ".join(missing))
+
+  DisplayCommandEnd("kernel %s, disks %s, %d MB free memory" %
+                    (inventory["kernel"],
+                     ", ".join(["%s (%d MB)" % (dev, size / (1024 * 1024))
+                                for dev, size in inventory["disks"]]),
+                     inventory["mem_free_kb"] / 1024))
+  return inventory
+
+
+def VerifyKernelMatches(client, inventory=None):
   """Make sure the bootstrap kernel is installed on the source OS.
 
   In order for the source OS to boot when transferred to the instance, it must
@@ -175,14 +1904,19 @@ def VerifyKernelMatches(client):
 
   @type client: paramiko.SSHClient
   @param client: SSH client object used to connect to the instance.
+  @type inventory: dict
+  @param inventory: Result of L{GetTargetInventory}, if already known.
   @rtype: bool
   @returns: True if the proper kernel is installed, else False.
 
   """
   DisplayCommandStart("Checking kernel compatibility...")
 
-  stdin, stdout, stderr = client.exec_command("uname -r")
-  kernel = stdout.read().strip()
+  if inventory:
+    kernel = inventory["kernel"]
+  else:
+    stdin, stdout, stderr = client.exec_command("uname -r")
+    kernel = stdout.read().strip()
 
   if os.path.exists(os.path.join(SOURCE_MOUNT, "lib", "modules", kernel)):
     DisplayCommandEnd("Kernel matches")
@@ -192,7 +1926,16 @@ def VerifyKernelMatches(client):
     return False
 
 
-def MountSourceFilesystems(root_dev, fstab_data=None):
+# Index of the block devices, made by GetBlockDevices when first needed
+_block_devices = None
+_block_devices_lock = threading.Lock()
+
+# Source filesystems mounted by MountSourceFilesystems, by path
+_source_mounts = set()
+_source_mounts_lock = threading.Lock()
+
+
+def MountSourceFilesystems(root_dev, fstab_data=None, check=False):
   """Mounts the filesystems of the source (physical) machine on /source.
 
   Reads /etc/fstab and mounts all of the real filesystems it can, so
@@ -201,54 +1944,194 @@ def MountSourceFilesystems(root_dev, fstab_data=None):
   make sure it's empty (though it really should be, since we're probably
   running off LiveCD/PXE)
 
+  Filesystems are mounted in parallel, each once the one it is mounted on
+  is. What is mounted is recorded for L{UnmountSourceFilesystems}. If they
+  are to be checked, all of them are checked at the same time before any is
+  mounted, the fstab being read from the root filesystem mounted read-only.
+
   @type root_dev: str
   @param root_dev: Name of the device holding the root filesystem of the
     source OS
   @type fstab_data: str
   @param fstab_data: Contents of an fstab file. If specified, will not try to
     read /etc/fstab off of root FS.
+  @type check: bool
+  @param check: Whether to check the filesystems with fsck before mounting
+    them.
   @rtype: (list, list)
   @return: List of (device, mount point) tuples, list of swap partitions
+  @raise P2VError: fsck found errors it could not correct.
 
   """
-
-  DisplayCommandStart("Mounting root filesystem...")
+  root = _ResolveDevice(root_dev) or root_dev
   if not os.path.isdir(SOURCE_MOUNT):
     os.mkdir(SOURCE_MOUNT)
-  errcode = subprocess.call(["mount", root_dev, SOURCE_MOUNT])
+
+  if check:
+    if not fstab_data:
+      # Mounted read-only just to find the other filesystems, as none of them
+      # may be mounted while it is checked
+      if subprocess.call(["mount", "-o", "ro", root, SOURCE_MOUNT]):
+        raise P2VError("Could not mount %s to read its fstab" % root_dev)
+      try:
+        fstab_data = _ReadSourceFstab()
+      finally:
+        if subprocess.call(["umount", SOURCE_MOUNT]):
+          raise P2VError("Could not unmount %s" % SOURCE_MOUNT)
+    fs_devs, swap_devs = ParseFstab(fstab_data)
+    _CheckSourceFilesystems([root] +
+                            [_ResolveDevice(dev) or dev
+                             for dev, mount_point in fs_devs
+                             if mount_point != "/"])
+
+  DisplayCommandStart("Mounting root filesystem...")
+  errcode = subprocess.call(["mount", root, SOURCE_MOUNT])
   if errcode:
     print "Error mounting %s" % root_dev
     sys.exit(1)
+  _RecordSourceMount(SOURCE_MOUNT, True)
   DisplayCommandEnd("done")
 
-  # Now that the root device is mounted, we can read the fstab
-  try:
+  if not check:
+    # Now that the root device is mounted, we can read the fstab
     if not fstab_data:
-      fstab = open(os.path.join(SOURCE_MOUNT, "etc", "fstab"), "r")
-      fstab_data = fstab.read()
+      fstab_data = _ReadSourceFstab()
+    fs_devs, swap_devs = ParseFstab(fstab_data)
+
+  DisplayCommandStart("Mounting filesystems to copy...")
+
+  def _Mount(dev, path):
+    # Resolved here, so that PARTUUID= works with any mount
+    dev = _ResolveDevice(dev) or dev
+    errcode = subprocess.call(["mount", dev, path])
+    if errcode:
+      print "Could not mount %s on %s, continuing..." % (dev, path)
+    else:
+      _RecordSourceMount(path, True)
+
+  others = [(dev, _SourcePath(mount_point)) for dev, mount_point in fs_devs
+            if mount_point != "/"]
+  paths = [path for _, path in others]
+  steps = PhaseScheduler(None, _MOUNT_THREADS)
+  for dev, path in sorted(others, key=lambda fs: _PathDepth(fs[1])):
+    parent = _ParentMount(path, paths)
+    steps.Add(path, _MountStep(_Mount, dev, path), [parent] if parent else [])
+  steps.Wait(paths)
+
+  DisplayCommandEnd("done")
+  return fs_devs, swap_devs
+
+
+def _MountStep(func, *args):
+  """Make a step for L{PhaseScheduler} that ignores the results it gets."""
+  return lambda *_: func(*args)
+
+
+def _ReadSourceFstab():
+  """Read /etc/fstab from the root filesystem mounted on /source.
+
+  @rtype: str
+  @return: The contents of the file.
+  @raise P2VError: The file could not be read.
+
+  """
+  try:
+    fstab = open(os.path.join(SOURCE_MOUNT, "etc", "fstab"), "r")
+    try:
+      return fstab.read()
+    finally:
       fstab.close()
   except IOError, e:
     raise P2VError("Error reading /etc/fstab to find filesystems: %s" % str(e))
 
-  fs_devs, swap_devs = ParseFstab(fstab_data)
 
-  DisplayCommandStart("Mounting filesystems to copy...")
+def _CheckSourceFilesystems(devs):
+  """Check the source filesystems with fsck, all at the same time.
+
+  @type devs: list
+  @param devs: Devices holding the filesystems, none of them mounted.
+  @raise P2VError: fsck found errors it could not correct, or failed.
+
+  """
+  DisplayCommandStart("Checking filesystems...")
+  errors = [error for _, error in _RunInThreads(_CheckSourceFilesystem, devs,
+                                                _MOUNT_THREADS)
+            if error]
+  if errors:
+    raise errors[0]
+  DisplayCommandEnd("done")
 
-  for dev, mount_point in fs_devs:
-    if mount_point == "/":
-      continue
 
-    # Ok, we've decided to actually try mounting this filesystem
-    if mount_point[0] == os.sep:
-      mount_point = SOURCE_MOUNT + mount_point
+def _CheckSourceFilesystem(dev):
+  """Check a source filesystem with fsck, making the repairs that are safe.
+
+  @type dev: str
+  @param dev: Device holding the filesystem, or its UUID= or LABEL= spec.
+  @raise P2VError: fsck found errors it could not correct, or failed.
+
+  """
+  errcode = subprocess.call(["fsck", "-p", dev])
+  # 1 means errors were corrected and 2 that a reboot is advised, which
+  # doesn't apply to a filesystem that isn't mounted
+  if errcode & 4:
+    raise P2VError("fsck found errors on %s that it could not correct (exit"
+                   " status %d). Check it by hand with fsck, then try"
+                   " again." % (dev, errcode))
+  if errcode & 8:
+    # An operational error, such as a missing fsck.vfat on the transfer OS
+    DisplayCommandProgress("fsck could not check %s (exit status %d), so it"
+                           " is copied unchecked" % (dev, errcode))
+  elif errcode & ~3:
+    raise P2VError("fsck failed on %s (exit status %d)" % (dev, errcode))
+
+
+def _RecordSourceMount(path, mounted):
+  """Record that a source filesystem was mounted or unmounted."""
+  _source_mounts_lock.acquire()
+  try:
+    if mounted:
+      _source_mounts.add(path)
     else:
-      mount_point = SOURCE_MOUNT + os.sep + mount_point
-    errcode = subprocess.call(["mount", dev, mount_point])
-    if errcode:
-      print "Could not mount %s on %s, continuing..." % (dev, mount_point)
+      _source_mounts.discard(path)
+  finally:
+    _source_mounts_lock.release()
 
-  DisplayCommandEnd("done")
-  return fs_devs, swap_devs
+
+def _ParentMount(path, paths):
+  """Find the path among paths that path is most directly below.
+
+  @rtype: str
+  @return: The path, or None if path is below none of them.
+
+  """
+  parents = [parent for parent in paths
+             if path.startswith(parent.rstrip("/") + "/")]
+  if not parents:
+    return None
+  return max(parents, key=_PathDepth)
+
+
+def _PathDepth(path):
+  """Number of components in a path."""
+  return len([name for name in path.split("/") if name])
+
+
+def _SourcePath(mount_point):
+  """Get the path under /source where a source filesystem is mounted.
+
+  @type mount_point: str
+  @param mount_point: Mount point of the filesystem on the source machine, as
+    found in its fstab.
+  @rtype: str
+  @return: Path of the mount point on the transfer OS.
+
+  """
+  if mount_point == "/":
+    return SOURCE_MOUNT
+  elif mount_point[0] == os.sep:
+    return SOURCE_MOUNT + mount_point
+  else:
+    return SOURCE_MOUNT + os.sep + mount_point
 
 
 def ShutDownTarget(client):
@@ -265,74 +2148,238 @@ def ShutDownTarget(client):
   DisplayCommandEnd("done")
 
 
-def _RunCommandAndWait(client, command):
+def _RunCommandAndWait(client, command, timeout=None, stream=False):
   """Send an SSH command and wait until it completes.
 
   @type client: paramiko.SSHClient
   @param client: SSH client object used to connect to the instance.
   @type command: str
   @param command: Command to send to the instance.
-  @raises P2VError: remote command returned nonzero exit status
+  @type timeout: float
+  @param timeout: Seconds after which to give up on the command, or None to
+    wait forever.
+  @type stream: bool
+  @param stream: Whether to show the output of the command as it arrives.
+  @rtype: (str, str)
+  @return: Output of the command on stdout and stderr.
+  @raises P2VError: remote command returned nonzero exit status, timed out or
+    was cancelled
+
+  """
+  return _FinishCommand(_StartCommand(client, command), timeout=timeout,
+                        stream=stream)
+
+
+def _StartCommand(client, command):
+  """Send an SSH command without waiting for it to complete.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type command: str
+  @param command: Command to send to the instance.
+  @rtype: (str, paramiko.Channel)
+  @return: The command and the channel it runs on, for L{_FinishCommand}.
 
   """
   stdin, stdout, stderr = client.exec_command(command)
+  return command, stdout.channel
 
-  _WaitForCompletion(stdout.channel)
 
-  if stdout.channel.recv_exit_status() != 0:
+def _FinishCommand(started, timeout=None, stream=False):
+  """Wait for a command sent by L{_StartCommand} to complete.
+
+  @type started: (str, paramiko.Channel)
+  @param started: Return value of L{_StartCommand}.
+  @rtype: (str, str)
+  @return: Output of the command on stdout and stderr.
+  @raises P2VError: remote command returned nonzero exit status, timed out or
+    was cancelled
+
+  """
+  command, channel = started
+  out, err = _WaitForCompletion(channel, timeout=timeout, stream=stream)
+
+  if channel.recv_exit_status() != 0:
     raise P2VError("Remote command returned nonzero exit status: %s\n"
-                   "stdout:\n%s\nstderr:\n%s\n" % (command, stdout.read(),
-                                                   stderr.read()))
+                   "stdout:\n%s\nstderr:\n%s\n" % (command, out, err))
+  return out, err
+
+
+def _RunScript(client, commands):
+  """Run many shell commands on the instance in a single round trip.
+
+  The commands are sent to the standard input of one shell rather than on its
+  command line, so there may be any number of them. The shell stops at the
+  first command that fails.
 
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type commands: list
+  @param commands: Commands to run, in order.
+  @raise P2VError: A command failed.
+
+  """
+  stdin, stdout, stderr = client.exec_command("sh -e")
+  try:
+    stdin.channel.sendall("".join([command + "\n" for command in commands]))
+    stdin.channel.shutdown_write()
+  except (socket.error, EOFError):
+    pass  # The shell stopped reading; its exit status and errors tell why
+  _, err = _WaitForCompletion(stdout.channel)
+  if stdout.channel.recv_exit_status() != 0:
+    raise P2VError("Command failed on the instance: %s" % err.strip())
 
-def _WaitForCompletion(channel):
+
+def _WaitForCompletion(channel, timeout=None, stream=False):
   """Wait for a remote command to complete.
 
   Helper function that sleeps until the last command run by the channel has
-  completed.
+  completed, reading its output as it arrives. The sleep is a select() on the
+  channel, so it ends as soon as there is output, and output is never left to
+  fill up the channel window, which would keep the command from exiting.
+
+  If the wait is interrupted with Ctrl-C or times out, the channel is closed,
+  which ends the remote command.
 
   @type channel: paramiko.Channel
   @param channel: The channel to wait for. If the command was run with
     stdin, stdout, stderr = exec_command(), use stdout.channel.
+  @type timeout: float
+  @param timeout: Seconds after which to give up on the command, or None to
+    wait forever.
+  @type stream: bool
+  @param stream: Whether to show the output of the command as it arrives.
+  @rtype: (str, str)
+  @return: Output of the command on stdout and stderr.
+  @raise P2VError: The command timed out or was cancelled.
 
   """
   start = time.time()
   gave_warning = False
+  out = []
+  err = []
 
-  while not channel.exit_status_ready():
-    time.sleep(.01)
-    if time.time() - start > 60 and not gave_warning:
-      gave_warning = True
-      print ("\nThe current command is taking a while to complete. Please make"
-             " sure the instance is still pingable. If so, try waiting another"
-             " few minutes.")
+  try:
+    while True:
+      # The exit status arrives after all output, so once it is here, the
+      # reads below will collect everything that is left
+      exited = channel.exit_status_ready()
+      while channel.recv_ready():
+        data = channel.recv(_RECV_BYTES)
+        out.append(data)
+        if stream:
+          sys.stdout.write(data)
+      while channel.recv_stderr_ready():
+        data = channel.recv_stderr(_RECV_BYTES)
+        err.append(data)
+        if stream:
+          sys.stderr.write(data)
+      if exited:
+        break
+
+      elapsed = time.time() - start
+      if timeout is not None and elapsed > timeout:
+        channel.close()
+        raise P2VError("Remote command did not complete within %d seconds" %
+                       timeout)
+      if elapsed > 60 and not gave_warning:
+        gave_warning = True
+        print ("\nThe current command is taking a while to complete. Please"
+               " make sure the instance is still pingable. If so, try waiting"
+               " another few minutes.")
+
+      select.select([channel], [], [], _SELECT_INTERVAL)
+  except KeyboardInterrupt:
+    channel.close()
+    raise P2VError("Remote command cancelled")
 
   if gave_warning:
     print "The command has completed."
 
+  return "".join(out), "".join(err)
+
 
 def _GetDeviceFile(dev):
   """Get the device file associated with a block device.
 
-  Accepts input of the form /dev/<device>, UUID=<uuid>, and LABEL=<label>, and
-  returns the /dev/<device> file for the disk.
+  Accepts input of the form /dev/<device>, UUID=<uuid>, LABEL=<label> and
+  PARTUUID=<uuid>, and returns the /dev/<device> file for the disk.
 
   @type dev: str
   @param dev: specification of the block device
 
   """
-  if dev.startswith("UUID=") or dev.startswith("LABEL="):
-    popen = subprocess.Popen(["findfs", dev], stdout=subprocess.PIPE)
-    devname = popen.communicate()[0].strip()
-    if popen.returncode == 0:
-      return devname
-    else:
-      raise P2VError("Swap device %s not found" % dev)
-  else:
-    return dev
+  devname = _ResolveDevice(dev)
+  if not devname:
+    raise P2VError("Device %s not found" % dev)
+  return devname
+
+
+def _ResolveDevice(spec):
+  """Get the device file for a spec, or None if there is no such device.
+
+  The block devices are only scanned if the spec isn't a device file.
+
+  """
+  if spec.startswith("/"):
+    return spec
+  return GetBlockDevices().Resolve(spec)
+
+
+def GetBlockDevices():
+  """Get the index of the block devices of this machine.
+
+  The devices are scanned the first time, and the same index is used
+  afterwards by every step of the transfer.
+
+  @rtype: L{BlockDeviceIndex}
+
+  """
+  global _block_devices
+  _block_devices_lock.acquire()
+  try:
+    if _block_devices is None:
+      _block_devices = ScanBlockDevices()
+    return _block_devices
+  finally:
+    _block_devices_lock.release()
+
+
+def ScanBlockDevices(sys_block="/sys/class/block"):
+  """Find the block devices of this machine, their tags and their sizes.
+
+  Tags come from a single run of blkid, and sizes from sysfs.
+
+  @type sys_block: str
+  @param sys_block: Directory with an entry for each block device.
+  @rtype: L{BlockDeviceIndex}
+
+  """
+  tags = {}
+  popen = subprocess.Popen(["blkid"], stdout=subprocess.PIPE)
+  for line in popen.communicate()[0].splitlines():
+    dev, _, values = line.partition(":")
+    if dev.startswith("/"):
+      tags[dev] = dict(re.findall(r'([A-Z_]+)="([^"]*)"', values))
+
+  sizes = {}
+  try:
+    names = os.listdir(sys_block)
+  except OSError:
+    names = []
+  for name in names:
+    try:
+      size_file = open(os.path.join(sys_block, name, "size"), "r")
+      try:
+        sizes[name] = int(size_file.read().strip()) * 512
+      finally:
+        size_file.close()
+    except (IOError, ValueError):
+      continue
+  return BlockDeviceIndex(tags, sizes)
 
 
-def GetDiskSize(client, swap_devs, target_hd):
+def GetDiskSize(client, swap_devs, target_hd, inventory=None):
   """Determine how much disk is available, how much swap space to include.
 
   For swap size, returns the minimum of:
@@ -345,6 +2392,8 @@ def GetDiskSize(client, swap_devs, target_hd):
   @param swap_devs: List of swap partitions on the source machine.
   @type target_hd: str
   @param target_hd: Device file for the instance hard drive.
+  @type inventory: dict
+  @param inventory: Result of L{GetTargetInventory}, if already known.
   @rtype: (int, int)
   @return: Total size in megabytes, swap size in megabytes
 
@@ -352,23 +2401,22 @@ def GetDiskSize(client, swap_devs, target_hd):
   DisplayCommandStart("Determining partition sizes...")
 
    # Find out how many MB are available on target
-  stdin, stdout, stderr = client.exec_command("blockdev --getsize64 %s" %
-                                              target_hd)
-  for line in stdout:
-    if line.strip():
-      total_megs = int(line.strip()) / (1024 * 1024)
-      break
-  stdout.close()
+  if inventory:
+    total_megs = dict(inventory["disks"])[target_hd] / (1024 * 1024)
+  else:
+    stdin, stdout, stderr = client.exec_command("blockdev --getsize64 %s" %
+                                                target_hd)
+    for line in stdout:
+      if line.strip():
+        total_megs = int(line.strip()) / (1024 * 1024)
+        break
+    stdout.close()
 
   swap_megs = 0
   for dev in swap_devs:
-    dev = _GetDeviceFile(dev)
-    size_output = subprocess.Popen(["blockdev", "--getsize64", dev],
-                                   stdout=subprocess.PIPE).communicate()[0]
-    try:
-      swap_megs += int(size_output.strip()) / (1024 * 1024)
-    except ValueError:
-      pass  # Dev has gone missing, so just ignore it.
+    size = GetBlockDevices().Size(_GetDeviceFile(dev))
+    if size:  # Otherwise dev has gone missing, so just ignore it.
+      swap_megs += size / (1024 * 1024)
 
   if swap_megs == 0:
     raise P2VError("No swap devices found, so swap size could not be"
@@ -381,110 +2429,3090 @@ def GetDiskSize(client, swap_devs, target_hd):
   return total_megs, swap_size
 
 
-def ParseFstab(fstab_data):
-  """Grab the useful information from the fstab.
+def PlanCapacity(fs_devs, total_megs, swap_megs, scan=None):
+  """Check that the source data will fit on the instance before partitioning.
 
-  Parses the fstab, and returns the information it contains, in two objects.
-  One is a dictionary of the information needed to mount the real filesystems
-  on the machine, and the other is a list of the names of the swap partitions.
+  The space and inodes used on the source filesystems are compared to what
+  the root partition will hold. statvfs gives an upper bound quickly; only if
+  that doesn't fit are the files themselves measured, which counts hard
+  linked files once and leaves out filesystem metadata. If the data only fits
+  with less swap, the swap partition is shrunk.
 
-  @type fstab_data: str
-  @param fstab_data: Contents of an fstab file
-  @rtype: (list, list)
-  @return: List of (device, mount point) tuples, list of swap partitions
+  @type fs_devs: list
+  @param fs_devs: List of (device, mount point) tuples, as returned by
+    MountSourceFilesystems.
+  @type total_megs: int
+  @param total_megs: Size of the instance disk in megabytes.
+  @type swap_megs: int
+  @param swap_megs: Planned swap size in megabytes.
+  @param scan: Function returning the measurement of the files, as from
+    L{_ScanUsage}, if it is needed. By default the files are measured here.
+  @rtype: int
+  @return: Swap size in megabytes to use.
+  @raise P2VError: The data doesn't fit on the instance disk.
 
   """
-  accepted_filesystems = ["ext2", "ext3", "ext4"]
-  DisplayCommandStart("Interpreting /etc/fstab...")
+  DisplayCommandStart("Checking that the data fits on the instance...")
+
+  usage = _StatvfsUsage(fs_devs)
+  needed_megs = _PartitionMegsNeeded(usage)
+  if needed_megs > total_megs - swap_megs:
+    DisplayCommandProgress("Measuring source files...")
+    if scan:
+      usage = scan()
+    else:
+      usage = _ScanUsage(fs_devs, _SCAN_THREADS)
+    needed_megs = _PartitionMegsNeeded(usage)
+
+  if needed_megs <= total_megs - swap_megs:
+    DisplayCommandEnd("done, %s and %d inodes to copy" %
+                      (_FormatBytes(sum([u[1] for u in usage])),
+                       sum([u[2] for u in usage])))
+    return swap_megs
+
+  if needed_megs <= total_megs - _MIN_SWAP_MEGS:
+    new_swap_megs = min(swap_megs, total_megs - needed_megs)
+    DisplayCommandEnd("done, swap reduced to %d MB to make room" %
+                      new_swap_megs)
+    return new_swap_megs
+
+  DisplayCommandEnd("failed")
+  lines = ["  %-20s %10s %10s" % ("Filesystem", "Used", "Inodes")]
+  for mount_point, used_bytes, used_inodes in usage:
+    lines.append("  %-20s %10s %10d" % (mount_point, _FormatBytes(used_bytes),
+                                        used_inodes))
+  raise P2VError("The source data does not fit on the instance disk:\n%s\n"
+                 "It needs a root partition of about %d MB, but the %d MB"
+                 " disk leaves at most %d MB after %d MB of swap. Grow the"
+                 " instance disk to at least %d MB, for example with"
+                 " gnt-instance grow-disk, and try again." %
+                 ("\n".join(lines), needed_megs, total_megs,
+                  total_megs - _MIN_SWAP_MEGS, _MIN_SWAP_MEGS,
+                  needed_megs + swap_megs))
+
+
+def _PartitionMegsNeeded(usage):
+  """Size of the root partition needed to hold the source data.
+
+  @type usage: list
+  @param usage: List of (mount point, used bytes, used inodes) tuples.
+  @rtype: int
+  @return: Size in megabytes.
 
-  fs_devs = []
-  swap_devs = []
+  """
+  used_bytes = sum([used for _, used, _ in usage])
+  used_inodes = sum([inodes for _, _, inodes in usage])
+  for_space = used_bytes / (1 - _TARGET_FS_OVERHEAD)
+  for_inodes = used_inodes * _TARGET_BYTES_PER_INODE
+  return int(max(for_space, for_inodes) / (1024 * 1024)) + 1
 
-  for line in fstab_data.splitlines():
-    if not line or line[0] == "#":
-      continue
-    words = line.split()
-    if len(words) != 6:
-      continue  # wrong format
 
-    if words[2] in accepted_filesystems:
+def _StatvfsUsage(fs_devs):
+  """Measure the space and inodes used on each mounted source filesystem.
+
+  @rtype: list
+  @return: List of (mount point, used bytes, used inodes) tuples.
+
+  """
+  usage = []
+  for _, mount_point in fs_devs:
+    src = _SourcePath(mount_point)
+    if src != SOURCE_MOUNT and not os.path.ismount(src):
+      continue
+    stats = os.statvfs(src)
+    usage.append((mount_point,
+                  (stats.f_blocks - stats.f_bfree) * stats.f_frsize,
+                  stats.f_files - stats.f_ffree))
+  return usage
+
+
+def _ScanUsage(fs_devs, max_threads, index_dir=None):
+  """Measure the space and inodes used by the files on each source filesystem.
+
+  @type max_threads: int
+  @param max_threads: Maximum number of directories to walk at once.
+  @type index_dir: str
+  @param index_dir: Directory to keep the index in, as for L{ScanSource}.
+  @rtype: list
+  @return: List of (mount point, used bytes, used inodes) tuples, as from
+    L{SourceIndex.Usage}.
+
+  """
+  index = ScanSource(fs_devs, max_threads, index_dir)
+  try:
+    return index.Usage()
+  finally:
+    index.Close()
+
+
+def ScanSource(fs_devs, max_threads=_SCAN_THREADS, index_dir=None):
+  """List the files on the source filesystems in an index.
+
+  The top level of each filesystem is listed here, and each directory there
+  walked by a thread of its own. Each file is looked at with a single lstat,
+  and the records of a directory are written together. Each filesystem is
+  listed separately, like rsync -x lists it.
+
+  @type fs_devs: list
+  @param fs_devs: List of (device, mount point) tuples, as returned by
+    MountSourceFilesystems.
+  @type max_threads: int
+  @param max_threads: Maximum number of directories to walk at once.
+  @type index_dir: str
+  @param index_dir: Directory to keep the index in, created if needed. The
+    index of a large machine doesn't fit in memory, so on the transfer OS
+    this must be on a disk rather than in /tmp. By default the system's
+    temporary directory is used.
+  @rtype: L{SourceIndex}
+  @return: The index. Call its Close method once it is no longer needed.
+  @raise P2VError: A directory couldn't be walked.
+
+  """
+  def _Walk(item):
+    part, prefix, src, root_dev, top = item
+    try:
+      stack = [top]
+      while stack:
+        dirpath = stack.pop()
+        try:
+          names = os.listdir(dirpath)
+        except OSError:
+          continue  # Removed or unreadable, so rsync won't copy it either
+        records = []
+        for name in names:
+          path = os.path.join(dirpath, name)
+          try:
+            stats = os.lstat(path)
+          except OSError:
+            continue
+          if stats.st_dev != root_dev:
+            continue  # Another filesystem, listed on its own
+          records.append(index.Record(prefix + path[len(src):], stats))
+          if stat.S_ISDIR(stats.st_mode):
+            stack.append(path)
+        part.write("".join(records))
+    finally:
+      part.close()
+
+  if index_dir and not os.path.isdir(index_dir):
+    os.makedirs(index_dir)
+  index = SourceIndex(tempfile.mkdtemp(prefix="p2v-index-", dir=index_dir))
+  items = []
+  try:
+    for _, mount_point in fs_devs:
+      src = _SourcePath(mount_point)
+      if src != SOURCE_MOUNT and not os.path.ismount(src):
+        continue
+      root_dev = os.lstat(src).st_dev
+      prefix = ("/" + mount_point.strip("/")).rstrip("/")
+      index.mount_points.append(mount_point)
+      top = index.AddPart(mount_point)
+      try:
+        for name in sorted(os.listdir(src)):
+          path = os.path.join(src, name)
+          try:
+            stats = os.lstat(path)
+          except OSError:
+            continue
+          if stats.st_dev != root_dev:
+            continue
+          top.write(index.Record("%s/%s" % (prefix, name), stats))
+          if stat.S_ISDIR(stats.st_mode):
+            items.append((index.AddPart(mount_point), prefix, src, root_dev,
+                          path))
+      finally:
+        top.close()
+
+    for item, error in _RunInThreads(_Walk, items, max_threads):
+      if error:
+        raise P2VError("Could not walk %s: %s" % (item[4], error))
+  except:
+    for item in items:
+      item[0].close()  # Those of the walks that were never started
+    index.Close()
+    raise
+  return index
+
+
+def FindExcludedFiles(index, rules, include_root=True):
+  """Find the files on the source filesystems that exclusion rules leave out.
+
+  The contents of an excluded directory are not listed on their own, but
+  added to its size.
+
+  @type index: L{SourceIndex}
+  @param index: The files on the source filesystems.
+  @type rules: L{ExclusionRules}
+  @param rules: The rules to apply.
+  @type include_root: bool
+  @param include_root: Whether to apply the rules to the root filesystem. If
+    not, as when it is copied block by block, its files are never excluded.
+  @rtype: list
+  @return: Sorted list of (path, rule, bytes) tuples, with the path from the
+    root of the source machine, the rule excluding it, and the size of the
+    file or of the files under the directory.
+
+  """
+  DisplayCommandStart("Finding excluded files...")
+  found = []
+  # Position in found of each excluded directory, by mount point and path
+  excluded_dirs = {}
+  for entry in index.Entries():
+    if not include_root and entry.mount_point == "/":
+      continue
+    if stat.S_ISREG(entry.st_mode):
+      nbytes = entry.st_size
+    else:
+      nbytes = 0
+    parent = None
+    if excluded_dirs:
+      for path in _ParentDirs(entry.path):
+        parent = excluded_dirs.get((entry.mount_point, path))
+        if parent is not None:
+          break
+    if parent is not None:
+      path, rule, total = found[parent]
+      found[parent] = (path, rule, total + nbytes)
+      continue
+    rule = rules.Match(entry.path, entry, entry.mount_point)
+    if not rule:
+      continue
+    if stat.S_ISDIR(entry.st_mode):
+      excluded_dirs[(entry.mount_point, entry.path)] = len(found)
+    found.append((entry.path, rule, nbytes))
+
+  DisplayCommandEnd("%d files, %s" % (len(found), _FormatBytes(
+    sum([nbytes for _, _, nbytes in found]))))
+  return sorted(found)
+
+
+def _ParentDirs(path):
+  """List the directories above a path, innermost first, leaving out "/"."""
+  parents = []
+  path = os.path.dirname(path)
+  while len(path) > 1:
+    parents.append(path)
+    path = os.path.dirname(path)
+  return parents
+
+
+def ReportExclusions(excluded, largest=10):
+  """Show how much data the exclusion rules leave out.
+
+  @type excluded: list
+  @param excluded: Result of L{FindExcludedFiles}.
+  @type largest: int
+  @param largest: Number of the largest excluded files to list.
+
+  """
+  totals = {}
+  for _, rule, nbytes in excluded:
+    count, total = totals.get(rule, (0, 0))
+    totals[rule] = (count + 1, total + nbytes)
+
+  print "Left out by each exclusion rule:"
+  for rule in sorted(totals, key=lambda rule: -totals[rule][1]):
+    count, total = totals[rule]
+    print "  %-40s %8d files %10s" % (rule, count, _FormatBytes(total))
+  if excluded:
+    print "Largest:"
+    for path, _, nbytes in sorted(excluded, key=lambda entry: -entry[2])[
+        :largest]:
+      print "  %10s  %s" % (_FormatBytes(nbytes), path)
+  print "Total: %d files, %s" % (len(excluded), _FormatBytes(
+    sum([nbytes for _, _, nbytes in excluded])))
+
+
+def PlanLayout(fs_devs, total_megs, swap_megs, inventory=None):
+  """Plan partitions for the instance that mirror the source filesystems.
+
+  Each mounted source filesystem gets a partition of the same type, with the
+  space that isn't used for swap divided in proportion to the sizes of the
+  source filesystems. Partitions that would then be too small for their data
+  are given just enough, and the rest is divided between the others.
+
+  The root filesystem is on partition 1 and swap on partition 2, as with a
+  single partition. The first other filesystem is on partition 3, and the
+  rest are logical partitions from 5 on.
+
+  @type fs_devs: list
+  @param fs_devs: List of (device, mount point) tuples, as returned by
+    MountSourceFilesystems.
+  @type total_megs: int
+  @param total_megs: Size of the instance disk in megabytes.
+  @type swap_megs: int
+  @param swap_megs: Swap size in megabytes.
+  @type inventory: dict
+  @param inventory: Result of L{GetTargetInventory}. Filesystems whose mkfs is
+    missing on the instance are made ext3 instead.
+  @rtype: list
+  @return: List of (partition number, mount point, filesystem type, size in
+    megabytes) tuples, root first.
+  @raise P2VError: The data doesn't fit on the instance disk.
+
+  """
+  DisplayCommandStart("Planning partitions...")
+
+  fs_types = _MountedFilesystemTypes()
+  filesystems = []
+  for _, mount_point in fs_devs:
+    src = _SourcePath(mount_point)
+    if src != SOURCE_MOUNT and not os.path.ismount(src):
+      continue  # Copied along with its parent
+    stats = os.statvfs(src)
+    fs_type = fs_types.get(src, "ext3")
+    if inventory and "mkfs.%s" % fs_type not in inventory["tools"]:
+      fs_type = "ext3"
+    usage = [(mount_point, (stats.f_blocks - stats.f_bfree) * stats.f_frsize,
+              stats.f_files - stats.f_ffree)]
+    filesystems.append((mount_point, fs_type,
+                        stats.f_blocks * stats.f_frsize,
+                        _PartitionMegsNeeded(usage)))
+  filesystems.sort(key=lambda fs: fs[0] != "/")
+
+  numbers = [1]
+  if len(filesystems) > 1:
+    numbers.append(3)
+  numbers.extend(range(5, len(filesystems) + 3))
+  available = (total_megs - swap_megs -
+               _LOGICAL_PARTITION_SLACK_MEGS * max(len(filesystems) - 2, 0))
+
+  needed = sum([fs[3] for fs in filesystems])
+  if needed > available:
+    DisplayCommandEnd("failed")
+    lines = ["  %-20s %10s" % ("Filesystem", "Needs")]
+    for mount_point, _, _, needed_megs in filesystems:
+      lines.append("  %-20s %7d MB" % (mount_point, needed_megs))
+    raise P2VError("The source filesystems do not fit on the instance"
+                   " disk:\n%s\nTogether they need %d MB, but only %d MB is"
+                   " left after %d MB of swap. Grow the instance disk to at"
+                   " least %d MB, or use --layout=single." %
+                   ("\n".join(lines), needed, available, swap_megs,
+                    total_megs + needed - available))
+
+  # Give partitions that would be too small what they need, until the
+  # others can all be sized in proportion
+  sizes = {}
+  remaining = list(filesystems)
+  space = available
+  while remaining:
+    source_total = sum([fs[2] for fs in remaining]) or 1
+    too_small = [fs for fs in remaining
+                 if space * fs[2] / source_total < fs[3]]
+    if not too_small:
+      break
+    for fs in too_small:
+      sizes[fs[0]] = fs[3]
+      space -= fs[3]
+      remaining.remove(fs)
+  for fs in remaining:
+    sizes[fs[0]] = space * fs[2] / source_total
+
+  layout = [(number, mount_point, fs_type, sizes[mount_point])
+            for number, (mount_point, fs_type, _, _) in zip(numbers,
+                                                            filesystems)]
+  DisplayCommandEnd(", ".join(["%s %s %d MB" % (mount_point, fs_type, megs)
+                               for _, mount_point, fs_type, megs in layout]))
+  return layout
+
+
+def _MountedFilesystemTypes():
+  """Get the types of the filesystems mounted on the transfer OS.
+
+  @rtype: dict
+  @return: Filesystem types by mount point.
+
+  """
+  fs_types = {}
+  try:
+    mounts = open("/proc/mounts", "r")
+    try:
+      for line in mounts:
+        words = line.split()
+        if len(words) >= 3:
+          fs_types[words[1]] = words[2]
+    finally:
+      mounts.close()
+  except IOError:
+    pass
+  return fs_types
+
+
+def ParseFstab(fstab_data):
+  """Grab the useful information from the fstab.
+
+  Parses the fstab, and returns the information it contains, in two objects.
+  One is a dictionary of the information needed to mount the real filesystems
+  on the machine, and the other is a list of the names of the swap partitions.
+
+  @type fstab_data: str
+  @param fstab_data: Contents of an fstab file
+  @rtype: (list, list)
+  @return: List of (device, mount point) tuples, list of swap partitions
+
+  """
+  accepted_filesystems = ["ext2", "ext3", "ext4"]
+  DisplayCommandStart("Interpreting /etc/fstab...")
+
+  fs_devs = []
+  swap_devs = []
+
+  for line in fstab_data.splitlines():
+    if not line or line[0] == "#":
+      continue
+    words = line.split()
+    if len(words) != 6:
+      continue  # wrong format
+
+    if words[2] in accepted_filesystems:
       fs_devs.append((words[0], words[1]))
     if words[2] == "swap":
       swap_devs.append(words[0])
 
-  fslist = ", ".join([ item[0] for item in fs_devs ])
-  swaplist = ", ".join(swap_devs)
-  DisplayCommandEnd("Found filesystems on %s; swap on %s" % (fslist, swaplist))
-  return fs_devs, swap_devs
+  fslist = ", ".join([ item[0] for item in fs_devs ])
+  swaplist = ", ".join(swap_devs)
+  DisplayCommandEnd("Found filesystems on %s; swap on %s" % (fslist, swaplist))
+  return fs_devs, swap_devs
+
+
+def PartitionTargetDisks(client, total_megs, swap_megs, target_hd,
+                         make_fs=True, layout=None, wait=True,
+                         lazy_init=False):
+  """Partition and format the disks on the target machine.
+
+  Sends commands over the SSH connection to partition and format the
+  disk of the target instance. By default, a single ext3 root partition is
+  made, followed by swap. With a layout from L{PlanLayout}, each filesystem
+  gets its own partition, and they are all mounted below /target.
+
+  All partitions are formatted at the same time, with the zeroing of inode
+  tables and journals left for later where the filesystem type allows it.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type total_megs: int
+  @param total_megs: Total size of disk, in megabytes
+  @type swap_megs: int
+  @param swap_megs: Desired size of swap space, in megabytes
+  @type target_hd: str
+  @param target_hd: Device file for the instance hard drive.
+  @type make_fs: bool
+  @param make_fs: Whether to create and mount a filesystem on the root
+    partition. Not needed if the filesystem will be copied block by block.
+  @type layout: list
+  @param layout: List of (partition number, mount point, filesystem type,
+    size in megabytes) tuples, or None for a single partition.
+  @type wait: bool
+  @param wait: Whether to wait for the partitions to be formatted and
+    mounted. If not, only the partitioning is waited for.
+  @type lazy_init: bool
+  @param lazy_init: Whether mke2fs on the instance supports leaving the
+    zeroing of inode tables and journals for later.
+  @rtype: (str, paramiko.Channel)
+  @return: If not waiting, the running format command, to be passed to
+    L{WaitForFormatting}.
+
+  """
+  DisplayCommandStart("Partitioning disks...")
+
+  if layout:
+    sfdisk_command = "sfdisk -uM %s <<EOF\n%sEOF\n" % (
+      target_hd, _SfdiskLayout(layout, swap_megs))
+    other_commands = (
+      [_FormatCommand(target_hd, [(number, fs_type)
+                                  for number, _, fs_type, _ in layout],
+                      lazy_init)] +
+      _MountLayoutCommands(target_hd, layout))
+  else:
+    nonswap_megs = total_megs - swap_megs
+    sfdisk_command = """sfdisk -uM %s <<EOF
+0,%d,83
+,,82
+EOF
+""" % (target_hd, nonswap_megs)
+    if make_fs:
+      other_commands = [
+        _FormatCommand(target_hd, [(1, "ext3")], lazy_init),
+        "mkdir -p %s" % TARGET_MOUNT,
+        "mount %s1 %s" % (target_hd, TARGET_MOUNT),
+        ]
+    else:
+      other_commands = [_FormatCommand(target_hd, [])]
+
+  try:
+    _RunCommandAndWait(client, sfdisk_command)
+    if wait:
+      _RunCommandAndWait(client, " && ".join(other_commands))
+  except P2VError, e:
+    print e
+    print "Retrying..."
+    # Make sure target is unmounted, then try again
+    CleanUpTarget(client)
+    _RunCommandAndWait(client, sfdisk_command)
+    if wait:
+      _RunCommandAndWait(client, " && ".join(other_commands))
+
+  if not wait:
+    DisplayCommandEnd("done, formatting in the background")
+    return _StartCommand(client, " && ".join(other_commands))
+  DisplayCommandEnd("done")
+
+
+def WaitForFormatting(formatting):
+  """Wait for the partitions of the instance to be formatted and mounted.
+
+  @type formatting: (str, paramiko.Channel)
+  @param formatting: Return value of L{PartitionTargetDisks} when not
+    waiting.
+
+  """
+  DisplayCommandStart("Waiting for the instance disk to be formatted...")
+  try:
+    _FinishCommand(formatting)
+  except P2VError:
+    DisplayCommandEnd("failed")
+    raise
+  DisplayCommandEnd("done")
+
+
+def _FormatCommand(target_hd, filesystems, lazy_init=False):
+  """Build the command that formats the partitions of the instance disk.
+
+  Swap and every filesystem are made at the same time, and the command fails
+  if any of them does.
+
+  @type target_hd: str
+  @param target_hd: Device file for the instance hard drive.
+  @type filesystems: list
+  @param filesystems: List of (partition number, filesystem type) tuples.
+  @type lazy_init: bool
+  @param lazy_init: Whether to leave zeroing for later, where the filesystem
+    type allows it.
+  @rtype: str
+  @return: The command.
+
+  """
+  jobs = [_MkfsCommand(fs_type, "%s%d" % (target_hd, number), lazy_init)
+          for number, fs_type in filesystems]
+  jobs.append("mkswap %s2" % target_hd)
+  if len(jobs) == 1:
+    return jobs[0]
+
+  commands = []
+  pids = []
+  for index, job in enumerate(jobs):
+    commands.append("{ %s; } & p%d=$!" % (job, index))
+    pids.append("$p%d" % index)
+  commands.append("failed=0")
+  commands.append("for pid in %s; do wait $pid || failed=1; done" %
+                  " ".join(pids))
+  return "{ %s; test $failed = 0; }" % "; ".join(commands)
+
+
+def _MkfsCommand(fs_type, device, lazy_init=False):
+  """Build the command that makes a filesystem, lazily if asked to.
+
+  Whether mke2fs knows the lazy options is found out by
+  L{GetTargetInventory}, as older versions refuse them.
+
+  """
+  options = _LAZY_INIT_OPTIONS.get(fs_type)
+  if not lazy_init or not options:
+    return "mkfs.%s -q %s" % (fs_type, device)
+  return "mkfs.%s -q -E %s %s" % (fs_type, options, device)
+
+
+def _SfdiskLayout(layout, swap_megs):
+  """Build the sfdisk input for a layout from L{PlanLayout}.
+
+  The last partition is given the rest of the disk, so that rounding by
+  sfdisk doesn't make the partitions overflow it.
+
+  """
+  def _Line(fs_id, megs, last):
+    if last:
+      return ",,%s\n" % fs_id
+    return ",%d,%s\n" % (megs, fs_id)
+
+  lines = ["0,%d,83\n" % layout[0][3]]
+  lines.append(_Line("82", swap_megs, len(layout) == 1))
+  for index, (number, _, _, megs) in enumerate(layout[1:]):
+    if number == 5:
+      lines.append(",,E\n")
+    lines.append(_Line("83", megs, index == len(layout) - 2))
+  return "".join(lines)
+
+
+def _MountLayoutCommands(target_hd, layout):
+  """Build the commands that mount the partitions of a layout below /target.
+
+  Filesystems are mounted in order of their mount points, so that each one is
+  mounted after the one it is below.
+
+  """
+  commands = []
+  for number, mount_point, _, _ in sorted(layout, key=lambda part: part[1]):
+    path = TARGET_MOUNT + mount_point.rstrip("/")
+    commands.extend(["mkdir -p %s" % path,
+                     "mount %s%d %s" % (target_hd, number, path)])
+  return commands
+
+
+def ChooseCompression(client, compression, inventory=None):
+  """Determine the rsync options to use for compression.
+
+  For a fixed choice, the options are returned once rsync on both ends is
+  known to support the codec. For 'auto', the compression codecs supported
+  by rsync on both ends are timed on a sample of the source data, the
+  throughput of the link to the instance is measured, and the codec and level
+  giving the highest effective throughput are chosen.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type compression: str
+  @param compression: One of COMPRESSION_CHOICES.
+  @type inventory: dict
+  @param inventory: Result of L{GetTargetInventory}, if already known.
+  @rtype: list
+  @return: List of rsync arguments selecting the compression.
+  @raise P2VError: rsync on one of the ends doesn't support the chosen codec.
+
+  """
+  if compression == "none":
+    return []
+
+  local_codecs = _GetRsyncCompressors(
+    subprocess.Popen(["rsync", "--version"],
+                     stdout=subprocess.PIPE).communicate()[0])
+  if inventory:
+    remote_codecs = inventory["rsync_compressors"]
+  else:
+    stdin, stdout, stderr = client.exec_command("rsync --version")
+    remote_codecs = _GetRsyncCompressors(stdout.read())
+  # Such rsyncs negotiate a codec unless told which one to use
+  negotiated = local_codecs != ["zlib"] and remote_codecs != ["zlib"]
+
+  if compression != "auto":
+    for codecs, where in [(local_codecs, "this machine"),
+                          (remote_codecs, "the instance")]:
+      if compression not in codecs:
+        raise P2VError("rsync on %s does not support %s compression" %
+                       (where, compression))
+    return _CompressionArgs(compression, None, negotiated)
+
+  DisplayCommandStart("Calibrating compression...")
+
+  sample = _SampleSourceData(_SAMPLE_BYTES)
+  link_rate = _MeasureLinkThroughput(client, _LINK_TEST_BYTES)
+
+  best = ("none", None, link_rate)
+  results = ["link %.1f MB/s" % (link_rate / 1048576.0)]
+  for codec, level in _COMPRESSION_CANDIDATES:
+    if codec not in local_codecs or codec not in remote_codecs:
+      continue
+    measured = _MeasureCompression(codec, level, sample)
+    if not measured:
+      continue
+    ratio, rate = measured
+    # Compression and sending happen at the same time, so the slower of the
+    # two limits the transfer
+    effective = min(rate, link_rate / max(ratio, 0.01))
+    results.append("%s-%d %.1f MB/s" % (codec, level, effective / 1048576.0))
+    if effective > best[2]:
+      best = (codec, level, effective)
+
+  codec, level, _ = best
+  if level is None:
+    results.append("using no compression")
+  else:
+    results.append("using %s level %d" % (codec, level))
+  DisplayCommandEnd("; ".join(results))
+  return _CompressionArgs(codec, level, negotiated)
+
+
+def _CompressionArgs(codec, level, negotiated=False):
+  """Build the rsync arguments for a compression codec and level.
+
+  @type codec: str
+  @param codec: Name of the codec, or "none".
+  @type level: int
+  @param level: Compression level, or None for rsync's default.
+  @type negotiated: bool
+  @param negotiated: Whether rsync on both ends lists its codecs, and so
+    would pick one itself unless zlib is asked for by name.
+  @rtype: list
+  @return: List of rsync arguments.
+
+  """
+  if codec == "none":
+    return []
+  args = ["-z"]
+  if codec != "zlib" or negotiated:
+    args.append("--compress-choice=%s" % codec)
+  if level is not None:
+    args.append("--compress-level=%d" % level)
+  return args
+
+
+def _GetRsyncCompressors(version_output):
+  """Find the compression codecs supported by an rsync binary.
+
+  rsync 3.2 and later list their codecs in the output of --version. Older
+  versions only support zlib.
+
+  @type version_output: str
+  @param version_output: Output of rsync --version.
+  @rtype: list
+  @return: List of codec names.
+
+  """
+  lines = version_output.splitlines()
+  for idx, line in enumerate(lines):
+    if line.strip().startswith("Compress list:"):
+      if idx + 1 < len(lines):
+        return lines[idx + 1].split()
+  return ["zlib"]
+
+
+def _SampleSourceData(max_bytes):
+  """Read a sample of the data under /source.
+
+  Reads the beginning of files from each top-level directory in turn, so
+  that the sample is not dominated by whichever directory is walked first.
+
+  @type max_bytes: int
+  @param max_bytes: Maximum size of the sample.
+  @rtype: str
+  @return: The sampled data.
+
+  """
+  chunks = []
+  total = 0
+  for name in sorted(os.listdir(SOURCE_MOUNT)):
+    nfiles = 0
+    for dirpath, dirnames, filenames in os.walk(os.path.join(SOURCE_MOUNT,
+                                                             name)):
+      for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        if not os.path.isfile(path) or os.path.islink(path):
+          continue
+        try:
+          sample_file = open(path, "rb")
+          try:
+            data = sample_file.read(_SAMPLE_CHUNK_BYTES)
+          finally:
+            sample_file.close()
+        except IOError:
+          continue
+        chunks.append(data)
+        total += len(data)
+        nfiles += 1
+        if total >= max_bytes:
+          return "".join(chunks)
+        if nfiles >= _SAMPLE_FILES_PER_DIR:
+          break
+      if nfiles >= _SAMPLE_FILES_PER_DIR:
+        break
+  return "".join(chunks)
+
+
+def _MeasureLinkThroughput(client, nbytes):
+  """Measure how fast data can be sent to the instance.
+
+  Sends incompressible data to the instance over a new channel of the SSH
+  connection and times how long it takes to arrive.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type nbytes: int
+  @param nbytes: Amount of data to send.
+  @rtype: float
+  @return: Throughput, in bytes per second.
+
+  """
+  data = os.urandom(nbytes)
+  stdin, stdout, stderr = client.exec_command("cat > /dev/null")
+  start = time.time()
+  stdin.write(data)
+  stdin.flush()
+  stdin.channel.shutdown_write()
+  stdout.channel.recv_exit_status()
+  return nbytes / max(time.time() - start, 0.001)
+
+
+def _MeasureCompression(codec, level, data):
+  """Measure the compression ratio and speed of a codec on some data.
+
+  zlib is measured in-process. zstd and lz4 are measured with their command
+  line tools, if these are installed.
+
+  @type codec: str
+  @param codec: Name of the codec.
+  @type level: int
+  @param level: Compression level.
+  @type data: str
+  @param data: Sample data to compress.
+  @rtype: tuple
+  @return: (compressed size / original size, input bytes per second), or None
+    if the codec could not be measured.
+
+  """
+  if not data:
+    return None
+
+  start = time.time()
+  if codec == "zlib":
+    compressed_len = len(zlib.compress(data, level))
+  else:
+    try:
+      proc = subprocess.Popen([codec, "-q", "-c", "-%d" % level],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except OSError:
+      return None  # tool not installed
+    output = proc.communicate(data)[0]
+    if proc.returncode:
+      return None
+    compressed_len = len(output)
+  elapsed = max(time.time() - start, 0.001)
+
+  return float(compressed_len) / len(data), len(data) / elapsed
+
+
+def TransferFiles(user, host, keyfile, fs_devs=None, parallel=1,
+                  split_dirs=False, rsync_args=None, include_root=True,
+                  journal=None, limiter=None, progress=None, excluded=None,
+                  index=None):
+  """Transfer files to the bootstrap OS.
+
+  Runs rsync to copy all files from the source filesystem to the target
+  filesystem. Holes in sparse files, and runs of zeros, are recreated as
+  holes on the target, so that they don't take up space there. If parallel
+  is greater than one, the copy is split into one rsync job per mounted
+  source filesystem (and optionally per top-level directory), and up to
+  parallel of these jobs are run at the same time.
+
+  @type user: str
+  @param user: Username to use for connection.
+  @type host: str
+  @param host: Hostname of instance to connect to.
+  @type keyfile: str
+  @param keyfile: Filename of the private key to authenticate with.
+  @type fs_devs: list
+  @param fs_devs: List of (device, mount point) tuples, as returned by
+    MountSourceFilesystems.
+  @type parallel: int
+  @param parallel: Maximum number of rsync processes to run at once.
+  @type split_dirs: bool
+  @param split_dirs: Whether to also split filesystems by top-level directory.
+  @type rsync_args: list
+  @param rsync_args: Additional rsync arguments, such as those selecting the
+    compression returned by ChooseCompression. Defaults to rsync's standard
+    compression.
+  @type include_root: bool
+  @param include_root: Whether to copy the root filesystem. If not, only the
+    other filesystems in fs_devs are copied.
+  @type journal: L{CheckpointJournal}
+  @param journal: If given, jobs recorded in it as done are skipped, and
+    completed jobs are added to it. Partially transferred files are kept, so
+    that rsync can pick up where it left off. If the journal records a warm
+    copy made with --warm, files that have since been deleted from the source
+    are deleted from the target as well.
+  @type limiter: L{BandwidthLimiter}
+  @param limiter: If given, each rsync process is limited to an equal share of
+    the bandwidth limit in force when it starts.
+  @type progress: L{ProgressReporter}
+  @param progress: If given along with index, the size of the holes in the
+    copied files is added to it, as counted by L{_CountHoles}.
+  @type excluded: list
+  @param excluded: Paths, from the root of the source machine, of files to
+    leave out, as found by L{FindExcludedFiles}.
+  @type index: L{SourceIndex}
+  @param index: The files on the source filesystems, if they were indexed.
+
+  """
+  def _LimitArgs():
+    return _RsyncLimitArgs(limiter, parallel)
+
+  if rsync_args is None:
+    rsync_args = ["-z"]
+  if fs_devs is None:
+    fs_devs = [("", "/")]
+  if not include_root:
+    fs_devs = [dev for dev in fs_devs if dev[1] != "/"]
+  if journal:
+    if journal.IsDone("files"):
+      return
+    rsync_args = rsync_args + ["--partial"]
+    if journal.IsDone("warm"):
+      rsync_args.append("--delete")
+
+  if parallel == 1 and include_root:
+    DisplayCommandStart("Transferring files. This will take a while...")
+
+    exclude_args, exclude_file = _RsyncExcludeArgs(SOURCE_MOUNT, excluded)
+    try:
+      errcode = subprocess.call(["rsync", "-aHAXS"] + rsync_args +
+                                _LimitArgs() + exclude_args +
+                                ["-e", "ssh -i %s" % keyfile,
+                                 "%s/" % SOURCE_MOUNT,
+                                 "%s@%s:%s" % (user, host, TARGET_MOUNT)])
+    finally:
+      if exclude_file:
+        exclude_file.close()
+    if errcode:
+      print "Error using rsync to transfer files"
+      sys.exit(1)
+    if journal:
+      journal.MarkDone("files")
+    if progress and index:
+      progress.AddSparseBytes(_CountHoles(index, fs_devs, excluded))
+
+    DisplayCommandEnd("done")
+    return
+
+  jobs = _GetTransferJobs(fs_devs, split_dirs)
+  if journal:
+    jobs = [job for job in jobs if not journal.IsDone("files %s" % job[1])]
+  if not jobs:
+    return
+  commands = []
+  job_dests = {}
+  exclude_files = []
+  for src, dest, excludes in jobs:
+    exclude_args, exclude_file = _RsyncExcludeArgs(src, excluded)
+    if exclude_file:
+      exclude_files.append(exclude_file)
+    command = (["rsync", "-aHAXS"] + rsync_args + exclude_args +
+               ["-x", "-e", "ssh -i %s" % keyfile,
+                "--rsync-path=mkdir -p %s && rsync" % dest] +
+               ["--exclude=/%s/" % name for name in excludes] +
+               ["%s/" % src, "%s@%s:%s" % (user, host, dest)])
+    commands.append(command)
+    job_dests[tuple(command)] = dest
+
+  def _JobDone(command, errcode):
+    if journal and not errcode:
+      journal.MarkDone("files %s" % job_dests[tuple(command)])
+
+  DisplayCommandStart("Transferring files in %d jobs, %d at a time. This will"
+                      " take a while..." % (len(jobs), parallel))
+
+  failed = []
+  try:
+    for command, errcode in _RunCommandsInParallel(commands, parallel,
+                                                   done_callback=_JobDone,
+                                                   args_callback=_LimitArgs):
+      if errcode:
+        failed.append(command[-1])
+  finally:
+    for exclude_file in exclude_files:
+      exclude_file.close()
+
+  if failed:
+    print "\nError using rsync to transfer files to %s" % ", ".join(failed)
+    sys.exit(1)
+  if progress and index:
+    progress.AddSparseBytes(_CountHoles(index, fs_devs, excluded))
+
+  DisplayCommandEnd("done")
+
+
+def _RsyncLimitArgs(limiter, parallel=1):
+  """Build the rsync arguments for a share of the bandwidth limit.
+
+  @type limiter: L{BandwidthLimiter}
+  @param limiter: The limit, or None for no limit.
+  @type parallel: int
+  @param parallel: Number of rsync processes sharing the limit.
+  @rtype: list
+  @return: List of rsync arguments.
+
+  """
+  if not limiter or not limiter.CurrentRate():
+    return []
+  return ["--bwlimit=%d" % max(limiter.CurrentRate() / parallel, 1)]
+
+
+def _RsyncExcludeArgs(src, excluded):
+  """Build the rsync arguments that leave out the excluded files under src.
+
+  @type src: str
+  @param src: Source directory of the rsync command.
+  @type excluded: list
+  @param excluded: Paths, from the root of the source machine, of files to
+    leave out, or None.
+  @rtype: (list, file)
+  @return: The arguments, and the temporary file they refer to, which must
+    be closed once rsync is done, or None.
+
+  """
+  prefix = src[len(SOURCE_MOUNT):]
+  patterns = []
+  for path in excluded or []:
+    if not path.startswith(prefix + "/"):
+      continue
+    pattern = path[len(prefix):]
+    # rsync only takes backslashes as escapes in patterns with wildcards
+    if re.search(r"[*?[]", pattern):
+      pattern = re.sub(r"([*?[\\])", r"\\\1", pattern)
+    patterns.append(pattern)
+  if not patterns:
+    return [], None
+
+  exclude_file = tempfile.NamedTemporaryFile()
+  exclude_file.write("\0".join(patterns))
+  exclude_file.flush()
+  return ["--from0", "--exclude-from=%s" % exclude_file.name], exclude_file
+
+
+def _CountHoles(index, fs_devs, excluded=None):
+  """Add up the size of the holes in the files rsync copies.
+
+  This is the apparent size of the files less the space allocated to them,
+  with hard-linked files counted once, as listed in the index; nothing is
+  read from the disk. rsync -S also turns runs of zeros in files without
+  holes into holes, and those aren't counted, so it may save more.
+
+  @type index: L{SourceIndex}
+  @param index: The files on the source filesystems.
+  @type fs_devs: list
+  @param fs_devs: List of (device, mount point) tuples of the filesystems
+    copied.
+  @type excluded: list
+  @param excluded: Paths, from the root of the source machine, of files
+    left out of the copy.
+  @rtype: int
+  @return: Bytes of the files that aren't stored on disk.
+
+  """
+  mount_points = set([mount_point for _, mount_point in fs_devs])
+  skip_paths = set(excluded or [])
+  linked = set()
+  holes = 0
+  for entry in index.Entries():
+    if (entry.mount_point not in mount_points or
+        not stat.S_ISREG(entry.st_mode)):
+      continue
+    if skip_paths and (entry.path in skip_paths or
+                       [path for path in _ParentDirs(entry.path)
+                        if path in skip_paths]):
+      continue
+    if entry.st_nlink > 1:
+      if (entry.st_dev, entry.st_ino) in linked:
+        continue
+      linked.add((entry.st_dev, entry.st_ino))
+    holes += max(entry.st_size - entry.st_blocks * 512, 0)
+  return holes
+
+
+def _GetTransferJobs(fs_devs, split_dirs=False):
+  """Split the file transfer into independent rsync jobs.
+
+  Creates one job for each mounted source filesystem. Each job is limited to
+  its own filesystem, like rsync's -x option, so that it doesn't copy the
+  contents of the filesystems mounted below it. If split_dirs is set, each
+  top-level directory of a filesystem is given its own job as well, and
+  excluded from the job for the filesystem itself.
+
+  @type fs_devs: list
+  @param fs_devs: List of (device, mount point) tuples.
+  @type split_dirs: bool
+  @param split_dirs: Whether to also split filesystems by top-level directory.
+  @rtype: list
+  @return: List of (source dir, target dir, excluded top-level directories)
+    tuples
+
+  """
+  jobs = []
+  for _, mount_point in fs_devs:
+    src = _SourcePath(mount_point)
+    if src != SOURCE_MOUNT and not os.path.ismount(src):
+      continue  # Not mounted, so it is copied along with its parent
+    dest = TARGET_MOUNT + src[len(SOURCE_MOUNT):]
+
+    subdirs = []
+    if split_dirs:
+      for name in sorted(os.listdir(src)):
+        path = os.path.join(src, name)
+        # Names are passed through the remote shell, so stick to simple ones
+        if (re.match("[-a-zA-Z0-9_.+@]+$", name) and os.path.isdir(path) and
+            not os.path.islink(path) and not os.path.ismount(path)):
+          subdirs.append(name)
+
+    jobs.append((src, dest, subdirs))
+    for name in subdirs:
+      jobs.append((os.path.join(src, name), os.path.join(dest, name), []))
+
+  return jobs
+
+
+def _RunCommandsInParallel(commands, max_procs, done_callback=None,
+                           args_callback=None):
+  """Run local commands, with at most max_procs of them running at once.
+
+  Commands are started in order. Once one of them fails, no new ones are
+  started, but the ones already running are allowed to finish. Only the
+  commands started here are waited for, so other threads may run their own
+  commands at the same time.
+
+  @type commands: list
+  @param commands: List of commands, each given as a list of arguments.
+  @type max_procs: int
+  @param max_procs: Maximum number of commands to run at the same time.
+  @type done_callback: callable
+  @param done_callback: Function called with the command and its exit status
+    as soon as each command completes.
+  @type args_callback: callable
+  @param args_callback: Function called just before each command is started,
+    returning a list of extra arguments to insert after the program name.
+  @rtype: list
+  @return: List of (command, exit status) tuples, in order of completion.
+
+  """
+  pending = list(commands)
+  running = []
+  results = []
+
+  while pending or running:
+    while pending and len(running) < max_procs:
+      command = pending.pop(0)
+      if args_callback:
+        proc = subprocess.Popen(command[:1] + args_callback() + command[1:])
+      else:
+        proc = subprocess.Popen(command)
+      running.append((command, proc))
+
+    finished = [item for item in running if item[1].poll() is not None]
+    if not finished:
+      time.sleep(_POLL_INTERVAL)
+      continue
+    for command, proc in finished:
+      running.remove((command, proc))
+      results.append((command, proc.returncode))
+      if done_callback:
+        done_callback(command, proc.returncode)
+
+      if proc.returncode:
+        result = "failed"
+        pending = []
+      else:
+        result = "done"
+      DisplayCommandProgress("[%d/%d] %s: %s" % (len(results), len(commands),
+                                                 command[-1], result))
+
+  return results
+
+
+def TransferNative(client, fs_devs=None, parallel=1, split_dirs=False,
+                   include_root=True, journal=None, limiter=None,
+                   compress_level=None, progress=None, excluded=None):
+  """Transfer files to the bootstrap OS over the existing SSH connection.
+
+  The source files are packed into pax (POSIX tar) archives as they are read,
+  keeping owners, permissions, times, hard links, ACLs, extended attributes
+  and holes in sparse files, and unpacked by tar on the instance.
+  Filesystems, and optionally top-level directories, are split into jobs as
+  for rsync, and up to parallel of them are sent at once, each on its own
+  channel of the connection.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type fs_devs: list
+  @param fs_devs: List of (device, mount point) tuples, as returned by
+    MountSourceFilesystems.
+  @type parallel: int
+  @param parallel: Maximum number of archives to send at once.
+  @type split_dirs: bool
+  @param split_dirs: Whether to also split filesystems by top-level directory.
+  @type include_root: bool
+  @param include_root: Whether to copy the root filesystem. If not, only the
+    other filesystems in fs_devs are copied.
+  @type journal: L{CheckpointJournal}
+  @param journal: If given, jobs recorded in it as done are skipped, and
+    completed jobs are added to it. A job that was interrupted is sent again
+    in full.
+  @type limiter: L{BandwidthLimiter}
+  @param limiter: If given, the archives are throttled by it.
+  @type compress_level: int
+  @param compress_level: gzip compression level, or None not to compress.
+  @type progress: L{ProgressReporter}
+  @param progress: If given, the size of the holes left out of the archives
+    is added to it.
+  @type excluded: list
+  @param excluded: Paths, from the root of the source machine, of files to
+    leave out, as found by L{FindExcludedFiles}.
+  @raise P2VError: A job failed.
+
+  """
+  if journal:
+    if journal.IsDone("files"):
+      return
+    if journal.IsDone("warm"):
+      raise P2VError("A warm copy can only be finished with --engine=rsync")
+
+  if parallel == 1 and include_root:
+    # One archive of the whole tree, like a single rsync
+    jobs = [(SOURCE_MOUNT, TARGET_MOUNT, [], False, "files")]
+  else:
+    if fs_devs is None:
+      fs_devs = [("", "/")]
+    if not include_root:
+      fs_devs = [dev for dev in fs_devs if dev[1] != "/"]
+    jobs = [(src, dest, excludes, True, "files %s" % dest)
+            for src, dest, excludes in _GetTransferJobs(fs_devs, split_dirs)]
+  if journal:
+    jobs = [job for job in jobs if not journal.IsDone(job[4])]
+  if not jobs:
+    return
+
+  skip_paths = set([SOURCE_MOUNT + path for path in excluded or []])
+
+  DisplayCommandStart("Transferring files in %d jobs, %d at a time. This will"
+                      " take a while..." % (len(jobs), parallel))
+
+  def _Send(job):
+    src, dest, excludes, one_file_system, entry = job
+    _SendTree(client, src, dest, excludes, one_file_system, limiter,
+              compress_level, progress, skip_paths)
+    if journal:
+      journal.MarkDone(entry)
+
+  failed = []
+  results = _RunInThreads(_Send, jobs, parallel)
+  for count, (job, error) in enumerate(results):
+    if error:
+      result = "failed: %s" % error
+      failed.append(job[1])
+    else:
+      result = "done"
+    if len(jobs) > 1:
+      DisplayCommandProgress("[%d/%d] %s: %s" % (count + 1, len(jobs), job[1],
+                                                 result))
+  if failed:
+    raise P2VError("Error transferring files to %s" % ", ".join(failed))
+
+  DisplayCommandEnd("done")
+
+
+def _SendTree(client, src, dest, excludes=(), one_file_system=False,
+              limiter=None, compress_level=None, progress=None,
+              skip_paths=()):
+  """Send a directory tree to the instance as a tar archive.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type src: str
+  @param src: Directory to send.
+  @type dest: str
+  @param dest: Directory on the instance to unpack into. It is created if
+    necessary.
+  @type excludes: list
+  @param excludes: Names of top-level directories of src to leave out.
+  @type one_file_system: bool
+  @param one_file_system: Whether to leave out the contents of filesystems
+    mounted below src.
+  @type limiter: L{BandwidthLimiter}
+  @param limiter: If given, the archive is throttled by it.
+  @type compress_level: int
+  @param compress_level: gzip compression level, or None not to compress.
+  @type progress: L{ProgressReporter}
+  @param progress: If given, the size of the holes left out of the archive is
+    added to it.
+  @type skip_paths: set
+  @param skip_paths: Paths of files to leave out, as for L{_TarStream}.
+  @raise P2VError: The archive could not be sent or unpacked.
+
+  """
+  _SendArchive(client, dest,
+               _TarStream(src, excludes, one_file_system, progress,
+                          skip_paths),
+               limiter, compress_level)
+
+
+def _SendArchive(client, dest, stream, limiter=None, compress_level=None):
+  """Unpack a tar archive into a directory on the instance.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type dest: str
+  @param dest: Directory on the instance to unpack into. It is created if
+    necessary.
+  @param stream: Iterable of strings, which together form the archive.
+  @type limiter: L{BandwidthLimiter}
+  @param limiter: If given, the archive is throttled by it.
+  @type compress_level: int
+  @param compress_level: gzip compression level, or None not to compress.
+  @raise P2VError: The archive could not be sent or unpacked.
+
+  """
+  if compress_level is None:
+    flags = ""
+  else:
+    flags = "z"
+  stdin, stdout, stderr = client.exec_command(
+    "mkdir -p %s && %s" % (dest, _TAR_EXTRACT % (flags, dest)))
+
+  if compress_level is not None:
+    stream = _GzipStream(stream, compress_level)
+  try:
+    for data in stream:
+      if limiter:
+        limiter.Throttle(len(data))
+      stdin.channel.sendall(data)
+    stdin.channel.shutdown_write()
+  except (socket.error, EOFError):
+    pass  # tar stopped reading; its exit status and errors tell why
+  _, err = _WaitForCompletion(stdout.channel)
+  if stdout.channel.recv_exit_status() != 0:
+    raise P2VError("tar failed on the instance: %s" % err.strip())
+
+
+def SendSmallFiles(client, index, max_bytes, parallel=1, include_root=True,
+                   journal=None, limiter=None, compress_level=None,
+                   progress=None, excluded=None):
+  """Send the small files of the source filesystems in batched archives.
+
+  rsync exchanges messages about every file it copies, so on a link with any
+  latency it copies trees of small files, like mail spools or package caches,
+  far slower than the link allows. Regular files smaller than max_bytes, apart
+  from hard links, are instead packed into pax archive segments of many files
+  each, which are unpacked by tar on the instance, up to parallel of them at
+  once on channels of the existing connection. Owners, permissions, times,
+  ACLs and extended attributes are kept, so the rsync run afterwards finds
+  these files up to date, and only copies directories, hard links, large files
+  and whatever changed in the meantime.
+
+  After a warm copy, the final pass leaves everything to rsync, which then
+  only sends the files that changed.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type index: L{SourceIndex}
+  @param index: The files on the source filesystems.
+  @type max_bytes: int
+  @param max_bytes: Size below which files are batched.
+  @type parallel: int
+  @param parallel: Maximum number of segments to send at once.
+  @type include_root: bool
+  @param include_root: Whether to send files on the root filesystem. If not,
+    only the files on the other filesystems are sent.
+  @type journal: L{CheckpointJournal}
+  @param journal: If given, nothing is sent if the small files, or all files,
+    are recorded in it as done, and the small files are added to it once
+    they are sent.
+  @type limiter: L{BandwidthLimiter}
+  @param limiter: If given, the archives are throttled by it.
+  @type compress_level: int
+  @param compress_level: gzip compression level, or None not to compress.
+  @type progress: L{ProgressReporter}
+  @param progress: If given, the size of the holes left out of the archives
+    is added to it.
+  @type excluded: list
+  @param excluded: Paths, from the root of the source machine, of files to
+    leave out, as found by L{FindExcludedFiles}.
+  @rtype: int
+  @return: Number of files sent.
+  @raise P2VError: A segment could not be sent or unpacked.
+
+  """
+  if journal and (journal.IsDone("small_files") or journal.IsDone("files") or
+                  journal.IsDone("warm")):
+    return 0
+
+  mount_points = None
+  if not include_root:
+    mount_points = [mount_point for mount_point in index.mount_points
+                    if mount_point != "/"]
+  segments = _SmallFileSegments(index, max_bytes, mount_points, excluded,
+                                _BATCH_SEGMENT_BYTES, _BATCH_SEGMENT_FILES)
+  lock = threading.Lock()
+  failed = threading.Event()
+  sent = [0, 0]
+
+  DisplayCommandStart("Sending files smaller than %s in batches, %d at a"
+                      " time..." % (_FormatBytes(max_bytes), parallel))
+
+  def _Send(_):
+    while not failed.isSet():
+      # The segments are made as they are asked for
+      lock.acquire()
+      try:
+        try:
+          paths = segments.next()
+        except StopIteration:
+          return
+      finally:
+        lock.release()
+      try:
+        _SendArchive(client, TARGET_MOUNT,
+                     _TarMembers(_TarFiles(paths), progress), limiter,
+                     compress_level)
+      except:
+        failed.set()
+        raise
+      lock.acquire()
+      try:
+        sent[0] += 1
+        sent[1] += len(paths)
+      finally:
+        lock.release()
+
+  for _, error in _RunInThreads(_Send, range(parallel), parallel):
+    if error:
+      raise P2VError("Error sending small files: %s" % error)
+  if journal:
+    journal.MarkDone("small_files")
+
+  DisplayCommandEnd("%d files in %d archives" % (sent[1], sent[0]))
+  return sent[1]
+
+
+def _SmallFileSegments(index, max_bytes, mount_points=None, excluded=None,
+                       segment_bytes=_BATCH_SEGMENT_BYTES,
+                       segment_files=_BATCH_SEGMENT_FILES):
+  """Group the small files in an index into archive segments.
+
+  @type index: L{SourceIndex}
+  @param index: The files on the source filesystems.
+  @type max_bytes: int
+  @param max_bytes: Size below which files are batched.
+  @type mount_points: list
+  @param mount_points: If given, only files on these filesystems are batched.
+  @type excluded: list
+  @param excluded: Paths of files to leave out, as for L{SendSmallFiles}.
+  @type segment_bytes: int
+  @param segment_bytes: Size of the files in a segment above which no more
+    are added to it.
+  @type segment_files: int
+  @param segment_files: Largest number of files in a segment.
+  @return: Generator of lists of paths, from the root of the source machine.
+
+  """
+  segment = []
+  nbytes = 0
+  for entry in _PlainFiles(index, mount_points, excluded):
+    if entry.st_size >= max_bytes:
+      continue
+    segment.append(entry.path)
+    nbytes += entry.st_size
+    if nbytes >= segment_bytes or len(segment) >= segment_files:
+      yield segment
+      segment = []
+      nbytes = 0
+  if segment:
+    yield segment
+
+
+def _PlainFiles(index, mount_points=None, excluded=None):
+  """List the regular files in an index that have no other hard links.
+
+  @type index: L{SourceIndex}
+  @param index: The files on the source filesystems.
+  @type mount_points: list
+  @param mount_points: If given, only files on these filesystems are listed.
+  @type excluded: list
+  @param excluded: Paths, from the root of the source machine, of files to
+    leave out, as found by L{FindExcludedFiles}.
+  @return: Generator of L{_IndexEntry} tuples.
+
+  """
+  skip_paths = set(excluded or [])
+  for part, (mount_point, _) in enumerate(index.parts):
+    if mount_points is not None and mount_point not in mount_points:
+      continue
+    for entry in index.Entries(part):
+      if not stat.S_ISREG(entry.st_mode) or entry.st_nlink != 1:
+        continue
+      if skip_paths and (entry.path in skip_paths or
+                         [path for path in _ParentDirs(entry.path)
+                          if path in skip_paths]):
+        continue
+      yield entry
+
+
+def SendLargeFiles(client, index, min_bytes, parallel=_RANGE_THREADS,
+                   include_root=True, journal=None, limiter=None,
+                   excluded=None, range_bytes=_RANGE_BYTES):
+  """Send the large files of the source filesystems in ranges, in parallel.
+
+  A single rsync copies a large file, like a database or a disk image, as one
+  stream, no faster than one CPU can checksum and compress it. Regular files
+  of at least min_bytes, apart from hard links, are instead split into ranges
+  of range_bytes, which up to parallel workers send at once, each on its own
+  channel of the existing connection. A small script on the instance writes
+  each range at its offset in the file. All-zero blocks are not sent, so
+  sparse files stay sparse.
+
+  Each range that is written is added to the journal, so an interrupted
+  transfer only sends the missing ranges again, as long as the file has the
+  same size and modification time. Once all of its ranges are written, a file
+  gets the modification time of the source, and the rsync run afterwards
+  finds it up to date and only copies its owner, permissions and attributes.
+  After a warm copy, the final pass leaves everything to rsync, which then
+  only sends the parts of the files that changed.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type index: L{SourceIndex}
+  @param index: The files on the source filesystems.
+  @type min_bytes: int
+  @param min_bytes: Size from which files are split into ranges.
+  @type parallel: int
+  @param parallel: Maximum number of ranges to send at once.
+  @type include_root: bool
+  @param include_root: Whether to send files on the root filesystem. If not,
+    only the files on the other filesystems are sent.
+  @type journal: L{CheckpointJournal}
+  @param journal: If given, ranges and files recorded in it as done are
+    skipped, and those that are completed are added to it.
+  @type limiter: L{BandwidthLimiter}
+  @param limiter: If given, the ranges are throttled by it.
+  @type excluded: list
+  @param excluded: Paths, from the root of the source machine, of files to
+    leave out, as found by L{FindExcludedFiles}.
+  @type range_bytes: int
+  @param range_bytes: Size of the ranges.
+  @rtype: int
+  @return: Number of ranges sent.
+  @raise P2VError: A range could not be sent or written.
+
+  """
+  if journal and (journal.IsDone("files") or journal.IsDone("warm")):
+    return 0
+
+  mount_points = None
+  if not include_root:
+    mount_points = [mount_point for mount_point in index.mount_points
+                    if mount_point != "/"]
+  done_ranges = set()
+  done_files = set()
+  if journal:
+    done_ranges = set(journal.Values("range"))
+    done_files = set(journal.Values("large_file"))
+
+  files = []
+  ranges = []
+  prepare = []
+  target_dirs = set()
+  for entry in _PlainFiles(index, mount_points, excluded):
+    # Such names can't be kept in the journal
+    if entry.st_size < min_bytes or "\n" in entry.path:
+      continue
+    if _LargeFileKey(entry) in done_files:
+      continue
+    files.append(entry)
+    offsets = range(0, entry.st_size, range_bytes)
+    missing = [offset for offset in offsets
+               if _RangeKey(entry, offset) not in done_ranges]
+    if len(missing) == len(offsets):
+      # Nothing of this version of the file was written yet
+      target = pipes.quote(TARGET_MOUNT + entry.path)
+      target_dir = pipes.quote(os.path.dirname(TARGET_MOUNT + entry.path))
+      if target_dir not in target_dirs:
+        target_dirs.add(target_dir)
+        prepare.append("mkdir -p %s" % target_dir)
+      prepare.extend([": > %s" % target,
+                      "truncate -s %d %s" % (entry.st_size, target)])
+    ranges.extend([(entry, offset) for offset in missing])
+  if not files:
+    return 0
+  # The files are created, and later given their times, all at once, as a
+  # round trip for each file would add up
+  if prepare:
+    _RunScript(client, prepare)
+
+  DisplayCommandStart("Sending %d files of %s or more in %d ranges, %d at a"
+                      " time..." % (len(files), _FormatBytes(min_bytes),
+                                    len(ranges), parallel))
+
+  lock = threading.Lock()
+
+  def _Send(item):
+    entry, offset = item
+    _SendRange(client, entry, offset, min(range_bytes, entry.st_size - offset),
+               limiter)
+    if journal:
+      lock.acquire()
+      try:
+        journal.MarkDone("range %s" % _RangeKey(entry, offset))
+      finally:
+        lock.release()
+
+  failed = []
+  for (entry, offset), error in _RunInThreads(_Send, ranges, parallel):
+    if error:
+      failed.append("%s at %d: %s" % (entry.path, offset, error))
+  if failed:
+    raise P2VError("Error sending ranges of large files: %s" %
+                   "; ".join(failed))
+
+  _RunScript(client, ["touch -m -d @%.9f %s" %
+                      (entry.st_mtime, pipes.quote(TARGET_MOUNT + entry.path))
+                      for entry in files])
+  if journal:
+    for entry in files:
+      journal.MarkDone("large_file %s" % _LargeFileKey(entry))
+
+  DisplayCommandEnd("done")
+  return len(ranges)
+
+
+def _RangeKey(entry, offset):
+  """Name a range of a version of a file in the journal."""
+  return "%d %d %r %s" % (offset, entry.st_size, entry.st_mtime, entry.path)
+
+
+def _LargeFileKey(entry):
+  """Name a version of a file in the journal."""
+  return "%d %r %s" % (entry.st_size, entry.st_mtime, entry.path)
+
+
+def _SendRange(client, entry, offset, length, limiter=None):
+  """Write a range of a source file into the same file on the instance.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type entry: L{_IndexEntry}
+  @param entry: The file.
+  @type offset: int
+  @param offset: Start of the range.
+  @type length: int
+  @param length: Length of the range.
+  @type limiter: L{BandwidthLimiter}
+  @param limiter: If given, the range is throttled by it.
+  @raise P2VError: The range could not be read, sent or written.
+
+  """
+  stdin, stdout, stderr = client.exec_command(
+    "python -c '%s' %s" % (_EXTENT_WRITER,
+                           pipes.quote(TARGET_MOUNT + entry.path)))
+  try:
+    source = open(SOURCE_MOUNT + entry.path, "rb")
+  except IOError, e:
+    stdin.channel.close()
+    raise P2VError("Could not read %s: %s" % (entry.path, e))
+  try:
+    try:
+      for data in _RangeStream(source, offset, length):
+        if limiter:
+          limiter.Throttle(len(data))
+        stdin.channel.sendall(data)
+      stdin.channel.shutdown_write()
+    except (socket.error, EOFError):
+      pass  # The writer stopped reading; its exit status and errors tell why
+  finally:
+    source.close()
+  _, err = _WaitForCompletion(stdout.channel)
+  if stdout.channel.recv_exit_status() != 0:
+    raise P2VError("Error writing %s: %s" % (entry.path, err.strip()))
+
+
+def _RangeStream(source, offset, length):
+  """Generate the records L{_EXTENT_WRITER} reads for a range of a file.
+
+  All-zero blocks are left out, as the instance file starts out empty.
+
+  @type source: file
+  @param source: The open file.
+  @type offset: int
+  @param offset: Start of the range.
+  @type length: int
+  @param length: Length of the range.
+  @return: Generator of strings.
+
+  """
+  source.seek(offset)
+  end = offset + length
+  while offset < end:
+    data = source.read(min(end - offset, _STREAM_BUFFER_BYTES))
+    if not data:
+      break  # The file was truncated; rsync copies it again
+    if data.strip("\0"):
+      yield struct.pack(">QQ", offset, len(data)) + data
+    offset += len(data)
+  yield struct.pack(">QQ", 0, 0)
+
+
+def _TarFiles(paths):
+  """List source files for L{_TarMembers}.
+
+  Files that disappeared since they were listed are left out.
+
+  @type paths: list
+  @param paths: Paths of the files, from the root of the source machine.
+  @return: Generator of (path, name in the archive, lstat result) tuples.
+
+  """
+  for path in paths:
+    try:
+      stats = os.lstat(SOURCE_MOUNT + path)
+    except OSError, e:
+      if e.errno == errno.ENOENT:
+        continue
+      raise P2VError("Could not read %s: %s" % (path, e))
+    yield SOURCE_MOUNT + path, path.lstrip("/"), stats
+
+
+def _RunInThreads(func, items, max_threads):
+  """Call a function on each item, in up to max_threads threads at once.
+
+  Items are started in order. Once one of them fails, no new ones are
+  started, but the ones already running are allowed to finish.
+
+  @param func: Function to call with each item.
+  @type items: list
+  @param items: Items to process.
+  @type max_threads: int
+  @param max_threads: Maximum number of threads to run at the same time.
+  @rtype: list
+  @return: List of (item, exception or None) tuples, in order of completion.
+
+  """
+  pending = list(items)
+  finished = Queue.Queue()
+  results = []
+  running = 0
+
+  def _Run(item):
+    try:
+      func(item)
+    except Exception, e:  # Passed on to the main thread
+      finished.put((item, e))
+    else:
+      finished.put((item, None))
+
+  while pending or running:
+    while pending and running < max_threads:
+      thread = threading.Thread(target=_Run, args=(pending.pop(0),))
+      thread.setDaemon(True)
+      thread.start()
+      running += 1
+
+    try:
+      # With a timeout, so that Ctrl-C is noticed
+      item, error = finished.get(True, _SELECT_INTERVAL)
+    except Queue.Empty:
+      continue
+    running -= 1
+    results.append((item, error))
+    if error:
+      pending = []
+
+  return results
+
+
+def _TarStream(root, excludes=(), one_file_system=False, progress=None,
+               skip_paths=()):
+  """Generate a pax archive of a directory tree.
+
+  Entries are named relative to root, starting with "." for root itself.
+  Directories are listed before their contents. Files that disappear while
+  the tree is read are left out. Files with holes are stored in the GNU sparse
+  1.0 format, which leaves out the holes and any all-zero blocks.
+
+  @type root: str
+  @param root: Directory to archive.
+  @type excludes: list
+  @param excludes: Names of top-level directories of root to leave out.
+  @type one_file_system: bool
+  @param one_file_system: Whether to leave out the contents of filesystems
+    mounted below root. Their mount points are still included.
+  @type progress: L{ProgressReporter}
+  @param progress: If given, the size of the holes left out is added to it.
+  @type skip_paths: set
+  @param skip_paths: Paths of files under root to leave out. The contents of
+    directories among them are left out as well.
+  @return: Generator of strings, which together form the archive.
+
+  """
+  return _TarMembers(_TarWalk(root, excludes, one_file_system, skip_paths),
+                     progress)
+
+
+def _TarWalk(root, excludes=(), one_file_system=False, skip_paths=()):
+  """Walk a directory tree for L{_TarStream}.
+
+  @return: Generator of (path, name in the archive, lstat result) tuples.
+    The contents of a directory are listed once the consumer asks for the
+    entry after it.
+
+  """
+  root_dev = os.lstat(root).st_dev
+  stack = [(root, ".")]
+
+  while stack:
+    path, name = stack.pop()
+    if path in skip_paths:
+      continue
+    try:
+      stats = os.lstat(path)
+    except OSError, e:
+      if e.errno == errno.ENOENT:
+        continue
+      raise P2VError("Could not read %s: %s" % (path, e))
+    yield path, name, stats
+
+    if stat.S_ISDIR(stats.st_mode):
+      if one_file_system and stats.st_dev != root_dev:
+        continue
+      try:
+        children = os.listdir(path)
+      except OSError, e:
+        if e.errno == errno.ENOENT:
+          continue
+        raise P2VError("Could not read %s: %s" % (path, e))
+      if name == ".":
+        children = [child for child in children if child not in excludes]
+      for child in sorted(children, reverse=True):
+        if name == ".":
+          child_name = child
+        else:
+          child_name = "%s/%s" % (name, child)
+        stack.append((os.path.join(path, child), child_name))
+
+
+def _TarMembers(files, progress=None):
+  """Generate a pax archive of files.
+
+  @type files: iterable
+  @param files: (path, name in the archive, lstat result) tuples.
+  @type progress: L{ProgressReporter}
+  @param progress: If given, the size of the holes left out is added to it.
+  @return: Generator of strings, which together form the archive.
+
+  """
+  xattr_reader = _XattrReader()
+  links = {}
+  # Headers are collected, so that they aren't sent in tiny pieces
+  pending = []
+  pending_bytes = 0
+
+  for path, name, stats in files:
+    entry = _TarEntry(path, name, stats, links, xattr_reader)
+    if entry is None:
+      continue
+    header, source, regions = entry
+    pending.append(header)
+    pending_bytes += len(header)
+    if source or pending_bytes >= _TAR_MIN_SEND_BYTES:
+      yield "".join(pending)
+      pending = []
+      pending_bytes = 0
+    if source and regions is not None:
+      if progress:
+        progress.AddSparseBytes(stats.st_size -
+                                sum([length for _, length in regions]))
+      for data in _TarSparseData(source, regions):
+        yield data
+    elif source:
+      for data in _TarFileData(source, stats.st_size):
+        yield data
+
+  pending.append("\0" * (2 * _TAR_BLOCK))
+  yield "".join(pending)
+
+
+def _TarEntry(path, name, stats, links, xattr_reader):
+  """Build the archive header for one file.
+
+  @type links: dict
+  @param links: Names already archived, by (device, inode), for files with
+    more than one link. Updated with this file.
+  @return: Tuple of the header; for a regular file that isn't a link to one
+    already archived, the open file to read its contents from; and for a
+    sparse file, the list of (offset, length) regions holding its data. None
+    if the file should be left out.
+
+  """
+  mode = stats.st_mode
+  linkname = ""
+  size = 0
+  devices = (0, 0)
+  source = None
+  regions = None
+  sparse_size = None
+  sparse_map = ""
+
+  key = (stats.st_dev, stats.st_ino)
+  if not stat.S_ISDIR(mode) and stats.st_nlink > 1 and key in links:
+    typeflag = "1"
+    linkname = links[key]
+  elif stat.S_ISREG(mode):
+    typeflag = "0"
+    try:
+      source = open(path, "rb")
+    except IOError, e:
+      if e.errno == errno.ENOENT:
+        return None
+      raise P2VError("Could not read %s: %s" % (path, e))
+    size = stats.st_size
+    if stats.st_blocks * 512 < size:
+      try:
+        regions = _SparseRegions(source, size)
+      except (IOError, OSError), e:
+        source.close()
+        raise P2VError("Could not read %s: %s" % (path, e))
+      if sum([length for _, length in regions]) < size:
+        sparse_size = size
+        sparse_map = _SparseMap(regions, size)
+        size = len(sparse_map) + sum([length for _, length in regions])
+      else:
+        regions = None
+  elif stat.S_ISDIR(mode):
+    typeflag = "5"
+  elif stat.S_ISLNK(mode):
+    typeflag = "2"
+    try:
+      linkname = os.readlink(path)
+    except OSError, e:
+      if e.errno == errno.ENOENT:
+        return None
+      raise P2VError("Could not read %s: %s" % (path, e))
+  elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+    if stat.S_ISCHR(mode):
+      typeflag = "3"
+    else:
+      typeflag = "4"
+    devices = (os.major(stats.st_rdev), os.minor(stats.st_rdev))
+  elif stat.S_ISFIFO(mode):
+    typeflag = "6"
+  else:
+    return None  # Sockets are recreated by whatever uses them
+
+  if typeflag != "1" and not stat.S_ISDIR(mode) and stats.st_nlink > 1:
+    links[key] = name
+
+  try:
+    xattrs = xattr_reader.Read(path)
+  except OSError, e:
+    if e.errno != errno.ENOENT:
+      raise P2VError("Could not read extended attributes of %s: %s" %
+                     (path, e))
+    xattrs = []
+
+  header = _TarHeader(name, stats, typeflag, linkname, size, devices, xattrs,
+                      sparse_size)
+  return header + sparse_map, source, regions
 
 
-def PartitionTargetDisks(client, total_megs, swap_megs, target_hd):
-  """Partition and format the disks on the target machine.
+def _TarHeader(name, stats, typeflag, linkname="", size=0, devices=(0, 0),
+               xattrs=(), sparse_size=None):
+  """Build a ustar header, preceded by a pax header if needed.
 
-  Sends commands over the SSH connection to partition and format the
-  disk of the target instance.
+  Values that don't fit in the ustar header, such as the fraction of a second
+  of the modification time, and extended attributes, go in the pax header.
+
+  @type sparse_size: int
+  @param sparse_size: For a file stored in the GNU sparse 1.0 format, its real
+    size. The header then has a placeholder name, and size is the size of the
+    sparse map and data.
+  @rtype: str
+  @return: The header blocks.
+
+  """
+  records = []
+  if sparse_size is not None:
+    records.extend([
+      _PaxRecord("GNU.sparse.major", "1"),
+      _PaxRecord("GNU.sparse.minor", "0"),
+      _PaxRecord("GNU.sparse.name", name),
+      _PaxRecord("GNU.sparse.realsize", str(sparse_size)),
+      ])
+    dirname, basename = os.path.split(name)
+    name = os.path.join(dirname, "GNUSparseFile.0", basename)
+  if len(name) > 100:
+    records.append(_PaxRecord("path", name))
+  if len(linkname) > 100:
+    records.append(_PaxRecord("linkpath", linkname))
+  if size > _TAR_MAX_SIZE:
+    records.append(_PaxRecord("size", str(size)))
+  if stats.st_uid > _TAR_MAX_ID:
+    records.append(_PaxRecord("uid", str(stats.st_uid)))
+  if stats.st_gid > _TAR_MAX_ID:
+    records.append(_PaxRecord("gid", str(stats.st_gid)))
+  if stats.st_mtime != int(stats.st_mtime):
+    records.append(_PaxRecord("mtime", repr(stats.st_mtime)))
+  for attr_name, value in xattrs:
+    records.append(_PaxRecord("SCHILY.xattr.%s" % attr_name, value))
+
+  header = _UstarHeader(name[:100], stat.S_IMODE(stats.st_mode),
+                        min(stats.st_uid, _TAR_MAX_ID),
+                        min(stats.st_gid, _TAR_MAX_ID),
+                        min(size, _TAR_MAX_SIZE), int(stats.st_mtime),
+                        typeflag, linkname[:100], devices)
+  if not records:
+    return header
+
+  data = "".join(records)
+  pax_name = "./PaxHeaders/%s" % os.path.basename(name.rstrip("/"))
+  pax_header = _UstarHeader(pax_name[:100], 0644, 0, 0, len(data),
+                            int(stats.st_mtime), "x", "", (0, 0))
+  return pax_header + _TarPad(data) + header
+
+
+def _UstarHeader(name, mode, uid, gid, size, mtime, typeflag, linkname,
+                 devices):
+  """Build a single ustar header block."""
+  def _Number(value, width):
+    return "%0*o\0" % (width - 1, value)
+
+  fields = [
+    name.ljust(100, "\0"),
+    _Number(mode, 8),
+    _Number(uid, 8),
+    _Number(gid, 8),
+    _Number(size, 12),
+    _Number(max(mtime, 0), 12),
+    " " * 8,  # Checksum, filled in below
+    typeflag,
+    linkname.ljust(100, "\0"),
+    "ustar\0", "00",
+    "\0" * 32,  # Owner and group names; numeric ids are used
+    "\0" * 32,
+    _Number(devices[0], 8),
+    _Number(devices[1], 8),
+    "\0" * 155,
+    ]
+  header = "".join(fields).ljust(_TAR_BLOCK, "\0")
+  checksum = sum([ord(char) for char in header])
+  return header[:148] + "%06o\0 " % checksum + header[156:]
+
+
+def _PaxRecord(keyword, value):
+  """Build one "length keyword=value" record of a pax header."""
+  record = " %s=%s\n" % (keyword, value)
+  # The length includes its own digits
+  length = len(record) + 1
+  while length != len(record) + len(str(length)):
+    length = len(record) + len(str(length))
+  return str(length) + record
+
+
+def _TarPad(data):
+  """Pad data to a whole number of archive blocks."""
+  return data + "\0" * (-len(data) % _TAR_BLOCK)
+
+
+def _TarFileData(source, size):
+  """Generate the archived contents of a regular file.
+
+  Exactly size bytes are produced, padded to whole blocks, even if the file
+  changes size while it is read.
+
+  """
+  try:
+    remaining = size
+    while remaining:
+      data = source.read(min(remaining, _STREAM_BUFFER_BYTES))
+      if not data:
+        # The file was truncated, so fill the rest of the entry
+        data = "\0" * min(remaining, _STREAM_BUFFER_BYTES)
+      remaining -= len(data)
+      if not remaining:
+        data = _TarPad(data)
+      yield data
+  finally:
+    source.close()
+
+
+def _SparseRegions(source, size):
+  """Find the parts of a file that hold data.
+
+  Holes are found with SEEK_DATA and SEEK_HOLE, and all-zero blocks within
+  the data are left out as well. Where the filesystem can't report holes,
+  only the all-zero blocks are left out.
+
+  @type source: file
+  @param source: The open file.
+  @type size: int
+  @param size: Size of the file.
+  @rtype: list
+  @return: List of (offset, length) tuples, in order.
+
+  """
+  fd = source.fileno()
+  regions = []
+  offset = 0
+  try:
+    while offset < size:
+      try:
+        start = os.lseek(fd, offset, _SEEK_DATA)
+      except OSError, e:
+        if e.errno == errno.ENXIO:
+          break  # Only a hole is left
+        if e.errno != errno.EINVAL:
+          raise
+        start = offset  # No hole support
+        end = size
+      else:
+        end = min(os.lseek(fd, start, _SEEK_HOLE), size)
+      _AddNonZeroRegions(regions, source, start, end)
+      offset = end
+  finally:
+    source.seek(0)
+  return regions
+
+
+def _AddNonZeroRegions(regions, source, start, end):
+  """Add the parts of source[start:end] that aren't all zeros to regions."""
+  source.seek(start)
+  offset = start
+  while offset < end:
+    data = source.read(min(end - offset, _STREAM_BUFFER_BYTES))
+    if not data:
+      break
+    if data.strip("\0"):
+      for pos in range(0, len(data), _SPARSE_BLOCK):
+        block = data[pos:pos + _SPARSE_BLOCK]
+        if block.strip("\0"):
+          _AddExtent(regions, offset + pos, len(block))
+    offset += len(data)
+
+
+def _SparseMap(regions, size):
+  """Build the map that starts the data of a GNU sparse 1.0 archive entry.
+
+  @type regions: list
+  @param regions: List of (offset, length) tuples holding data.
+  @type size: int
+  @param size: Real size of the file.
+  @rtype: str
+  @return: The map, padded to whole blocks.
+
+  """
+  # An empty region at the end gives the file its full size
+  if not regions or sum(regions[-1]) < size:
+    regions = regions + [(size, 0)]
+  lines = [str(len(regions))]
+  for offset, length in regions:
+    lines.extend([str(offset), str(length)])
+  return _TarPad("\n".join(lines) + "\n")
+
+
+def _TarSparseData(source, regions):
+  """Generate the archived data regions of a sparse file.
+
+  The regions are produced at the lengths given, padded to whole blocks at
+  the end, even if the file changes while it is read.
+
+  """
+  try:
+    total = sum([length for _, length in regions])
+    for offset, length in regions:
+      source.seek(offset)
+      while length:
+        data = source.read(min(length, _STREAM_BUFFER_BYTES))
+        if not data:
+          data = "\0" * min(length, _STREAM_BUFFER_BYTES)
+        length -= len(data)
+        yield data
+    yield "\0" * (-total % _TAR_BLOCK)
+  finally:
+    source.close()
+
+
+def _GzipStream(stream, level):
+  """Compress a stream of strings in gzip format."""
+  compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  for data in stream:
+    compressed = compressor.compress(data)
+    if compressed:
+      yield compressed
+  yield compressor.flush()
+
+
+def _NativeCompressionLevel(rsync_args):
+  """Choose the gzip level for the native engine from rsync's compression.
+
+  @type rsync_args: list
+  @param rsync_args: Compression arguments returned by L{ChooseCompression}.
+  @rtype: int
+  @return: The level, or None for no compression.
+
+  """
+  if not rsync_args:
+    return None
+  for arg in rsync_args:
+    if arg.startswith("--compress-level="):
+      return min(max(int(arg.split("=", 1)[1]), 1), 9)
+  return 6
+
+
+def TransferBlocks(client, root_dev, target_hd, limiter=None, progress=None):
+  """Copy the root filesystem to the instance block by block.
+
+  Reads the allocation bitmaps of the ext2/3/4 filesystem on root_dev and
+  streams only the blocks in use to the first partition of the target disk.
+  The filesystem is then checked, grown to fill the partition and mounted on
+  /target, so that any other filesystems can be copied into it.
 
   @type client: paramiko.SSHClient
   @param client: SSH client object used to connect to the instance.
-  @type total_megs: int
-  @param total_megs: Total size of disk, in megabytes
-  @type swap_megs: int
-  @param swap_megs: Desired size of swap space, in megabytes
+  @type root_dev: str
+  @param root_dev: Device holding the root filesystem of the source OS.
   @type target_hd: str
   @param target_hd: Device file for the instance hard drive.
+  @type limiter: L{BandwidthLimiter}
+  @param limiter: If given, the stream of blocks is throttled by it.
+  @type progress: L{ProgressReporter}
+  @param progress: If given, the number of bytes sent is reported to it.
+  @raise P2VError: The filesystem can't be read or doesn't fit on the target.
 
   """
-  DisplayCommandStart("Partitioning disks...")
+  target_dev = "%s1" % target_hd
 
-  nonswap_megs = total_megs - swap_megs
-  sfdisk_command = """sfdisk -uM %s <<EOF
-0,%d,83
-,,82
-EOF
-""" % (target_hd, nonswap_megs)
+  # Nothing may change the filesystem from the time its bitmaps are read
+  # until its blocks have been copied
+  errcode = subprocess.call(["mount", "-o", "remount,ro", SOURCE_MOUNT])
+  if errcode:
+    raise P2VError("Could not remount %s read-only" % SOURCE_MOUNT)
 
-  other_commands = [
-    "mkfs.ext3 %s1" % target_hd,
-    "mkswap %s2" % target_hd,
-    "mkdir -p %s" % TARGET_MOUNT,
-    "mount %s1 %s" % (target_hd, TARGET_MOUNT),
-    ]
+  DisplayCommandStart("Reading filesystem allocation bitmaps...")
+  block_size, blocks_count, extents = ReadExtUsedExtents(root_dev)
+  used_blocks = sum([count for _, count in extents])
+  DisplayCommandEnd("%d MB used of %d MB" %
+                    (used_blocks * block_size / (1024 * 1024),
+                     blocks_count * block_size / (1024 * 1024)))
 
+  stdin, stdout, stderr = client.exec_command("blockdev --getsize64 %s" %
+                                              target_dev)
   try:
-    _RunCommandAndWait(client, sfdisk_command)
-    _RunCommandAndWait(client, " && ".join(other_commands))
-  except P2VError, e:
-    print e
-    print "Retrying..."
-    # Make sure target is unmounted, then try again
-    CleanUpTarget(client)
-    _RunCommandAndWait(client, sfdisk_command)
-    _RunCommandAndWait(client, " && ".join(other_commands))
+    target_bytes = int(stdout.read().strip())
+  except ValueError:
+    raise P2VError("Could not determine the size of %s" % target_dev)
+  if blocks_count * block_size > target_bytes:
+    raise P2VError("The root filesystem (%d MB) is larger than the target"
+                   " partition (%d MB), so it can't be copied block by block."
+                   " Please use --mode=file instead." %
+                   (blocks_count * block_size / (1024 * 1024),
+                    target_bytes / (1024 * 1024)))
+
+  DisplayCommandStart("Copying used blocks. This will take a while...")
+  if progress:
+    progress.SetTotals(used_blocks * block_size)
+  sent = 0
+  source = open(root_dev, "rb")
+  try:
+    stdin, stdout, stderr = client.exec_command("python -c '%s' %s" %
+                                                (_EXTENT_WRITER, target_dev))
+    for data in _ExtentStream(source, extents, block_size):
+      if limiter:
+        limiter.Throttle(len(data))
+      stdin.channel.sendall(data)
+      sent += len(data)
+      if progress:
+        progress.Update(sent)
+    stdin.channel.shutdown_write()
+    _, err = _WaitForCompletion(stdout.channel)
+    if stdout.channel.recv_exit_status() != 0:
+      raise P2VError("Error writing blocks to %s: %s" % (target_dev, err))
+  finally:
+    source.close()
+  DisplayCommandEnd("done")
 
+  DisplayCommandStart("Resizing filesystem...")
+  # e2fsck exits with 1 if it corrected errors, which is fine here
+  _RunCommandAndWait(client, " && ".join([
+    "(e2fsck -fy %s; test $? -le 1)" % target_dev,
+    "resize2fs %s" % target_dev,
+    "mkdir -p %s" % TARGET_MOUNT,
+    "mount %s %s" % (target_dev, TARGET_MOUNT),
+    ]))
   DisplayCommandEnd("done")
 
 
-def TransferFiles(user, host, keyfile):
-  """Transfer files to the bootstrap OS.
+def ReadExtUsedExtents(device):
+  """Find the blocks in use by an ext2/3/4 filesystem.
 
-  Runs rsync to copy all files from the source filesystem to the target
-  filesystem.
+  Reads the superblock, group descriptors and block bitmaps of the filesystem
+  and returns the runs of allocated blocks. Block groups whose bitmap was
+  never initialized (BLOCK_UNINIT) only contain the group's own metadata, so
+  that is computed from the descriptors instead. With the meta_bg feature,
+  the descriptors from s_first_meta_bg on are kept in the first group of
+  each meta group rather than after the superblock.
+
+  @type device: str
+  @param device: Block device or image file holding the filesystem.
+  @rtype: (int, int, list)
+  @return: Block size in bytes, total number of blocks, and a list of
+    (first block, number of blocks) tuples for the blocks in use.
+  @raise P2VError: The device doesn't hold a supported ext filesystem.
+
+  """
+  try:
+    dev = open(device, "rb")
+  except IOError, e:
+    raise P2VError("Could not open %s: %s" % (device, e))
+
+  try:
+    dev.seek(_EXT_SUPERBLOCK_OFFSET)
+    sb = dev.read(1024)
+    if len(sb) != 1024 or struct.unpack("<H", sb[0x38:0x3A])[0] != _EXT_MAGIC:
+      raise P2VError("%s does not contain an ext2/3/4 filesystem" % device)
+
+    (inodes_count, blocks_count, _, _, _, first_data_block,
+     log_block_size, _, blocks_per_group, _,
+     inodes_per_group) = struct.unpack("<11I", sb[:0x2C])
+    rev_level = struct.unpack("<I", sb[0x4C:0x50])[0]
+    feature_compat, feature_incompat, feature_ro_compat = \
+        struct.unpack("<III", sb[0x5C:0x68])
+    reserved_gdt_blocks = struct.unpack("<H", sb[0xCE:0xD0])[0]
+    first_meta_bg = struct.unpack("<I", sb[0x104:0x108])[0]
+    block_size = 1024 << log_block_size
+    if rev_level >= 1:
+      inode_size = struct.unpack("<H", sb[0x58:0x5A])[0]
+    else:
+      inode_size = 128
+    desc_size = 32
+    if feature_incompat & _EXT_FEATURE_INCOMPAT_64BIT:
+      desc_size = struct.unpack("<H", sb[0xFE:0x100])[0]
+      blocks_count |= struct.unpack("<I", sb[0x150:0x154])[0] << 32
+    if not feature_compat & _EXT_FEATURE_COMPAT_RESIZE_INODE:
+      reserved_gdt_blocks = 0
+
+    ngroups = ((blocks_count - first_data_block + blocks_per_group - 1) /
+               blocks_per_group)
+    gdt_blocks = (ngroups * desc_size + block_size - 1) / block_size
+    inode_table_blocks = ((inodes_per_group * inode_size + block_size - 1) /
+                          block_size)
+    uninit_allowed = feature_ro_compat & (_EXT_FEATURE_RO_COMPAT_GDT_CSUM |
+                                          _EXT_FEATURE_RO_COMPAT_METADATA_CSUM)
+
+    # Descriptors after the superblock, then one block per meta group
+    descs_per_block = block_size / desc_size
+    if feature_incompat & _EXT_FEATURE_INCOMPAT_META_BG:
+      flat_groups = min(ngroups, first_meta_bg * descs_per_block)
+    else:
+      flat_groups = ngroups
+    dev.seek((first_data_block + 1) * block_size)
+    gdt = dev.read(flat_groups * desc_size)
+    for first in range(flat_groups, ngroups, descs_per_block):
+      location = first_data_block + first * blocks_per_group
+      if _ExtGroupHasSuper(first, feature_ro_compat):
+        location += 1
+      dev.seek(location * block_size)
+      gdt += dev.read(min(descs_per_block, ngroups - first) * desc_size)
+    if len(gdt) != ngroups * desc_size:
+      raise P2VError("%s: group descriptors are truncated" % device)
+
+    descs = []
+    metadata = []  # (first block, number of blocks) of every group's metadata
+    for group in range(ngroups):
+      desc = gdt[group * desc_size:(group + 1) * desc_size]
+      block_bitmap, inode_bitmap, inode_table = struct.unpack("<III",
+                                                              desc[:12])
+      flags = struct.unpack("<H", desc[0x12:0x14])[0]
+      if desc_size >= 64:
+        hi = struct.unpack("<III", desc[0x20:0x2C])
+        block_bitmap |= hi[0] << 32
+        inode_bitmap |= hi[1] << 32
+        inode_table |= hi[2] << 32
+      descs.append((block_bitmap, flags))
+      metadata.extend([(block_bitmap, 1), (inode_bitmap, 1),
+                       (inode_table, inode_table_blocks)])
+
+    extents = []
+    if first_data_block:
+      _AddExtent(extents, 0, first_data_block)  # boot block
+
+    for group in range(ngroups):
+      group_start = first_data_block + group * blocks_per_group
+      group_blocks = min(blocks_per_group, blocks_count - group_start)
+      block_bitmap, flags = descs[group]
+
+      if uninit_allowed and flags & _EXT_BG_BLOCK_UNINIT:
+        used = []
+        has_super = _ExtGroupHasSuper(group, feature_ro_compat)
+        if has_super and feature_incompat & _EXT_FEATURE_INCOMPAT_META_BG:
+          used.append((group_start, 1 + first_meta_bg))
+        elif has_super:
+          used.append((group_start, 1 + gdt_blocks + reserved_gdt_blocks))
+        # The first, second and last group of a meta group hold a copy of its
+        # descriptor block
+        if (group >= flat_groups and
+            group % descs_per_block in [0, 1, descs_per_block - 1]):
+          used.append((group_start + int(has_super), 1))
+        for start, count in metadata:
+          if group_start <= start < group_start + group_blocks:
+            used.append((start, min(count, group_start + group_blocks - start)))
+        used.sort()
+        for start, count in used:
+          _AddExtent(extents, start, count)
+        continue
+
+      dev.seek(block_bitmap * block_size)
+      bitmap = dev.read((group_blocks + 7) / 8)
+      for match in re.finditer("\xff+|[^\x00\xff]", bitmap):
+        pos = match.start()
+        if match.group()[0] == "\xff":
+          first = pos * 8
+          count = min(len(match.group()) * 8, group_blocks - first)
+          _AddExtent(extents, group_start + first, count)
+        else:
+          byte = ord(match.group())
+          for bit in range(8):
+            if byte & (1 << bit) and pos * 8 + bit < group_blocks:
+              _AddExtent(extents, group_start + pos * 8 + bit, 1)
+  finally:
+    dev.close()
 
+  return block_size, blocks_count, extents
+
+
+def _ExtGroupHasSuper(group, feature_ro_compat):
+  """Whether an ext block group holds a copy of the superblock.
+
+  With the sparse_super feature, only groups 0, 1 and powers of 3, 5 and 7
+  have one; otherwise every group does.
+
+  """
+  if group <= 1 or not feature_ro_compat & _EXT_FEATURE_RO_COMPAT_SPARSE_SUPER:
+    return True
+  for base in [3, 5, 7]:
+    power = base
+    while power < group:
+      power *= base
+    if power == group:
+      return True
+  return False
+
+
+def _AddExtent(extents, start, count):
+  """Append a run of blocks to a sorted list, merging adjacent runs."""
+  if count <= 0:
+    return
+  if extents:
+    last_start, last_count = extents[-1]
+    if last_start + last_count >= start:
+      extents[-1] = (last_start, max(last_count, start + count - last_start))
+      return
+  extents.append((start, count))
+
+
+def _ExtentStream(source, extents, block_size):
+  """Generate the data sent to _EXTENT_WRITER for a list of extents.
+
+  @type source: file
+  @param source: File to read the extents from.
+  @type extents: list
+  @param extents: List of (first block, number of blocks) tuples.
+  @type block_size: int
+  @param block_size: Size of a block in bytes.
+  @return: Generator of strings, which together form the stream.
+
+  """
+  for start, count in extents:
+    offset = start * block_size
+    length = count * block_size
+    yield struct.pack(">QQ", offset, length)
+    source.seek(offset)
+    while length:
+      data = source.read(min(length, _STREAM_BUFFER_BYTES))
+      if not data:
+        raise P2VError("Unexpected end of source device at offset %d" %
+                       source.tell())
+      length -= len(data)
+      yield data
+  yield struct.pack(">QQ", 0, 0)
+
+
+def HashSourceFiles(index, max_threads=_HASH_THREADS, cancelled=None,
+                    excluded=None):
+  """Compute the SHA-1 digest of every regular file on the source filesystems.
+
+  This reads all the source data a second time. The parts of the index are
+  hashed in parallel by sha1sum processes at idle I/O priority, so that they
+  only use the disks when the transfer leaves them idle. Files with a
+  backslash or a newline in their path are left out, as sha1sum escapes those
+  names in its output.
+
+  @type index: L{SourceIndex}
+  @param index: The files on the source filesystems.
+  @type max_threads: int
+  @param max_threads: Maximum number of parts of the index to hash at once.
+  @type cancelled: threading.Event
+  @param cancelled: If given, hashing is abandoned once it is set.
+  @type excluded: list
+  @param excluded: Paths, from the root of the source machine, of files that
+    are not transferred, and so not hashed.
+  @rtype: dict
+  @return: Hex digests by path relative to /source, starting with "./" like
+    the output of find.
+  @raise P2VError: Hashing was abandoned.
+
+  """
+  lock = threading.Lock()
+  digests = {}
+  skip_paths = set(excluded or [])
+
+  def _HashPart(part):
+    paths = []
+    for entry in index.Entries(part):
+      if (not stat.S_ISREG(entry.st_mode) or "\\" in entry.path or
+          "\n" in entry.path):
+        continue
+      if skip_paths and (entry.path in skip_paths or
+                         [path for path in _ParentDirs(entry.path)
+                          if path in skip_paths]):
+        continue
+      paths.append("." + entry.path)
+    found = {}
+    for start in range(0, len(paths), _HASH_FILES_PER_COMMAND):
+      if cancelled and cancelled.isSet():
+        raise P2VError("cancelled")
+      found.update(_HashFiles(paths[start:start + _HASH_FILES_PER_COMMAND]))
+    lock.acquire()
+    try:
+      digests.update(found)
+    finally:
+      lock.release()
+
+  for _, error in _RunInThreads(_HashPart, range(len(index.parts)),
+                                max_threads):
+    if error:
+      raise P2VError("Could not hash the source files: %s" % error)
+  return digests
+
+
+def _HashFiles(paths):
+  """Compute the SHA-1 digests of source files with sha1sum.
+
+  @type paths: list
+  @param paths: Paths relative to /source, starting with "./".
+  @rtype: dict
+  @return: Hex digests by path. Files that couldn't be read are missing.
+  @raise P2VError: sha1sum could not be run.
+
+  """
+  devnull = open(os.devnull, "w")
+  try:
+    try:
+      proc = subprocess.Popen(_HASH_IO_PRIORITY + ["sha1sum", "--"] + paths,
+                              cwd=SOURCE_MOUNT, stdout=subprocess.PIPE,
+                              stderr=devnull)
+    except OSError, e:
+      raise P2VError("Could not run sha1sum: %s" % e)
+    out, _ = proc.communicate()
+  finally:
+    devnull.close()
+  # sha1sum exits with 1 when some files couldn't be read
+  if proc.returncode not in [0, 1]:
+    raise P2VError("sha1sum failed with exit status %d" % proc.returncode)
+  return _ParseDigests(out)
+
+
+def _ParseDigests(output):
+  """Read the digests printed by sha1sum, by path.
+
+  Names sha1sum escaped start with a backslash, and are left out, as those
+  files aren't hashed on the source.
+
+  """
+  digests = {}
+  for line in output.splitlines():
+    if len(line) > 42 and not line.startswith("\\"):
+      digests[line[42:]] = line[:40]
+  return digests
+
+
+def VerifyTransfer(client, user, host, keyfile, source_digests,
+                   rsync_args=None, journal=None, limiter=None):
+  """Check that the files on the instance match those on the source.
+
+  The files under /target are hashed on the instance, and only their digests
+  are sent back to be compared with those of L{HashSourceFiles}. Files that
+  differ or are missing are sent again with rsync, comparing their contents
+  rather than their sizes and times, and are then checked once more.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
   @type user: str
-  @param user: Username to use for connection.
+  @param user: Username to use for rsync.
   @type host: str
-  @param host: Hostname of instance to connect to.
+  @param host: Hostname of the instance.
+  @type keyfile: str
+  @param keyfile: Filename of the private key to authenticate with.
+  @type source_digests: dict
+  @param source_digests: Digests of the source files, as returned by
+    L{HashSourceFiles}.
+  @type rsync_args: list
+  @param rsync_args: Additional rsync arguments, as for L{TransferFiles}.
+  @type journal: L{CheckpointJournal}
+  @param journal: If given, nothing is done if it records that this was
+    already done, and it is recorded when done.
+  @type limiter: L{BandwidthLimiter}
+  @param limiter: If given, the files are sent again within the bandwidth
+    limit in force at the time.
+  @rtype: int
+  @return: Number of files that were sent again.
+  @raise P2VError: Files still differ after being sent again.
 
   """
-  DisplayCommandStart("Transferring files. This will take a while...")
+  if journal and journal.IsDone("verified"):
+    return 0
+  if rsync_args is None:
+    rsync_args = ["-z"]
+
+  DisplayCommandStart("Verifying %d files..." % len(source_digests))
+  mismatched = _DifferingFiles(source_digests,
+                               _HashTargetFiles(client,
+                                                sorted(source_digests)))
+  if mismatched:
+    DisplayCommandProgress("%d files differ, sending them again" %
+                           len(mismatched))
+    list_file = tempfile.NamedTemporaryFile()
+    try:
+      list_file.write("\0".join(mismatched))
+      list_file.flush()
+      errcode = subprocess.call(["rsync", "-aHAXS", "-c", "--from0",
+                                 "--files-from=%s" % list_file.name] +
+                                rsync_args + _RsyncLimitArgs(limiter) +
+                                ["-e", "ssh -i %s" % keyfile,
+                                 "%s/" % SOURCE_MOUNT,
+                                 "%s@%s:%s" % (user, host, TARGET_MOUNT)])
+    finally:
+      list_file.close()
+    if errcode:
+      raise P2VError("Error using rsync to send differing files again")
+
+    still_mismatched = _DifferingFiles(source_digests,
+                                       _HashTargetFiles(client, mismatched),
+                                       mismatched)
+    if still_mismatched:
+      raise P2VError("%d files on the instance differ from the source:\n%s" %
+                     (len(still_mismatched),
+                      "\n".join(still_mismatched[:_MAX_REPORTED_MISMATCHES])))
+    DisplayCommandEnd("done, %d files sent again" % len(mismatched))
+  else:
+    DisplayCommandEnd("done")
+  if journal:
+    journal.MarkDone("verified")
+  return len(mismatched)
 
-  errcode = subprocess.call(["rsync", "-aHAXz", "-e", "ssh -i %s" % keyfile,
-                             "%s/" % SOURCE_MOUNT,
-                             "%s@%s:%s" % (user, host, TARGET_MOUNT)])
-  if errcode:
-    print "Error using rsync to transfer files"
-    sys.exit(1)
 
+def _HashTargetFiles(client, paths):
+  """Compute the SHA-1 digests of files on the instance.
+
+  The files are hashed by as many sha1sum processes at once as the instance
+  has processors.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type paths: list
+  @param paths: Paths relative to /target of the files to hash, starting
+    with "./", as hashed on the source.
+  @rtype: dict
+  @return: Hex digests by path, in the format of L{HashSourceFiles}. Files
+    that couldn't be read are missing.
+  @raise P2VError: The files could not be hashed.
+
+  """
+  command = ("cd %s && xargs -0 -r -n %d -P $(grep -c ^processor"
+             " /proc/cpuinfo) sha1sum 2>/dev/null" %
+             (TARGET_MOUNT, _HASH_FILES_PER_COMMAND))
+  stdin, stdout, stderr = client.exec_command(command)
+
+  # Sent while the output is read, as sha1sum stops taking paths once its
+  # output isn't read
+  def _SendPaths():
+    try:
+      if paths:
+        stdin.channel.sendall("\0".join(paths))
+      stdin.channel.shutdown_write()
+    except (socket.error, EOFError):
+      pass  # xargs stopped reading; its exit status tells why
+
+  sender = threading.Thread(target=_SendPaths)
+  sender.setDaemon(True)
+  sender.start()
+  try:
+    out, _ = _WaitForCompletion(stdout.channel)
+  finally:
+    sender.join()
+  # xargs exits with 123 when some files couldn't be read
+  if stdout.channel.recv_exit_status() not in [0, 123]:
+    raise P2VError("Could not compute checksums of the files on the"
+                   " instance")
+
+  return _ParseDigests(out)
+
+
+def _DifferingFiles(source_digests, target_digests, paths=None):
+  """List the files whose digests on the instance differ from the source.
+
+  @type paths: list
+  @param paths: Paths to compare. Defaults to all the source files.
+  @rtype: list
+  @return: Sorted paths of the files that differ or are missing.
+
+  """
+  if paths is None:
+    paths = source_digests.keys()
+  return sorted([path for path in paths
+                 if target_digests.get(path) != source_digests[path]])
+
+
+def SeedFromChunkCache(client, cache, journal=None, excluded=None):
+  """Copy the data already in the chunk cache to the instance.
+
+  The source files are read and split into chunks, and a manifest of their
+  SHA-1 digests is sent to the instance, which fetches the chunks the cache
+  has directly from the cache. Files whose chunks are all found are complete,
+  and are skipped by rsync. The chunks that weren't found are recorded on the
+  instance, for L{FillChunkCache}.
+
+  The cache is only an optimization, so problems reaching it are reported
+  and otherwise ignored.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type cache: str
+  @param cache: user@host of the chunk cache.
+  @type journal: L{CheckpointJournal}
+  @param journal: If given, nothing is done if it records that this was
+    already done, and it is recorded when done.
+  @type excluded: list
+  @param excluded: Paths, from the root of the source machine, of files that
+    are not transferred, and so not fetched either.
+
+  """
+  if journal and journal.IsDone("seeded"):
+    return
+
+  DisplayCommandStart("Fetching data from the chunk cache...")
+  stdin, stdout, stderr = client.exec_command(_ChunkClientCommand("seed",
+                                                                  cache))
+  skip_paths = set([SOURCE_MOUNT + path for path in excluded or []])
+  for record in _ChunkManifest(SOURCE_MOUNT, skip_paths=skip_paths):
+    stdin.channel.sendall(record)
+  stdin.channel.shutdown_write()
+  out, err = _WaitForCompletion(stdout.channel)
+  if stdout.channel.recv_exit_status() != 0:
+    DisplayCommandEnd("failed, sending everything from this machine: %s" %
+                      err.strip())
+    return
+  if journal:
+    journal.MarkDone("seeded")
+  DisplayCommandEnd("done, %s" % out.strip())
+
+
+def FillChunkCache(client, cache, journal=None):
+  """Add the chunks the cache was missing to it, once they are on the instance.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type cache: str
+  @param cache: user@host of the chunk cache.
+  @type journal: L{CheckpointJournal}
+  @param journal: If given, nothing is done if it records that this was
+    already done, and it is recorded when done.
+
+  """
+  if journal and journal.IsDone("cache_filled"):
+    return
+
+  DisplayCommandStart("Adding new data to the chunk cache...")
+  stdin, stdout, stderr = client.exec_command(_ChunkClientCommand("fill",
+                                                                  cache))
+  out, err = _WaitForCompletion(stdout.channel)
+  if stdout.channel.recv_exit_status() != 0:
+    DisplayCommandEnd("failed: %s" % err.strip())
+    return
+  if journal:
+    journal.MarkDone("cache_filled")
+  DisplayCommandEnd("done, %s" % out.strip())
+
+
+def _ChunkClientCommand(mode, cache):
+  """Build the command that runs _CHUNK_CLIENT on the instance."""
+  store = ("ssh -i %s -o BatchMode=yes %s p2v_chunk_store.py" %
+           (_CHUNK_STORE_KEY, cache))
+  return "python -c '%s' %s '%s' %s %s %d" % (_CHUNK_CLIENT, mode, store,
+                                              JOURNAL_DIR, TARGET_MOUNT,
+                                              _DEDUP_CHUNK_BYTES)
+
+
+def _ChunkManifest(root, chunk_bytes=_DEDUP_CHUNK_BYTES,
+                   min_bytes=_DEDUP_MIN_FILE_BYTES, skip_paths=()):
+  """Generate the manifest of the files under root for the chunk cache.
+
+  Each file gets a record of its path relative to root, its size, its mtime
+  and the SHA-1 digests of its chunks. Small files and files with several
+  hard links are left out.
+
+  @type root: str
+  @param root: Directory to list.
+  @type chunk_bytes: int
+  @param chunk_bytes: Size of the chunks.
+  @type min_bytes: int
+  @param min_bytes: Size of the smallest file to include.
+  @type skip_paths: set
+  @param skip_paths: Paths of files and directories to leave out.
+  @rtype: generator
+  @return: Generator of the records, as strings.
+
+  """
+  for dirpath, dirnames, filenames in os.walk(root):
+    dirnames[:] = sorted([name for name in dirnames
+                          if os.path.join(dirpath, name) not in skip_paths])
+    for name in sorted(filenames):
+      path = os.path.join(dirpath, name)
+      if path in skip_paths:
+        continue
+      try:
+        stats = os.lstat(path)
+        if (not stat.S_ISREG(stats.st_mode) or stats.st_nlink > 1 or
+            stats.st_size < min_bytes):
+          continue
+        digests = []
+        source = open(path, "rb")
+        try:
+          while True:
+            chunk = source.read(chunk_bytes)
+            if not chunk:
+              break
+            digests.append(hashlib.sha1(chunk).digest())
+        finally:
+          source.close()
+      except (IOError, OSError):
+        continue  # rsync will report it
+      relpath = os.path.relpath(path, root)
+      yield (struct.pack(">I", len(relpath)) + relpath +
+             struct.pack(">QdI", stats.st_size, stats.st_mtime,
+                         len(digests)) +
+             "".join(digests))
+
+
+def GetSourceUsage(fs_devs):
+  """Measure the data on the mounted source filesystems.
+
+  @type fs_devs: list
+  @param fs_devs: List of (device, mount point) tuples, as returned by
+    MountSourceFilesystems.
+  @rtype: (int, int)
+  @return: Bytes and inodes in use.
+
+  """
+  used_bytes = 0
+  used_files = 0
+  for _, mount_point in fs_devs:
+    src = _SourcePath(mount_point)
+    if src != SOURCE_MOUNT and not os.path.ismount(src):
+      continue
+    stats = os.statvfs(src)
+    used_bytes += (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+    used_files += stats.f_files - stats.f_ffree
+  return used_bytes, used_files
+
+
+def StartTargetUsageMonitor(client, progress, layout=None):
+  """Start reporting the progress of rsync from the space used on /target.
+
+  @type layout: list
+  @param layout: Partitions of the instance, as from L{PlanLayout}, if it has
+    one for each source filesystem. The space used on all of them is added
+    up.
+  @rtype: L{TargetUsageMonitor}
+  @return: The running monitor. Call its Stop method once rsync is done.
+
+  """
+  paths = None
+  if layout:
+    paths = [TARGET_MOUNT + mount_point.rstrip("/")
+             for _, mount_point, _, _ in layout]
+  monitor = TargetUsageMonitor(client, progress, paths)
+  monitor.start()
+  return monitor
+
+
+def _ReadCpuTimes():
+  """Return the (busy, total) CPU time of this machine, in clock ticks.
+
+  @return: The times, or None if they can't be read.
+
+  """
+  try:
+    stat_file = open("/proc/stat", "r")
+    try:
+      fields = [int(x) for x in stat_file.readline().split()[1:]]
+    finally:
+      stat_file.close()
+  except (IOError, ValueError):
+    return None
+  if len(fields) < 4:
+    return None
+  idle = fields[3]
+  if len(fields) > 4:
+    idle += fields[4]  # iowait
+  return sum(fields) - idle, sum(fields)
+
+
+def _SampleResources():
+  """Measure the resources used so far on the source machine.
+
+  @rtype: dict
+  @return: CPU seconds used by this process and by the commands it has run,
+    bytes read from physical disks, and bytes sent and received on network
+    interfaces other than loopback. Values that can't be read are None.
+
+  """
+  times = os.times()
+  sample = {
+    "cpu_user": times[0],
+    "cpu_system": times[1],
+    "children_user": times[2],
+    "children_system": times[3],
+    "disk_read_bytes": None,
+    "net_sent_bytes": None,
+    "net_received_bytes": None,
+    }
+
+  try:
+    read_bytes = 0
+    for name in os.listdir("/sys/block"):
+      # Only physical disks, as partitions, RAID and device mapper devices
+      # would count the same reads again
+      if not os.path.exists("/sys/block/%s/device" % name):
+        continue
+      stat_file = open("/sys/block/%s/stat" % name, "r")
+      try:
+        read_bytes += int(stat_file.read().split()[2]) * 512
+      finally:
+        stat_file.close()
+    sample["disk_read_bytes"] = read_bytes
+  except (EnvironmentError, ValueError, IndexError):
+    pass
+
+  try:
+    net_file = open("/proc/net/dev", "r")
+    try:
+      lines = net_file.readlines()[2:]
+    finally:
+      net_file.close()
+    received = sent = 0
+    for line in lines:
+      name, counters = line.split(":", 1)
+      if name.strip() == "lo":
+        continue
+      counters = counters.split()
+      received += int(counters[0])
+      sent += int(counters[8])
+    sample["net_received_bytes"] = received
+    sample["net_sent_bytes"] = sent
+  except (EnvironmentError, ValueError, IndexError):
+    pass
+
+  return sample
+
+
+def _FormatBytes(nbytes):
+  """Format a number of bytes for people to read."""
+  for unit in ["bytes", "KB", "MB", "GB"]:
+    if abs(nbytes) < 1024:
+      break
+    nbytes /= 1024.0
+  else:
+    unit = "TB"
+  if unit == "bytes":
+    return "%d %s" % (nbytes, unit)
+  return "%.1f %s" % (nbytes, unit)
+
+
+def _FormatDuration(seconds):
+  """Format a number of seconds as H:MM:SS."""
+  minutes, seconds = divmod(int(seconds), 60)
+  hours, minutes = divmod(minutes, 60)
+  return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+def _RunPhase(reporter, phase_name, func, *args, **kwargs):
+  """Run one step of the transfer, recording how long it takes.
+
+  @type reporter: L{ProgressReporter}
+  @param reporter: Where to record the step.
+  @type phase_name: str
+  @param phase_name: Name of the step.
+  @param func: Function carrying out the step, called with the remaining
+    arguments.
+  @return: The return value of func.
+
+  """
+  reporter.StartPhase(phase_name)
+  try:
+    result = func(*args, **kwargs)
+  except:
+    reporter.EndPhase(phase_name, "failed")
+    raise
+  reporter.EndPhase(phase_name)
+  return result
+
+
+def OpenJournal(client, host, root_dev, resume):
+  """Open the checkpoint journal for this transfer.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type host: str
+  @param host: Hostname of the instance.
+  @type root_dev: str
+  @param root_dev: Device holding the root filesystem of the source OS.
+  @type resume: bool
+  @param resume: Whether to continue from the journal of an earlier run,
+    rather than starting a new one.
+  @rtype: L{CheckpointJournal}
+  @return: The opened journal.
+
+  """
+  journal = CheckpointJournal(os.path.join(JOURNAL_DIR, "%s.journal" % host),
+                              "p2v-transfer %s %s" % (root_dev, host),
+                              client=client,
+                              remote_path=os.path.join(JOURNAL_DIR, "journal"))
+  if resume:
+    journal.Load()
+  else:
+    journal.Reset()
+  return journal
+
+
+def _LayoutFromJournal(journal):
+  """Get the partitions recorded by an earlier run with --layout=mirror.
+
+  @type journal: L{CheckpointJournal}
+  @param journal: The journal of the earlier run.
+  @rtype: list
+  @return: List of (partition number, mount point, filesystem type, None)
+    tuples, as from L{PlanLayout} but without sizes.
+
+  """
+  layout = []
+  for value in journal.Values("layout"):
+    number, fs_type, mount_point = value.split(" ", 2)
+    layout.append((int(number), mount_point, fs_type, None))
+  return layout
+
+
+def MountTargetFilesystem(client, target_hd, layout=None):
+  """Mount the root partition of the instance on /target.
+
+  Used when resuming a transfer, since the partition was already created and
+  formatted by the earlier run.
+
+  @type client: paramiko.SSHClient
+  @param client: SSH client object used to connect to the instance.
+  @type target_hd: str
+  @param target_hd: Device file for the instance hard drive.
+  @type layout: list
+  @param layout: The partitions made by the earlier run, as returned by
+    L{PlanLayout}, or None for a single partition.
+
+  """
+  DisplayCommandStart("Mounting target filesystem from earlier run...")
+  if layout:
+    _RunCommandAndWait(client, " && ".join(_MountLayoutCommands(target_hd,
+                                                                layout)))
+  else:
+    _RunCommandAndWait(client, "mkdir -p %s && mount %s1 %s" %
+                       (TARGET_MOUNT, target_hd, TARGET_MOUNT))
   DisplayCommandEnd("done")
 
 
@@ -499,39 +5527,48 @@ def RunFixScripts(client):
 
   """
   DisplayCommandStart("Running fix scripts...")
-  _RunCommandAndWait(client, "run-parts /usr/lib/ganeti/fixes")
+  _RunCommandAndWait(client, "run-parts /usr/lib/ganeti/fixes", stream=True)
   DisplayCommandEnd("done")
 
 
-def UnmountSourceFilesystems(fs_devs):
+def UnmountSourceFilesystems():
   """Undo mounts performed by MountSourceFilesystems.
 
-  Unmounts all filesystems mounted by MountSourceFilesystems. Retries a couple
-  of times in case the filesystem is busy the first time.
-
-  @type fs_devs: list
-  @param fs_devs: List of (device, mount point) tuples.
+  Unmounts exactly the filesystems MountSourceFilesystems mounted, each once
+  the ones mounted on it are, in parallel where they don't depend on each
+  other. Retries a couple of times in case the filesystem is busy the first
+  time.
 
   """
-  for _, mount in reversed(fs_devs):
-    if mount == "/":
-      mount = SOURCE_MOUNT
-    elif mount[0] == os.sep:
-      mount = SOURCE_MOUNT + mount
-    else:
-      mount = SOURCE_MOUNT + os.sep + mount
+  _source_mounts_lock.acquire()
+  try:
+    paths = sorted(_source_mounts)
+  finally:
+    _source_mounts_lock.release()
+  failed = []
 
-    if os.path.exists(mount) and os.path.ismount(mount):
-      succeeded = False
+  def _Unmount(path):
+    if os.path.exists(path) and os.path.ismount(path):
       for trynum in range(3):
-        errcode = subprocess.call(["umount", mount])
+        errcode = subprocess.call(["umount", path])
         if not errcode:
-          succeeded = True
           break
         time.sleep(0.5)
-      if not succeeded:
-        print "Error unmounting %s" % mount
-        sys.exit(1)
+      else:
+        failed.append(path)
+        return
+    _RecordSourceMount(path, False)
+
+  steps = PhaseScheduler(None, _MOUNT_THREADS)
+  for path in sorted(paths, key=_PathDepth, reverse=True):
+    steps.Add(path, _MountStep(_Unmount, path),
+              [child for child in paths if _ParentMount(child, paths) == path])
+  steps.Wait(paths)
+
+  if failed:
+    for path in sorted(failed):
+      print "Error unmounting %s" % path
+    sys.exit(1)
 
 
 def CleanUpTarget(client):
@@ -545,27 +5582,60 @@ def CleanUpTarget(client):
   @param client: SSH client object used to connect to the instance.
 
   """
+  # Filesystems mounted below /target are unmounted first
   try:
-    _RunCommandAndWait(client, "umount %s ; rmdir %s" % (TARGET_MOUNT,
-                                                         TARGET_MOUNT))
+    _RunCommandAndWait(client, "umount $(awk '$2 ~ \"^%s(/|$)\""
+                       " {print $2}' /proc/mounts | sort -r) ; rmdir %s" %
+                       (TARGET_MOUNT, TARGET_MOUNT))
   except P2VError, e:
     # many things can make this complain, so don't crash because everything
     # might actually be ok
     print e
 
 
+# Set in threads of a PhaseScheduler. Their messages are only shown a whole
+# line at a time, so that those of steps running at once don't get mixed up.
+_display = threading.local()
+_display_lock = threading.Lock()
+
+
 def DisplayCommandStart(message):
   """Display a message that an action is beginning."""
+  if getattr(_display, "whole_lines", False):
+    _display.started = message
+    return
   print message,
   sys.stdout.flush()
 
 
 def DisplayCommandEnd(message):
   """Display a message that an action has completed."""
+  if getattr(_display, "whole_lines", False):
+    _DisplayLine("%s %s" % (getattr(_display, "started", ""), message))
+    return
   print message
 
 
-def FindTargetHardDrive(client):
+def DisplayCommandProgress(message):
+  """Display an update on an action that is still running."""
+  if getattr(_display, "whole_lines", False):
+    _DisplayLine("%s %s" % (getattr(_display, "started", ""), message))
+    return
+  print
+  print " ", message,
+  sys.stdout.flush()
+
+
+def _DisplayLine(line):
+  _display_lock.acquire()
+  try:
+    sys.stdout.write(line.strip() + "\n")
+    sys.stdout.flush()
+  finally:
+    _display_lock.release()
+
+
+def FindTargetHardDrive(client, inventory=None):
   """Find the name of the first hard drive on the target machine.
 
   Tries, in order, /dev/{xvda,vda,sda} and returns the first one that exists on
@@ -573,13 +5643,20 @@ def FindTargetHardDrive(client):
 
   @type client: paramiko.SSHClient
   @param client: SSH client object used to connect to the instance
+  @type inventory: dict
+  @param inventory: Result of L{GetTargetInventory}, if already known.
   @rtype: str
   @return: name of the hard drive device to install onto
 
   """
-  for hd in ["/dev/xvda", "/dev/vda", "/dev/sda"]:
+  if inventory:
+    if inventory["disks"]:
+      return inventory["disks"][0][0]
+    raise P2VError("Could not locate a hard drive on the target.")
+
+  for hd in _TARGET_DISKS:
     stdin, stdout, stderr = client.exec_command("test -b %s" % hd)
-    _WaitForCompletion(stdout.channel)
+    _WaitForCompletion(stdout.channel, timeout=_PROBE_TIMEOUT)
     if stdout.channel.recv_exit_status() == 0:
       return hd
   raise P2VError("Could not locate a hard drive on the target.")
@@ -589,6 +5666,9 @@ def main(argv):
   client = None
   uid = None
   fs_devs = []
+  progress = None
+  phases = None
+  succeeded = False
 
   try:
     try:
@@ -600,28 +5680,263 @@ def main(argv):
       if uid != 0:
         raise P2VError("Must be run as root")
 
-      key = LoadSSHKey(keyfile)
-      client = EstablishConnection(user, host, key)
-      fs_devs, swap_devs = MountSourceFilesystems(root_dev)
-      target_hd = FindTargetHardDrive(client)
-      if options.skip_kernel_check or VerifyKernelMatches(client):
-        total_megs, swap_megs = GetDiskSize(client, swap_devs, target_hd)
-        PartitionTargetDisks(client, total_megs, swap_megs, target_hd)
-        TransferFiles(user, host, keyfile)
-        RunFixScripts(client)
-        ShutDownTarget(client)
+      progress = ProgressReporter(options.progress_log,
+                                  profile=bool(options.profile))
+      limiter = BandwidthLimiter(options.bwlimit, options.bwlimit_schedule,
+                                 options.bwlimit_file)
+      required_tools = list(_REQUIRED_TOOLS)
+      if options.mode == "block":
+        required_tools.extend(_BLOCK_MODE_TOOLS)
+      if options.engine == "native":
+        required_tools.extend(_NATIVE_ENGINE_TOOLS)
+      if options.dedup_cache:
+        required_tools.extend(_DEDUP_TOOLS)
+      if options.batch_small_files:
+        required_tools.extend(_NATIVE_ENGINE_TOOLS)
+      if options.split_large_files:
+        required_tools.extend(_RANGE_TOOLS)
+
+      if options.dry_run:
+        fs_devs, _ = _RunPhase(progress, "mount_source",
+                               MountSourceFilesystems, root_dev,
+                               check=options.fsck)
+        index = _RunPhase(progress, "scan_source", ScanSource, fs_devs,
+                          _SCAN_THREADS, options.index_dir)
+        try:
+          ReportExclusions(_RunPhase(progress, "find_excluded",
+                                     FindExcludedFiles, index,
+                                     options.exclusions,
+                                     options.mode != "block"))
+        finally:
+          index.Close()
+        succeeded = True
+        return
+
+      # The final pass of --warm checks everything
+      verify = options.verify and not options.warm
+      if verify:
+        required_tools.extend(_VERIFY_TOOLS)
+
+      def _Connect(key):
+        client = EstablishConnection(user, host, key,
+                                     not options.auto_add_host_key)
+        if options.profile:
+          progress.TimeRemoteCommands(client)
+        return client
+
+      def _CheckKernel(client, _, inventory):
+        if not VerifyKernelMatches(client, inventory):
+          raise P2VError("Modules matching instance kernel not present on"
+                         " source OS. If your kernel does not use modules,"
+                         " you may want the --skip-kernel-check option.")
+
+      def _ScanSource(source):
+        try:
+          return ScanSource(source[0], _SCAN_THREADS, options.index_dir)
+        except (P2VError, EnvironmentError):
+          if (options.exclusions or verify or options.batch_small_files or
+              options.split_large_files):
+            raise
+          return None  # Measured again if the capacity check needs it
+
+      def _SourceUsage():
+        index = phases.Result("scan_source")
+        if index:
+          return index.Usage()
+        return _ScanUsage(fs_devs, _SCAN_THREADS, options.index_dir)
+
+      # The source is mounted and walked while the instance is examined
+      phases = PhaseScheduler(progress, _MAX_RUNNING_PHASES)
+      phases.Add("load_key", lambda: LoadSSHKey(keyfile))
+      phases.Add("connect", _Connect, ["load_key"])
+      phases.Add("mount_source",
+                 lambda: MountSourceFilesystems(root_dev, check=options.fsck))
+      phases.Add("inventory",
+                 lambda client: GetTargetInventory(client, required_tools),
+                 ["connect"])
+      phases.Add("find_disk", FindTargetHardDrive, ["connect", "inventory"])
+      journal_requires = ["connect"]
+      if not options.skip_kernel_check:
+        phases.Add("kernel_check", _CheckKernel,
+                   ["connect", "mount_source", "inventory"])
+        journal_requires.append("kernel_check")
+      phases.Add("journal",
+                 lambda client, *_: OpenJournal(client, host, root_dev,
+                                                options.resume),
+                 journal_requires)
+      phases.Add("disk_size",
+                 lambda client, source, target_hd, inventory:
+                   GetDiskSize(client, source[1], target_hd, inventory),
+                 ["connect", "mount_source", "find_disk", "inventory"])
+      phases.Add("scan_source", _ScanSource, ["mount_source"])
+      if options.exclusions:
+        # The root filesystem is copied whole in block mode
+        phases.Add("find_excluded",
+                   lambda index: FindExcludedFiles(index, options.exclusions,
+                                                   options.mode != "block"),
+                   ["scan_source"])
+      try:
+        phases.Wait(["journal", "disk_size"])
+      finally:
+        client = phases.Get("connect")
+        fs_devs, swap_devs = phases.Get("mount_source", ([], []))
+      inventory = phases.Result("inventory")
+      target_hd = phases.Result("find_disk")
+      journal = phases.Result("journal")
+      total_megs, swap_megs = phases.Result("disk_size")
+
+      layout = None
+      formatting = None
+      if journal.IsDone("partitioned"):
+        # The partitions are those of the earlier run, whatever is asked now
+        layout = _LayoutFromJournal(journal) or None
+        earlier_layout = layout and "mirror" or "single"
+        if options.layout and options.layout != earlier_layout:
+          raise P2VError("The earlier transfer used --layout=%s, so it can't"
+                         " be resumed with --layout=%s" %
+                         (earlier_layout, options.layout))
+        _RunPhase(progress, "mount_target", MountTargetFilesystem, client,
+                  target_hd, layout=layout)
+      elif options.mode == "block":
+        _RunPhase(progress, "partition", PartitionTargetDisks, client,
+                  total_megs, swap_megs, target_hd, make_fs=False)
+        _RunPhase(progress, "transfer_blocks", TransferBlocks, client,
+                  root_dev, target_hd, limiter=limiter, progress=progress)
+        journal.MarkDone("partitioned")
+      elif options.layout == "mirror":
+        layout = _RunPhase(progress, "plan_layout", PlanLayout, fs_devs,
+                           total_megs, swap_megs, inventory)
+        formatting = _RunPhase(progress, "partition", PartitionTargetDisks,
+                               client, total_megs, swap_megs, target_hd,
+                               layout=layout, wait=False,
+                               lazy_init=inventory["mkfs_lazy_init"])
+      else:
+        swap_megs = _RunPhase(progress, "capacity_check", PlanCapacity,
+                              fs_devs, total_megs, swap_megs,
+                              scan=_SourceUsage)
+        formatting = _RunPhase(progress, "partition", PartitionTargetDisks,
+                               client, total_megs, swap_megs, target_hd,
+                               wait=False,
+                               lazy_init=inventory["mkfs_lazy_init"])
+      if not options.parallel:
+        # One rsync for each partition
+        options.parallel = len(layout or [None])
+      # Sampled from the source while the instance disk is formatted
+      rsync_args = _RunPhase(progress, "choose_compression",
+                             ChooseCompression, client, options.compression,
+                             inventory)
+      if formatting:
+        _RunPhase(progress, "format", WaitForFormatting, formatting)
+        for number, mount_point, fs_type, _ in layout or []:
+          journal.MarkDone("layout %d %s %s" % (number, fs_type,
+                                                mount_point))
+        journal.MarkDone("partitioned")
+      # Listed once, for all the steps that look at every source file
+      index = phases.Result("scan_source")
+      excluded = []
+      if options.exclusions:
+        excluded = phases.Result("find_excluded")
+      excluded_paths = [path for path, _, _ in excluded]
+      if options.dedup_cache:
+        _RunPhase(progress, "dedup_seed", SeedFromChunkCache, client,
+                  options.dedup_cache, journal, excluded_paths)
+      # Once the source was walked, the files rsync lists are in the cache
+      phases.Stop()
+      used_bytes, used_files = GetSourceUsage(fs_devs)
+      progress.SetTotals(used_bytes - sum([nbytes for _, _, nbytes
+                                           in excluded]),
+                         used_files - len(excluded))
+      if verify and journal.IsDone("verified"):
+        verify = False
+      if verify:
+        # A second read of the source, hashed at idle I/O priority while the
+        # transfer runs rather than after it
+        phases.Add("hash_source",
+                   lambda: HashSourceFiles(index, _HASH_THREADS,
+                                           phases.cancelled, excluded_paths))
+        phases.Start()
+      monitor = StartTargetUsageMonitor(client, progress, layout)
+      try:
+        if options.batch_small_files:
+          # rsync then finds the small files up to date
+          _RunPhase(progress, "small_files", SendSmallFiles, client, index,
+                    options.batch_small_files * 1024, options.parallel,
+                    include_root=(options.mode != "block"), journal=journal,
+                    limiter=limiter,
+                    compress_level=_NativeCompressionLevel(rsync_args),
+                    progress=progress, excluded=excluded_paths)
+        if options.split_large_files:
+          _RunPhase(progress, "large_files", SendLargeFiles, client, index,
+                    options.split_large_files * 1024 * 1024,
+                    max(options.parallel, _RANGE_THREADS),
+                    include_root=(options.mode != "block"), journal=journal,
+                    limiter=limiter, excluded=excluded_paths)
+        if options.warm:
+          # Not journalled, so that the final pass copies everything again
+          _RunPhase(progress, "warm_transfer", TransferFiles, user, host,
+                    keyfile, fs_devs, options.parallel, options.split_dirs,
+                    rsync_args, limiter=limiter, excluded=excluded_paths,
+                    index=index)
+        elif options.engine == "native":
+          _RunPhase(progress, "transfer_files", TransferNative, client,
+                    fs_devs, options.parallel, options.split_dirs,
+                    include_root=(options.mode != "block"), journal=journal,
+                    limiter=limiter,
+                    compress_level=_NativeCompressionLevel(rsync_args),
+                    progress=progress, excluded=excluded_paths)
+        else:
+          _RunPhase(progress, "transfer_files", TransferFiles, user, host,
+                    keyfile, fs_devs, options.parallel, options.split_dirs,
+                    rsync_args, include_root=(options.mode != "block"),
+                    journal=journal, limiter=limiter, progress=progress,
+                    excluded=excluded_paths, index=index)
+      finally:
+        monitor.Stop()
+      if options.dedup_cache:
+        _RunPhase(progress, "dedup_fill", FillChunkCache, client,
+                  options.dedup_cache, journal)
+      if options.warm:
+        journal.MarkDone("warm")
+        # The copy on the instance is used by the final pass
+        journal.Remove()
+        succeeded = True
+        print ("Warm copy complete. Leave the instance running, boot this"
+               " machine into the transfer OS and run p2v_transfer.py again"
+               " with the same arguments and --resume to copy the changes"
+               " made since.")
+      else:
+        if verify:
+          _RunPhase(progress, "verify", VerifyTransfer, client, user, host,
+                    keyfile, phases.Result("hash_source"), rsync_args,
+                    journal, limiter)
+        _RunPhase(progress, "fix_scripts", RunFixScripts, client)
+        _RunPhase(progress, "shutdown", ShutDownTarget, client)
+        journal.Remove()
+        succeeded = True
         # If this succeeds, the client won't be useful anymore
         client = None
-      else:
-        raise P2VError("Modules matching instance kernel not present on source"
-                       " OS. If your kernel does not use modules, you may want"
-                       " the --skip-kernel-check option.")
     except P2VError, e:  # Print error message
       print e
       sys.exit(1)
   finally:
+    if phases:
+      # Nothing may be left using the source filesystems
+      phases.Stop(cancel=True)
+      if phases.Get("scan_source"):
+        phases.Get("scan_source").Close()
+    if progress:
+      progress.DisplaySummary()
+      if options.profile:
+        progress.WriteProfile(options.profile, {
+          "host": host,
+          "root_dev": root_dev,
+          "mode": options.mode,
+          "parallel": options.parallel,
+          "succeeded": succeeded,
+          })
+      progress.Close()
     if uid == 0:
-      UnmountSourceFilesystems(fs_devs)
+      UnmountSourceFilesystems()
     if client:
       CleanUpTarget(client)
 
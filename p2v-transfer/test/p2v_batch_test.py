@@ -0,0 +1,142 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Tests for p2v_batch."""
+
+
+import mox
+import os
+import shutil
+import tempfile
+import unittest
+
+import p2v_batch
+
+
+class P2vbatchTest(unittest.TestCase):
+  def setUp(self):
+    self.mox = mox.Mox()
+    self.module = p2v_batch
+    self.log_dir = tempfile.mkdtemp()
+
+    self.manifest_data = """
+# source    root dev   target       key on source       node
+web1 /dev/sda1 web1-vm /root/id_dsa node1
+web2 /dev/sda1 web2-vm /root/id_dsa node1
+db1 /dev/md0 db1-vm /root/id_dsa node2
+"""
+    self.opts = self.module.optparse.Values()
+    self.opts.ssh_key = None
+    self.opts.max_parallel = 4
+    self.opts.per_node = 1
+    self.opts.bandwidth = 30000
+    self.opts.log_dir = self.log_dir
+    self.opts.transfer_args = "--parallel 2"
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.mox.ResetAll()
+    shutil.rmtree(self.log_dir)
+
+  def _ExpectPoll(self, proc, status):
+    """Expect a poll of a mock process, which sets its exit status."""
+    def _SetStatus():
+      proc.returncode = status
+    proc.poll().WithSideEffects(_SetStatus).AndReturn(status)
+
+  def testParseManifestReadsLines(self):
+    migrations = self.module.ParseManifest(self.manifest_data)
+    self.assertEqual([(m.source, m.root_dev, m.target, m.keyfile, m.node)
+                      for m in migrations],
+                     [("web1", "/dev/sda1", "web1-vm", "/root/id_dsa",
+                       "node1"),
+                      ("web2", "/dev/sda1", "web2-vm", "/root/id_dsa",
+                       "node1"),
+                      ("db1", "/dev/md0", "db1-vm", "/root/id_dsa", "node2")])
+
+  def testParseManifestRejectsBadLines(self):
+    self.assertRaises(self.module.BatchError, self.module.ParseManifest,
+                      "web1 /dev/sda1 web1-vm\n")
+    self.assertRaises(self.module.BatchError, self.module.ParseManifest,
+                      "web1 /dev/sda1 web1-vm /root/id;rm node1\n")
+
+  def testBuildCommand(self):
+    migration = self.module.Migration("web1", "/dev/sda1", "web1-vm",
+                                      "/root/id_dsa", None)
+    command = self.module.BuildCommand(migration, "/root/admin_key", 10000,
+                                       ["--parallel", "2"])
+    self.assertEqual(command, ["ssh", "-o", "BatchMode=yes", "-i",
+                               "/root/admin_key", "root@web1",
+                               "p2v_transfer.py", "--auto-add-host-key",
+                               "--bwlimit=10000", "--parallel", "2",
+                               "/dev/sda1", "web1-vm", "/root/id_dsa"])
+
+  def testRunBatchRespectsPerNodeLimit(self):
+    self.mox.StubOutWithMock(self.module.subprocess, "Popen",
+                             use_mock_anything=True)
+    self.mox.StubOutWithMock(self.module.time, "sleep")
+    migrations = self.module.ParseManifest(self.manifest_data)
+    procs = [self.mox.CreateMockAnything() for _ in range(3)]
+
+    # Only three transfers, so the budget is split three ways; web2 has to
+    # wait for web1, which is on the same node
+    def _Expect(migration, proc):
+      command = self.module.BuildCommand(migration, None, 10000,
+                                         ["--parallel", "2"])
+      call = self.module.subprocess.Popen(command, stdin=mox.IgnoreArg(),
+                                          stdout=mox.IgnoreArg(),
+                                          stderr=self.module.subprocess.STDOUT)
+      call.AndReturn(proc)
+
+    _Expect(migrations[0], procs[0])
+    _Expect(migrations[2], procs[2])
+    self._ExpectPoll(procs[0], None)
+    self._ExpectPoll(procs[2], None)
+    self.module.time.sleep(self.module._POLL_INTERVAL)
+    self._ExpectPoll(procs[0], 0)
+    self._ExpectPoll(procs[2], None)
+    _Expect(migrations[1], procs[1])
+    self._ExpectPoll(procs[2], 1)
+    self._ExpectPoll(procs[1], None)
+    self._ExpectPoll(procs[1], 0)
+
+    self.mox.ReplayAll()
+    self.module.RunBatch(migrations, self.opts)
+    self.mox.VerifyAll()
+
+    self.assertEqual([m.status for m in migrations],
+                     ["done", "done", "failed"])
+    self.assertEqual(migrations[0].log_file,
+                     os.path.join(self.log_dir, "web1.log"))
+
+  def testFormatReport(self):
+    migrations = self.module.ParseManifest(self.manifest_data)
+    migrations[0].status = "done"
+    migrations[0].start_time = 100.0
+    migrations[0].end_time = 225.0
+    report = self.module.FormatReport(migrations)
+    lines = report.splitlines()
+    self.assertEqual(len(lines), 4)
+    self.assertEqual(lines[1].split(),
+                     ["web1", "web1-vm", "node1", "done", "2:05", "-"])
+    self.assertEqual(lines[3].split()[3], "pending")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -20,8 +20,16 @@
 """Tests for p2v_transfer."""
 
 
+import hashlib
 import mox
+import os
 import paramiko
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
 import types
 import unittest
 
@@ -55,6 +63,12 @@ class P2vtransferTest(unittest.TestCase):
 
     self.client = self.mox.CreateMock(paramiko.SSHClient)
     self.module = p2v_transfer
+    # One step at a time, so that calls are made in a predictable order
+    self.mox.stubs.Set(self.module, "_MAX_RUNNING_PHASES", 1)
+    self.mox.stubs.Set(self.module, "_MOUNT_THREADS", 1)
+    self.mox.stubs.Set(self.module, "_source_mounts", set())
+    self.mox.stubs.Set(self.module, "_block_devices",
+                       self.module.BlockDeviceIndex({}, {}))
 
     self.root_dev = "/dev/sda1"
     self.target_hd = "/dev/xvda"
@@ -72,6 +86,8 @@ class P2vtransferTest(unittest.TestCase):
     self.totsize = 102400
 
     self.fs_devs = [(self.root_dev, "/")]
+    self.inventory = {"disks": [(self.target_hd, 1 << 30)],
+                      "mkfs_lazy_init": False}
     self.swap_devs = ["/dev/sda5"]
 
     self.fstab_data = """
@@ -82,6 +98,28 @@ UUID=55555555-5555-5555-5555-555555555555 /usr ext3 defaults 0 2
 
     self.opts = self.module.optparse.Values()
     self.opts.skip_kernel_check = False
+    self.opts.fsck = False
+    self.opts.parallel = 1
+    self.opts.split_dirs = False
+    self.opts.compression = "zlib"
+    self.opts.mode = "file"
+    self.opts.resume = False
+    self.opts.bwlimit = 0
+    self.opts.bwlimit_schedule = []
+    self.opts.bwlimit_file = None
+    self.opts.progress_log = None
+    self.opts.profile = None
+    self.opts.warm = False
+    self.opts.engine = "rsync"
+    self.opts.dedup_cache = None
+    self.opts.layout = "single"
+    self.opts.verify = False
+    self.opts.exclusions = None
+    self.opts.dry_run = False
+    self.opts.batch_small_files = 0
+    self.opts.split_large_files = 0
+    self.opts.index_dir = None
+    self.opts.auto_add_host_key = False
 
   def _MockRunCommandAndWait(self, command, exit_status=0):
     stdin = _MockChannelFile(self.mox)
@@ -90,14 +128,33 @@ UUID=55555555-5555-5555-5555-555555555555 /usr ext3 defaults 0 2
     self.client.exec_command(command).AndReturn((stdin, stdout, stderr))
 
     # pretend the command is taking a few cycles
-    stdout.channel.exit_status_ready().AndReturn(False)
-    stdout.channel.exit_status_ready().AndReturn(False)
-    stdout.channel.exit_status_ready().AndReturn(True)
+    self._MockWaitForCompletion(stdout.channel)
     stdout.channel.recv_exit_status().AndReturn(exit_status)
 
     # return stdout in case we want to do something else with it
     return stdout
 
+  def _MockWaitForCompletion(self, channel, output=(), cycles=2):
+    """Expect _WaitForCompletion to wait for a few cycles.
+
+    Each string in output is returned from recv() in a separate cycle.
+
+    """
+    if type(self.module.select.select) == types.BuiltinFunctionType:
+      self.mox.StubOutWithMock(self.module.select, "select")
+    for cycle in range(max(cycles, len(output))):
+      channel.exit_status_ready().AndReturn(False)
+      if cycle < len(output):
+        channel.recv_ready().AndReturn(True)
+        channel.recv(mox.IgnoreArg()).AndReturn(output[cycle])
+      channel.recv_ready().AndReturn(False)
+      channel.recv_stderr_ready().AndReturn(False)
+      call = self.module.select.select([channel], [], [], mox.IgnoreArg())
+      call.AndReturn(([channel], [], []))
+    channel.exit_status_ready().AndReturn(True)
+    channel.recv_ready().AndReturn(False)
+    channel.recv_stderr_ready().AndReturn(False)
+
   def _MockSubprocessCallSuccess(self, command_list):
     if type(self.module.subprocess.call) == types.FunctionType:
       self.mox.StubOutWithMock(self.module.subprocess, "call")
@@ -124,10 +181,32 @@ UUID=55555555-5555-5555-5555-555555555555 /usr ext3 defaults 0 2
       "CleanUpTarget",
       "ParseFstab",
       "FindTargetHardDrive",
+      "ChooseCompression",
+      "OpenJournal",
+      "MountTargetFilesystem",
+      "GetTargetInventory",
+      "GetSourceUsage",
+      "StartTargetUsageMonitor",
+      "PlanCapacity",
+      "WaitForFormatting",
       ]
     for func in self.module_functions:
       self.mox.StubOutWithMock(self.module, func)
 
+  def _MockOpenJournal(self, done=()):
+    journal = self.mox.CreateMock(self.module.CheckpointJournal)
+    self.module.OpenJournal(self.client, self.host, self.root_dev,
+                            self.opts.resume).AndReturn(journal)
+    return journal
+
+  def _MockStartTargetUsageMonitor(self):
+    self.module.GetSourceUsage(self.fs_devs).AndReturn((1 << 30, 20000))
+    monitor = self.mox.CreateMock(self.module.TargetUsageMonitor)
+    call = self.module.StartTargetUsageMonitor(
+      self.client, mox.IsA(self.module.ProgressReporter), None)
+    call.AndReturn(monitor)
+    return monitor
+
   def tearDown(self):
     self.mox.UnsetStubs()
     self.mox.ResetAll()
@@ -144,12 +223,10 @@ UUID=55555555-5555-5555-5555-555555555555 /usr ext3 defaults 0 2
     uses self.totsize and self.swapsize to generate command outputs such that
     the returned values will be approximately self.totsize and self.swapsize.
     """
-    popen = self.mox.CreateMock(self.module.subprocess.Popen)
-    self.mox.StubOutWithMock(self.module.subprocess, "Popen",
-                             use_mock_anything=True)
-
     tot_bytes = self.totsize * 1024 * 1024
     swap_bytes = self.swapsize * 1024 * 1024
+    self.mox.stubs.Set(self.module, "_block_devices",
+                       self.module.BlockDeviceIndex({}, {"sda5": swap_bytes}))
 
     stdout = _MockChannelFile(self.mox)
     stdout._SetOutput(str(tot_bytes))
@@ -157,12 +234,6 @@ UUID=55555555-5555-5555-5555-555555555555 /usr ext3 defaults 0 2
     call = self.client.exec_command("blockdev --getsize64 /dev/xvda")
     call.AndReturn((None, stdout, None))
 
-    call = self.module.subprocess.Popen(["blockdev", "--getsize64",
-                                         self.swap_devs[0]],
-                                        stdout=self.module.subprocess.PIPE)
-    call.AndReturn(popen)
-    popen.communicate().AndReturn((str(swap_bytes), None))
-
     self.mox.ReplayAll()
     total, swap = self.module.GetDiskSize(self.client, self.swap_devs,
                                           self.target_hd)
@@ -179,12 +250,10 @@ UUID=55555555-5555-5555-5555-555555555555 /usr ext3 defaults 0 2
     """
     self.totsize = self.swapsize * 5
 
-    popen = self.mox.CreateMock(self.module.subprocess.Popen)
-    self.mox.StubOutWithMock(self.module.subprocess, "Popen",
-                             use_mock_anything=True)
-
     tot_bytes = self.totsize * 1024 * 1024
     swap_bytes = self.swapsize * 1024 * 1024
+    self.mox.stubs.Set(self.module, "_block_devices",
+                       self.module.BlockDeviceIndex({}, {"sda5": swap_bytes}))
 
     stdout = _MockChannelFile(self.mox)
     stdout._SetOutput(str(tot_bytes))
@@ -192,12 +261,6 @@ UUID=55555555-5555-5555-5555-555555555555 /usr ext3 defaults 0 2
     call = self.client.exec_command("blockdev --getsize64 /dev/xvda")
     call.AndReturn((None, stdout, None))
 
-    call = self.module.subprocess.Popen(["blockdev", "--getsize64",
-                                         self.swap_devs[0]],
-                                        stdout=self.module.subprocess.PIPE)
-    call.AndReturn(popen)
-    popen.communicate().AndReturn((str(swap_bytes), None))
-
     self.mox.ReplayAll()
     total, swap = self.module.GetDiskSize(self.client, self.swap_devs,
                                           self.target_hd)
@@ -207,6 +270,46 @@ UUID=55555555-5555-5555-5555-555555555555 /usr ext3 defaults 0 2
     self.assertNotEqual(swap, self.swapsize)
     self.mox.VerifyAll()
 
+  def testScanBlockDevicesFindsTagsAndSizes(self):
+    popen = self.mox.CreateMock(self.module.subprocess.Popen)
+    self.mox.StubOutWithMock(self.module.subprocess, "Popen",
+                             use_mock_anything=True)
+    call = self.module.subprocess.Popen(["blkid"],
+                                        stdout=self.module.subprocess.PIPE)
+    call.AndReturn(popen)
+    popen.communicate().AndReturn((
+      '/dev/sda1: LABEL="root" UUID="1111" TYPE="ext4" PARTUUID="aa-01"\n'
+      '/dev/mapper/vg-swap: UUID="2222" TYPE="swap"\n', None))
+
+    sys_block = tempfile.mkdtemp()
+    try:
+      for name, sectors in [("sda1", "2048"), ("dm-0", "4096")]:
+        os.mkdir(os.path.join(sys_block, name))
+        size_file = open(os.path.join(sys_block, name, "size"), "w")
+        size_file.write(sectors + "\n")
+        size_file.close()
+      self.mox.ReplayAll()
+      index = self.module.ScanBlockDevices(sys_block)
+      self.mox.VerifyAll()
+    finally:
+      shutil.rmtree(sys_block)
+
+    self.assertEqual(index.Resolve("LABEL=root"), "/dev/sda1")
+    self.assertEqual(index.Resolve("PARTUUID=aa-01"), "/dev/sda1")
+    self.assertEqual(index.Resolve("UUID=2222"), "/dev/mapper/vg-swap")
+    self.assertEqual(index.Resolve("UUID=3333"), None)
+    self.assertEqual(index.Resolve("/dev/sdb1"), "/dev/sdb1")
+    self.assertEqual(index.FsType("/dev/mapper/vg-swap"), "swap")
+    self.assertEqual(index.Size("/dev/sda1"), 1024 * 1024)
+
+  def testGetDeviceFileUsesIndex(self):
+    self.mox.stubs.Set(self.module, "_block_devices",
+                       self.module.BlockDeviceIndex(
+                         {"/dev/sda5": {"UUID": "2222"}}, {}))
+    self.assertEqual(self.module._GetDeviceFile("UUID=2222"), "/dev/sda5")
+    self.assertRaises(self.module.P2VError, self.module._GetDeviceFile,
+                      "LABEL=gone")
+
   def testPartitionTargetDisksSendsCommands(self):
     sfdisk_command = """sfdisk -uM /dev/xvda <<EOF
 0,%d,83
@@ -216,8 +319,10 @@ EOF
 
     self._MockRunCommandAndWait(sfdisk_command)
 
-    commands = ("mkfs.ext3 /dev/xvda1"
-                " && mkswap /dev/xvda2"
+    commands = ("{ { mkfs.ext3 -q /dev/xvda1; } & p0=$!;"
+                " { mkswap /dev/xvda2; } & p1=$!; failed=0;"
+                " for pid in $p0 $p1; do wait $pid || failed=1; done;"
+                " test $failed = 0; }"
                 " && mkdir -p %s"
                 " && mount /dev/xvda1 %s") % (self.module.TARGET_MOUNT,
                                               self.module.TARGET_MOUNT)
@@ -228,6 +333,116 @@ EOF
                                      self.target_hd)
     self.mox.VerifyAll()
 
+  def testPartitionTargetDisksMirrorsLayout(self):
+    layout = [(1, "/", "ext4", 40000), (3, "/var", "ext4", 30000),
+              (5, "/home", "ext3", 20000), (6, "/var/log", "ext2", 10000)]
+    sfdisk_command = """sfdisk -uM /dev/xvda <<EOF
+0,40000,83
+,%d,82
+,30000,83
+,,E
+,20000,83
+,,83
+EOF
+""" % self.swapsize
+    self._MockRunCommandAndWait(sfdisk_command)
+
+    target = self.module.TARGET_MOUNT
+    lazy_ext4 = "-E lazy_itable_init=1,lazy_journal_init=1"
+    commands = " && ".join([
+      "{ { mkfs.ext4 -q %s /dev/xvda1; } & p0=$!;"
+      " { mkfs.ext4 -q %s /dev/xvda3; } & p1=$!;"
+      " { mkfs.ext3 -q -E lazy_journal_init=1 /dev/xvda5; } & p2=$!;"
+      " { mkfs.ext2 -q /dev/xvda6; } & p3=$!;"
+      " { mkswap /dev/xvda2; } & p4=$!; failed=0;"
+      " for pid in $p0 $p1 $p2 $p3 $p4; do wait $pid || failed=1; done;"
+      " test $failed = 0; }" % (lazy_ext4, lazy_ext4),
+      "mkdir -p %s" % target,
+      "mount /dev/xvda1 %s" % target,
+      "mkdir -p %s/home" % target,
+      "mount /dev/xvda5 %s/home" % target,
+      "mkdir -p %s/var" % target,
+      "mount /dev/xvda3 %s/var" % target,
+      "mkdir -p %s/var/log" % target,
+      "mount /dev/xvda6 %s/var/log" % target,
+      ])
+    self._MockRunCommandAndWait(commands)
+
+    self.mox.ReplayAll()
+    self.module.PartitionTargetDisks(self.client, self.totsize, self.swapsize,
+                                     self.target_hd, layout=layout,
+                                     lazy_init=True)
+    self.mox.VerifyAll()
+
+  def testPartitionTargetDisksFormatsInBackground(self):
+    sfdisk_command = """sfdisk -uM /dev/xvda <<EOF
+0,%d,83
+,,82
+EOF
+""" % (self.totsize - self.swapsize)
+    self._MockRunCommandAndWait(sfdisk_command)
+
+    stdin = _MockChannelFile(self.mox)
+    stdout = _MockChannelFile(self.mox)
+    stderr = _MockChannelFile(self.mox)
+    self.client.exec_command(mox.StrContains(
+      "mkswap /dev/xvda2")).AndReturn((stdin, stdout, stderr))
+    self.mox.ReplayAll()
+    formatting = self.module.PartitionTargetDisks(
+      self.client, self.totsize, self.swapsize, self.target_hd, wait=False)
+    self.mox.VerifyAll()
+
+    # Only now is the format command waited for
+    self.mox.ResetAll()
+    self._MockWaitForCompletion(stdout.channel)
+    stdout.channel.recv_exit_status().AndReturn(1)
+    self.mox.ReplayAll()
+    self.assertRaises(self.module.P2VError, self.module.WaitForFormatting,
+                      formatting)
+    self.mox.VerifyAll()
+
+  def testPlanLayoutScalesFilesystems(self):
+    self.mox.StubOutWithMock(self.module.os, "statvfs")
+    self.mox.StubOutWithMock(self.module.os.path, "ismount")
+    self.mox.StubOutWithMock(self.module, "_MountedFilesystemTypes")
+    source = self.module.SOURCE_MOUNT
+    self.module._MountedFilesystemTypes().AndReturn(
+      {source: "ext4", source + "/var": "ext4", source + "/home": "ext2"})
+    # Sizes of 1000, 3000 and 1000 MB, with /home nearly full
+    for path, blocks, used in [(source + "/var", 768000, 25600),
+                               (source, 256000, 25600),
+                               (source + "/home", 256000, 230400)]:
+      if path != source:
+        self.module.os.path.ismount(path).AndReturn(True)
+      stats = self.mox.CreateMockAnything()
+      stats.f_frsize = 4096
+      stats.f_blocks = blocks
+      stats.f_bfree = blocks - used
+      stats.f_files = 100000
+      stats.f_ffree = 99000
+      self.module.os.statvfs(path).AndReturn(stats)
+
+    self.mox.ReplayAll()
+    inventory = {"tools": ["mkfs.ext3", "mkfs.ext4"]}
+    layout = self.module.PlanLayout([("/dev/sda2", "/var"),
+                                     ("/dev/sda1", "/"),
+                                     ("/dev/sda3", "/home")],
+                                    2600, 100, inventory)
+    self.mox.VerifyAll()
+
+    # /home needs 948 MB, and the other two share the rest, less 8 MB for the
+    # logical partition, 1:3. mkfs.ext2 is missing, so /home is made ext3.
+    self.assertEqual(layout, [(1, "/", "ext4", 386), (3, "/var", "ext4", 1158),
+                              (5, "/home", "ext3", 948)])
+
+  def testLayoutFromJournal(self):
+    journal = self.mox.CreateMock(self.module.CheckpointJournal)
+    journal.Values("layout").AndReturn(["1 ext4 /", "3 ext3 /var"])
+    self.mox.ReplayAll()
+    self.assertEqual(self.module._LayoutFromJournal(journal),
+                     [(1, "/", "ext4", None), (3, "/var", "ext3", None)])
+    self.mox.VerifyAll()
+
   def testPartitionTargetDisksUsesKVMDevice(self):
     self.target_hd = "/dev/vda"
     sfdisk_command = """sfdisk -uM /dev/vda <<EOF
@@ -238,8 +453,10 @@ EOF
 
     self._MockRunCommandAndWait(sfdisk_command)
 
-    commands = ("mkfs.ext3 /dev/vda1"
-                " && mkswap /dev/vda2"
+    commands = ("{ { mkfs.ext3 -q /dev/vda1; } & p0=$!;"
+                " { mkswap /dev/vda2; } & p1=$!; failed=0;"
+                " for pid in $p0 $p1; do wait $pid || failed=1; done;"
+                " test $failed = 0; }"
                 " && mkdir -p %s"
                 " && mount /dev/vda1 %s") % (self.module.TARGET_MOUNT,
                                               self.module.TARGET_MOUNT)
@@ -260,8 +477,10 @@ EOF
 """ % (self.totsize - self.swapsize)
 
 
-    commands = ("mkfs.ext3 /dev/xvda1"
-                " && mkswap /dev/xvda2"
+    commands = ("{ { mkfs.ext3 -q /dev/xvda1; } & p0=$!;"
+                " { mkswap /dev/xvda2; } & p1=$!; failed=0;"
+                " for pid in $p0 $p1; do wait $pid || failed=1; done;"
+                " test $failed = 0; }"
                 " && mkdir -p %s"
                 " && mount /dev/xvda1 %s") % (self.module.TARGET_MOUNT,
                                               self.module.TARGET_MOUNT)
@@ -276,11 +495,26 @@ EOF
                                      self.target_hd)
     self.mox.VerifyAll()
 
+  def testPartitionTargetDisksWithoutFilesystem(self):
+    sfdisk_command = """sfdisk -uM /dev/xvda <<EOF
+0,%d,83
+,,82
+EOF
+""" % (self.totsize - self.swapsize)
+
+    self._MockRunCommandAndWait(sfdisk_command)
+    self._MockRunCommandAndWait("mkswap /dev/xvda2")
+
+    self.mox.ReplayAll()
+    self.module.PartitionTargetDisks(self.client, self.totsize, self.swapsize,
+                                     self.target_hd, make_fs=False)
+    self.mox.VerifyAll()
+
   def testTransferFilesExitsOnError(self):
     user = "root"
     host = "instance"
     pkey = "keyfile"
-    command_list = ["rsync", "-aHAXz", "-e", "ssh -i %s" % pkey,
+    command_list = ["rsync", "-aHAXS", "-z", "-e", "ssh -i %s" % pkey,
                     "%s/" % self.module.SOURCE_MOUNT,
                     "%s@%s:%s" % (user, host, self.module.TARGET_MOUNT)]
     self._MockSubprocessCallFailure(command_list)
@@ -292,7 +526,7 @@ EOF
     user = "root"
     host = "instance"
     pkey = "keyfile"
-    command_list = ["rsync", "-aHAXz", "-e", "ssh -i %s" % pkey,
+    command_list = ["rsync", "-aHAXS", "-z", "-e", "ssh -i %s" % pkey,
                     "%s/" % self.module.SOURCE_MOUNT,
                     "%s@%s:%s" % (user, host, self.module.TARGET_MOUNT)]
     self._MockSubprocessCallSuccess(command_list)
@@ -300,7 +534,1259 @@ EOF
     self.module.TransferFiles(user, host, pkey)
     self.mox.VerifyAll()
 
+  def testTransferFilesRunsOneJobPerFilesystem(self):
+    self.mox.StubOutWithMock(self.module, "_GetTransferJobs")
+    self.mox.StubOutWithMock(self.module, "_RunCommandsInParallel")
+    user = "root"
+    host = "instance"
+    pkey = "keyfile"
+    fs_devs = [("/dev/sda1", "/"), ("/dev/sda2", "/usr")]
+    src = self.module.SOURCE_MOUNT
+    dest = self.module.TARGET_MOUNT
+    jobs = [(src, dest, []), (src + "/usr", dest + "/usr", [])]
+    commands = []
+    for job_src, job_dest, _ in jobs:
+      commands.append(["rsync", "-aHAXS", "-z", "-x", "-e", "ssh -i %s" % pkey,
+                       "--rsync-path=mkdir -p %s && rsync" % job_dest,
+                       "%s/" % job_src, "%s@%s:%s" % (user, host, job_dest)])
+
+    self.module._GetTransferJobs(fs_devs, False).AndReturn(jobs)
+    call = self.module._RunCommandsInParallel(commands, 2,
+                                              done_callback=mox.IgnoreArg(),
+                                              args_callback=mox.IgnoreArg())
+    call.AndReturn([(commands[1], 0), (commands[0], 0)])
+
+    self.mox.ReplayAll()
+    self.module.TransferFiles(user, host, pkey, fs_devs, 2)
+    self.mox.VerifyAll()
+
+  def testGetTransferJobsSkipsUnmountedFilesystems(self):
+    self.mox.StubOutWithMock(self.module.os.path, "ismount")
+    src = self.module.SOURCE_MOUNT
+    dest = self.module.TARGET_MOUNT
+    fs_devs = [("/dev/sda1", "/"), ("/dev/sda2", "/usr"),
+               ("/dev/sda3", "/home")]
+
+    self.module.os.path.ismount(src + "/usr").AndReturn(True)
+    self.module.os.path.ismount(src + "/home").AndReturn(False)
+
+    self.mox.ReplayAll()
+    jobs = self.module._GetTransferJobs(fs_devs)
+    self.assertEqual(jobs, [(src, dest, []), (src + "/usr", dest + "/usr", [])])
+    self.mox.VerifyAll()
+
+  def testGetTransferJobsSplitsTopLevelDirectories(self):
+    self.mox.StubOutWithMock(self.module.os, "listdir")
+    self.mox.StubOutWithMock(self.module.os.path, "isdir")
+    self.mox.StubOutWithMock(self.module.os.path, "islink")
+    self.mox.StubOutWithMock(self.module.os.path, "ismount")
+    src = self.module.SOURCE_MOUNT
+    dest = self.module.TARGET_MOUNT
+
+    self.module.os.listdir(src).AndReturn(["vmlinuz", "var", "usr"])
+    self.module.os.path.isdir(src + "/usr").AndReturn(True)
+    self.module.os.path.islink(src + "/usr").AndReturn(False)
+    self.module.os.path.ismount(src + "/usr").AndReturn(True)
+    self.module.os.path.isdir(src + "/var").AndReturn(True)
+    self.module.os.path.islink(src + "/var").AndReturn(False)
+    self.module.os.path.ismount(src + "/var").AndReturn(False)
+    self.module.os.path.isdir(src + "/vmlinuz").AndReturn(False)
+
+    self.mox.ReplayAll()
+    jobs = self.module._GetTransferJobs([(self.root_dev, "/")], True)
+    self.assertEqual(jobs, [(src, dest, ["var"]),
+                            (src + "/var", dest + "/var", [])])
+    self.mox.VerifyAll()
+
+  def _ExpectPoll(self, proc, status):
+    """Expect a poll of a mock process, which sets its exit status."""
+    def _SetStatus():
+      proc.returncode = status
+    proc.poll().WithSideEffects(_SetStatus).AndReturn(status)
+
+  def testRunCommandsInParallelLimitsProcesses(self):
+    self.mox.StubOutWithMock(self.module.subprocess, "Popen",
+                             use_mock_anything=True)
+    self.mox.StubOutWithMock(self.module.time, "sleep")
+    commands = [["true", "1"], ["true", "2"], ["false", "3"], ["true", "4"]]
+    procs = [self.mox.CreateMockAnything() for _ in range(3)]
+
+    self.module.subprocess.Popen(commands[0]).AndReturn(procs[0])
+    self.module.subprocess.Popen(commands[1]).AndReturn(procs[1])
+    self._ExpectPoll(procs[0], None)
+    self._ExpectPoll(procs[1], None)
+    self.module.time.sleep(self.module._POLL_INTERVAL)
+    self._ExpectPoll(procs[0], None)
+    self._ExpectPoll(procs[1], 0)
+    self.module.subprocess.Popen(commands[2]).AndReturn(procs[2])
+    self._ExpectPoll(procs[0], None)
+    self._ExpectPoll(procs[2], 1)
+    # The fourth command is never started, because the third one failed
+    self._ExpectPoll(procs[0], 0)
+
+    self.mox.ReplayAll()
+    results = self.module._RunCommandsInParallel(commands, 2)
+    self.assertEqual(results, [(commands[1], 0), (commands[2], 1),
+                               (commands[0], 0)])
+    self.mox.VerifyAll()
+
+  def testRunCommandsInParallelAddsArguments(self):
+    self.mox.StubOutWithMock(self.module.subprocess, "Popen",
+                             use_mock_anything=True)
+    commands = [["rsync", "a/", "b"], ["rsync", "c/", "d"]]
+    limits = ["--bwlimit=500", "--bwlimit=100"]
+    procs = [self.mox.CreateMockAnything() for _ in range(2)]
+
+    # Each command gets the arguments in force when it is started
+    self.module.subprocess.Popen(["rsync", limits[0], "a/",
+                                  "b"]).AndReturn(procs[0])
+    self._ExpectPoll(procs[0], 0)
+    self.module.subprocess.Popen(["rsync", limits[1], "c/",
+                                  "d"]).AndReturn(procs[1])
+    self._ExpectPoll(procs[1], 0)
+
+    self.mox.ReplayAll()
+    results = self.module._RunCommandsInParallel(
+      commands, 1, args_callback=lambda: [limits.pop(0)])
+    self.assertEqual(results, [(commands[0], 0), (commands[1], 0)])
+    self.mox.VerifyAll()
+
+  def testTransferFilesAppliesBandwidthLimit(self):
+    user = "root"
+    host = "instance"
+    pkey = "keyfile"
+    limiter = self.mox.CreateMock(self.module.BandwidthLimiter)
+    limiter.CurrentRate().MultipleTimes().AndReturn(2000)
+    command_list = ["rsync", "-aHAXS", "-z", "--bwlimit=2000", "-e",
+                    "ssh -i %s" % pkey, "%s/" % self.module.SOURCE_MOUNT,
+                    "%s@%s:%s" % (user, host, self.module.TARGET_MOUNT)]
+    self._MockSubprocessCallSuccess(command_list)
+    self.mox.ReplayAll()
+    self.module.TransferFiles(user, host, pkey, limiter=limiter)
+    self.mox.VerifyAll()
+
+  def testParseBandwidthSchedule(self):
+    schedule = self.module.ParseBandwidthSchedule(
+      "08:00-18:30=2000, 22:00-6:00=0")
+    self.assertEqual(schedule, [(480, 1110, 2000), (1320, 360, 0)])
+    self.assertRaises(self.module.P2VError,
+                      self.module.ParseBandwidthSchedule, "08:00=2000")
+    self.assertRaises(self.module.P2VError,
+                      self.module.ParseBandwidthSchedule, "08:00-18:75=2000")
+    self.assertEqual(self.module.ParseBandwidthSchedule("18:00-24:00=500"),
+                     [(1080, 1440, 500)])
+    self.assertRaises(self.module.P2VError,
+                      self.module.ParseBandwidthSchedule, "18:00-24:30=500")
+
+  def testBandwidthLimiterFollowsScheduleAndControlFile(self):
+    self.mox.StubOutWithMock(self.module.time, "time")
+    self.mox.StubOutWithMock(self.module.time, "localtime")
+    control_dir = tempfile.mkdtemp()
+    try:
+      control_file = os.path.join(control_dir, "bwlimit")
+      limiter = self.module.BandwidthLimiter(
+        100, [(480, 1080, 2000), (1320, 360, 5000)], control_file)
+
+      def _ExpectCheck(when, hour):
+        self.module.time.time().AndReturn(when)
+        self.module.time.localtime(when).AndReturn(
+          time.struct_time((2011, 1, 1, hour, 0, 0, 5, 1, 0)))
+
+      _ExpectCheck(1000.0, 9)
+      # Not looked up again until the check interval has passed
+      self.module.time.time().AndReturn(1001.0)
+      _ExpectCheck(1010.0, 23)
+      _ExpectCheck(1020.0, 19)
+      self.module.time.time().AndReturn(1030.0)
+
+      self.mox.ReplayAll()
+      self.assertEqual(limiter.CurrentRate(), 2000)
+      self.assertEqual(limiter.CurrentRate(), 2000)
+      self.assertEqual(limiter.CurrentRate(), 5000)  # past midnight rule
+      self.assertEqual(limiter.CurrentRate(), 100)
+      control = open(control_file, "w")
+      control.write("300\n")
+      control.close()
+      self.assertEqual(limiter.CurrentRate(), 300)
+      self.mox.VerifyAll()
+    finally:
+      shutil.rmtree(control_dir)
+
+  def testBandwidthLimiterThrottleSleeps(self):
+    self.mox.StubOutWithMock(self.module.time, "time")
+    self.mox.StubOutWithMock(self.module.time, "sleep")
+    limiter = self.module.BandwidthLimiter(100)
+
+    # The bucket starts empty, so 100 KB at 100 KB/s takes a second
+    self.module.time.time().MultipleTimes().AndReturn(1000.0)
+    self.module.time.sleep(1.0)
+
+    self.mox.ReplayAll()
+    limiter.Throttle(100 * 1024)
+    self.mox.VerifyAll()
+
+  def testTransferFilesWithoutCompression(self):
+    user = "root"
+    host = "instance"
+    pkey = "keyfile"
+    command_list = ["rsync", "-aHAXS", "-e", "ssh -i %s" % pkey,
+                    "%s/" % self.module.SOURCE_MOUNT,
+                    "%s@%s:%s" % (user, host, self.module.TARGET_MOUNT)]
+    self._MockSubprocessCallSuccess(command_list)
+    self.mox.ReplayAll()
+    self.module.TransferFiles(user, host, pkey, rsync_args=[])
+    self.mox.VerifyAll()
+
+  def _MockLocalRsyncVersion(self, output):
+    popen = self.mox.CreateMockAnything()
+    call = self.module.subprocess.Popen(["rsync", "--version"],
+                                        stdout=self.module.subprocess.PIPE)
+    call.AndReturn(popen)
+    popen.communicate().AndReturn((output, None))
+
+  def testChooseCompressionFixedChoice(self):
+    self.mox.StubOutWithMock(self.module.subprocess, "Popen",
+                             use_mock_anything=True)
+    new_rsync = "Compress list:\n    zstd zlib none\n"
+    old_rsync = "rsync  version 3.0.7  protocol version 30\n"
+    self._MockLocalRsyncVersion(old_rsync)
+    self._ExecCommandWithOutput("rsync --version", new_rsync)
+    self._MockLocalRsyncVersion(new_rsync)
+    self._ExecCommandWithOutput("rsync --version", new_rsync)
+    self._MockLocalRsyncVersion(new_rsync)
+    self._MockLocalRsyncVersion(old_rsync)
+    inventory = {"rsync_compressors": ["zstd", "zlib", "none"]}
+
+    self.mox.ReplayAll()
+    self.assertEqual(self.module.ChooseCompression(self.client, "none"), [])
+    self.assertEqual(self.module.ChooseCompression(self.client, "zlib"),
+                     ["-z"])
+    # Both rsyncs would otherwise agree on zstd
+    self.assertEqual(self.module.ChooseCompression(self.client, "zlib"),
+                     ["-z", "--compress-choice=zlib"])
+    self.assertEqual(self.module.ChooseCompression(self.client, "zstd",
+                                                   inventory),
+                     ["-z", "--compress-choice=zstd"])
+    self.assertRaises(self.module.P2VError, self.module.ChooseCompression,
+                      self.client, "zstd", inventory)
+    self.mox.VerifyAll()
+
+  def testGetRsyncCompressorsParsesVersion(self):
+    new_rsync = ("rsync  version 3.2.3  protocol version 31\n"
+                 "Compress list:\n"
+                 "    zstd lz4 zlibx zlib none\n")
+    old_rsync = "rsync  version 3.0.7  protocol version 30\n"
+    self.assertEqual(self.module._GetRsyncCompressors(new_rsync),
+                     ["zstd", "lz4", "zlibx", "zlib", "none"])
+    self.assertEqual(self.module._GetRsyncCompressors(old_rsync), ["zlib"])
+
+  def testChooseCompressionAutoPicksFastest(self):
+    popen = self.mox.CreateMock(self.module.subprocess.Popen)
+    self.mox.StubOutWithMock(self.module.subprocess, "Popen",
+                             use_mock_anything=True)
+    self.mox.StubOutWithMock(self.module, "_SampleSourceData")
+    self.mox.StubOutWithMock(self.module, "_MeasureLinkThroughput")
+    self.mox.StubOutWithMock(self.module, "_MeasureCompression")
+    mb = 1024 * 1024
+    versions = "Compress list:\n    zstd zlib none\n"
+
+    call = self.module.subprocess.Popen(["rsync", "--version"],
+                                        stdout=self.module.subprocess.PIPE)
+    call.AndReturn(popen)
+    popen.communicate().AndReturn((versions, None))
+    self._ExecCommandWithOutput("rsync --version", versions)
+    self.module._SampleSourceData(mox.IgnoreArg()).AndReturn("data")
+    call = self.module._MeasureLinkThroughput(self.client, mox.IgnoreArg())
+    call.AndReturn(100.0 * mb)
+    # zlib is too slow to keep up with the link, zstd is fast enough
+    self.module._MeasureCompression("zlib", 1, "data").AndReturn((0.5, 50 * mb))
+    self.module._MeasureCompression("zlib", 6, "data").AndReturn((0.4, 10 * mb))
+    self.module._MeasureCompression("zstd", 1, "data").AndReturn((0.5,
+                                                                  400 * mb))
+    self.module._MeasureCompression("zstd", 3, "data").AndReturn((0.45,
+                                                                  150 * mb))
+
+    self.mox.ReplayAll()
+    args = self.module.ChooseCompression(self.client, "auto")
+    self.assertEqual(args, ["-z", "--compress-choice=zstd",
+                            "--compress-level=1"])
+    self.mox.VerifyAll()
+
+  def testMeasureCompressionZlib(self):
+    ratio, rate = self.module._MeasureCompression("zlib", 6, "a" * 100000)
+    self.assertTrue(ratio < 0.1)
+    self.assertTrue(rate > 0)
+
+  def _MakeExtImage(self, blocks_count, blocks_per_group, groups,
+                    first_meta_bg=None):
+    """Write a minimal ext2 image with 1k blocks to a temporary file.
+
+    groups is a list of (block bitmap, inode bitmap, inode table, flags,
+    bitmap bytes) tuples, one per block group. If first_meta_bg is given, the
+    image has the meta_bg feature.
+
+    """
+    block_size = 1024
+    image = ["\0"] * (blocks_count * block_size)
+
+    def _Put(offset, data):
+      image[offset:offset + len(data)] = list(data)
+
+    sb = struct.pack("<11I", 16 * len(groups), blocks_count, 0, 0, 0, 1, 0, 0,
+                     blocks_per_group, 0, 16)
+    _Put(1024, sb)
+    _Put(1024 + 0x38, struct.pack("<H", self.module._EXT_MAGIC))
+    _Put(1024 + 0x4C, struct.pack("<I", 1))  # dynamic revision
+    _Put(1024 + 0x58, struct.pack("<H", 128))  # inode size
+    _Put(1024 + 0x64, struct.pack("<I", 0x11))  # sparse_super, gdt_csum
+    if first_meta_bg is not None:
+      _Put(1024 + 0x60, struct.pack("<I",
+                                    self.module._EXT_FEATURE_INCOMPAT_META_BG))
+      _Put(1024 + 0x104, struct.pack("<I", first_meta_bg))
+    for idx, (bbitmap, ibitmap, itable, flags, bits) in enumerate(groups):
+      desc_offset = 2048 + idx * 32
+      first = idx - idx % 32
+      if first_meta_bg is not None and first >= first_meta_bg * 32:
+        # In the first group of its meta group, after any superblock
+        location = 1 + first * blocks_per_group
+        if self.module._ExtGroupHasSuper(first, 1):
+          location += 1
+        desc_offset = location * block_size + idx % 32 * 32
+      desc = struct.pack("<III", bbitmap, ibitmap, itable)
+      _Put(desc_offset, desc)
+      _Put(desc_offset + 0x12, struct.pack("<H", flags))
+      _Put(bbitmap * block_size, bits)
+
+    handle, fname = tempfile.mkstemp()
+    os.write(handle, "".join(image))
+    os.close(handle)
+    return fname
+
+  def testReadExtUsedExtentsReadsBitmap(self):
+    # Blocks 1-10 and 50-52 in use; the padding after the last block is set,
+    # as mke2fs does, and must be ignored
+    bits = "\xff\x03" + "\0" * 4 + "\x0e" + "\0" * 5 + "\xf8\xff"
+    fname = self._MakeExtImage(100, 8192, [(3, 4, 5, 0, bits)])
+    try:
+      block_size, blocks_count, extents = \
+          self.module.ReadExtUsedExtents(fname)
+    finally:
+      os.remove(fname)
+
+    self.assertEqual(block_size, 1024)
+    self.assertEqual(blocks_count, 100)
+    self.assertEqual(extents, [(0, 11), (50, 3)])
+
+  def testReadExtUsedExtentsHandlesUninitializedGroups(self):
+    # Group 1 (blocks 65-128) has a superblock backup and its own bitmaps and
+    # inode table, but its block bitmap was never written
+    bits = "\xff" + "\0" * 7
+    groups = [(3, 4, 5, 0, bits),
+              (67, 68, 69, self.module._EXT_BG_BLOCK_UNINIT, "\xaa" * 8)]
+    fname = self._MakeExtImage(129, 64, groups)
+    try:
+      _, _, extents = self.module.ReadExtUsedExtents(fname)
+    finally:
+      os.remove(fname)
+
+    self.assertEqual(extents, [(0, 9), (65, 6)])
+
+  def testReadExtUsedExtentsFindsMetaGroupDescriptors(self):
+    # Groups of 8 blocks, so descriptor block 2 holds groups 0-31 and the
+    # descriptor of group 32 (blocks 257-264) is in its own first block.
+    # Groups 1 and 31 only hold the backups of the superblock and of the
+    # descriptor block.
+    uninit = self.module._EXT_BG_BLOCK_UNINIT
+    groups = [(3, 4, 5, 0, "\x3f"), (7, 4, 5, uninit, "")]
+    groups.extend([(7, 4, 5, 0, "\0")] * 29)
+    groups.append((7, 4, 5, uninit, ""))
+    groups.append((258, 4, 5, 0, "\x03"))
+    fname = self._MakeExtImage(265, 8, groups, first_meta_bg=0)
+    try:
+      _, _, extents = self.module.ReadExtUsedExtents(fname)
+    finally:
+      os.remove(fname)
+
+    self.assertEqual(extents, [(0, 7), (9, 2), (249, 1), (257, 2)])
+
+  def testReadExtUsedExtentsRejectsOtherFilesystems(self):
+    handle, fname = tempfile.mkstemp()
+    os.write(handle, "\0" * 4096)
+    os.close(handle)
+    try:
+      self.assertRaises(self.module.P2VError,
+                        self.module.ReadExtUsedExtents, fname)
+    finally:
+      os.remove(fname)
+
+  def testTransferBlocksRemountsBeforeReadingBitmaps(self):
+    # ReadExtUsedExtents must not be called while the source can change
+    self.mox.StubOutWithMock(self.module, "ReadExtUsedExtents")
+    self.mox.StubOutWithMock(self.module.subprocess, "call")
+    self.module.subprocess.call(["mount", "-o", "remount,ro",
+                                 self.module.SOURCE_MOUNT]).AndReturn(32)
+
+    self.mox.ReplayAll()
+    self.assertRaises(self.module.P2VError, self.module.TransferBlocks,
+                      self.client, self.root_dev, self.target_hd)
+    self.mox.VerifyAll()
+
+  def testExtentWriterReproducesExtents(self):
+    block_size = 512
+    data = "".join([chr(i % 256) * block_size for i in range(16)])
+    extents = [(1, 2), (8, 5), (15, 1)]
+
+    # The instance may only have Python 3
+    interpreters = [sys.executable]
+    try:
+      subprocess.call(["python3", "-c", ""])
+      interpreters.append("python3")
+    except OSError:
+      pass
+
+    source = tempfile.TemporaryFile()
+    source.write(data)
+    try:
+      stream = "".join(self.module._ExtentStream(source, extents, block_size))
+    finally:
+      source.close()
+    for interpreter in interpreters:
+      handle, target = tempfile.mkstemp()
+      os.write(handle, "\0" * len(data))
+      os.close(handle)
+      try:
+        writer = subprocess.Popen([interpreter, "-c",
+                                   self.module._EXTENT_WRITER, target],
+                                  stdin=subprocess.PIPE)
+        writer.communicate(stream)
+        self.assertEqual(writer.returncode, 0)
+        result = open(target, "rb").read()
+      finally:
+        os.remove(target)
+
+      for block in range(16):
+        chunk = result[block * block_size:(block + 1) * block_size]
+        if block in [1, 2, 8, 9, 10, 11, 12, 15]:
+          self.assertEqual(chunk, data[block * block_size:
+                                       (block + 1) * block_size])
+        else:
+          self.assertEqual(chunk, "\0" * block_size)
+
+  def testChunkManifestListsLargeFiles(self):
+    tree = tempfile.mkdtemp()
+    try:
+      os.mkdir(os.path.join(tree, "etc"))
+      open(os.path.join(tree, "etc", "big"), "w").write("a" * 5 + "b" * 3)
+      open(os.path.join(tree, "small"), "w").write("c" * 3)
+      open(os.path.join(tree, "linked"), "w").write("d" * 8)
+      os.link(os.path.join(tree, "linked"), os.path.join(tree, "link2"))
+      os.utime(os.path.join(tree, "etc", "big"), (1000, 1000))
+
+      records = list(self.module._ChunkManifest(tree, chunk_bytes=5,
+                                                min_bytes=4))
+    finally:
+      shutil.rmtree(tree)
+
+    self.assertEqual(records, [
+      self.module.struct.pack(">I", 7) + "etc/big" +
+      self.module.struct.pack(">QdI", 8, 1000, 2) +
+      self.module.hashlib.sha1("a" * 5).digest() +
+      self.module.hashlib.sha1("b" * 3).digest(),
+      ])
+
+  def testChunkClientSeedsAndFillsCache(self):
+    tree = tempfile.mkdtemp()
+    try:
+      src = os.path.join(tree, "src")
+      target = os.path.join(tree, "target")
+      state = os.path.join(tree, "state")
+      store = os.path.join(tree, "store")
+      for path in [os.path.join(src, "usr"), target, store]:
+        os.makedirs(path)
+      partial = "a" * 4 + "b" * 4 + "c" * 2
+      open(os.path.join(src, "partial"), "w").write(partial)
+      open(os.path.join(src, "usr", "complete"), "w").write("b" * 4 + "a")
+      os.utime(os.path.join(src, "usr", "complete"), (1000, 1000))
+      for chunk in ["a" * 4, "b" * 4, "a"]:
+        open(os.path.join(store, self.module.hashlib.sha1(chunk).hexdigest()),
+             "w").write(chunk)
+
+      # Serves chunks from a directory, like p2v_chunk_store.py
+      fake_store = os.path.join(tree, "store.py")
+      open(fake_store, "w").write(
+        "import os, struct, sys\n"
+        "store = sys.argv[1]\n"
+        "if sys.argv[2] == 'get':\n"
+        "  for name in sys.stdin.read().split():\n"
+        "    path = os.path.join(store, name)\n"
+        "    if os.path.exists(path):\n"
+        "      data = open(path).read()\n"
+        "      sys.stdout.write(struct.pack('>I', len(data)) + data)\n"
+        "    else:\n"
+        "      sys.stdout.write(struct.pack('>I', 0xffffffff))\n"
+        "else:\n"
+        "  data = sys.stdin.read()\n"
+        "  while data:\n"
+        "    digest, length = struct.unpack('>20sI', data[:24])\n"
+        "    open(os.path.join(store, digest.encode('hex')), 'w').write(\n"
+        "      data[24:24 + length])\n"
+        "    data = data[24 + length:]\n")
+      store_command = "%s %s %s" % (sys.executable, fake_store, store)
+
+      def _RunClient(mode, data=""):
+        client = subprocess.Popen([sys.executable, "-c",
+                                   self.module._CHUNK_CLIENT, mode,
+                                   store_command, state, target, "4"],
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE)
+        out = client.communicate(data)[0]
+        self.assertEqual(client.returncode, 0)
+        return out
+
+      manifest = "".join(self.module._ChunkManifest(src, chunk_bytes=4,
+                                                    min_bytes=1))
+      self.assertEqual(_RunClient("seed", manifest), "3 of 4 chunks found")
+
+      complete = os.stat(os.path.join(target, "usr", "complete"))
+      self.assertEqual(open(os.path.join(target, "usr", "complete")).read(),
+                       "b" * 4 + "a")
+      self.assertEqual(complete.st_mtime, 1000)
+      self.assertEqual(open(os.path.join(target, "partial")).read(),
+                       "a" * 4 + "b" * 4 + "\0" * 2)
+      self.assertNotEqual(os.stat(os.path.join(target, "partial")).st_mtime,
+                          os.stat(os.path.join(src, "partial")).st_mtime)
+
+      # What rsync would do
+      open(os.path.join(target, "partial"), "w").write(partial)
+      self.assertEqual(_RunClient("fill"), "1 chunks added")
+      self.assertEqual(
+        open(os.path.join(store,
+                          self.module.hashlib.sha1("cc").hexdigest())).read(),
+        "cc")
+      self.assertFalse(os.path.exists(os.path.join(state, "chunk_missing")))
+    finally:
+      shutil.rmtree(tree)
+
+  def testSeedFromChunkCacheSendsManifest(self):
+    self.mox.StubOutWithMock(self.module, "_ChunkManifest")
+    journal = self.mox.CreateMock(self.module.CheckpointJournal)
+    stdin = _MockChannelFile(self.mox)
+    stdout = _MockChannelFile(self.mox)
+    stderr = _MockChannelFile(self.mox)
+
+    journal.IsDone("seeded").AndReturn(False)
+    self.client.exec_command(
+      self.module._ChunkClientCommand("seed", "p2v@node1")).AndReturn(
+        (stdin, stdout, stderr))
+    self.module._ChunkManifest(self.module.SOURCE_MOUNT,
+                               skip_paths=set()).AndReturn(
+      iter(["rec1", "rec2"]))
+    stdin.channel.sendall("rec1")
+    stdin.channel.sendall("rec2")
+    stdin.channel.shutdown_write()
+    self._MockWaitForCompletion(stdout.channel, output=["2 of 5 chunks found"])
+    stdout.channel.recv_exit_status().AndReturn(0)
+    journal.MarkDone("seeded")
+
+    self.mox.ReplayAll()
+    self.module.SeedFromChunkCache(self.client, "p2v@node1", journal)
+    self.mox.VerifyAll()
+
+  def testFillChunkCacheIgnoresFailure(self):
+    journal = self.mox.CreateMock(self.module.CheckpointJournal)
+    stdin = _MockChannelFile(self.mox)
+    stdout = _MockChannelFile(self.mox)
+    stderr = _MockChannelFile(self.mox)
+
+    journal.IsDone("cache_filled").AndReturn(False)
+    self.client.exec_command(
+      self.module._ChunkClientCommand("fill", "node1")).AndReturn(
+        (stdin, stdout, stderr))
+    self._MockWaitForCompletion(stdout.channel)
+    stdout.channel.recv_exit_status().AndReturn(255)
+
+    self.mox.ReplayAll()
+    self.module.FillChunkCache(self.client, "node1", journal)
+    self.mox.VerifyAll()
+
+  def testExclusionRulesMatchEachKindOfRule(self):
+    rules = self.module.ExclusionRules([
+      "*.swp", "/var/cache/apt/archives/*.deb", "/srv/**.log", "re:/core$",
+      "size>1M", "fs=/home *.iso", "fs=/home size>10K"])
+    small = os.stat_result((0100644, 0, 0, 1, 0, 0, 1000, 0, 0, 0))
+    large = os.stat_result((0100644, 0, 0, 1, 0, 0, 100000, 0, 0, 0))
+    huge = os.stat_result((0100644, 0, 0, 1, 0, 0, 2 << 20, 0, 0, 0))
+
+    self.assertEqual(rules.Match("/etc/.passwd.swp", small), "*.swp")
+    self.assertEqual(rules.Match("/var/cache/apt/archives/a.deb", small),
+                     "/var/cache/apt/archives/*.deb")
+    self.assertEqual(rules.Match("/var/cache/apt/archives/partial/a.deb",
+                                 small), None)
+    self.assertEqual(rules.Match("/srv/www/logs/access.log", small),
+                     "/srv/**.log")
+    self.assertEqual(rules.Match("/var/crash/core", small), "re:/core$")
+    self.assertEqual(rules.Match("/usr/lib/big.so", huge), "size>1M")
+    self.assertEqual(rules.Match("/srv/a.iso", small), None)
+    self.assertEqual(rules.Match("/home/u/a.iso", small, "/home"),
+                     "fs=/home *.iso")
+    self.assertEqual(rules.Match("/home/u/a.txt", large, "/home"),
+                     "fs=/home size>10K")
+    self.assertEqual(rules.Match("/srv/a.txt", large), None)
+
+  def testExclusionRulesRejectInvalidRules(self):
+    for rule in ["re:(", "size>1X", "fs=/home", ""]:
+      self.assertRaises(self.module.P2VError, self.module.ExclusionRules,
+                        [rule])
+
+  def testFindExcludedFilesMeasuresExcludedDirectories(self):
+    tree = tempfile.mkdtemp()
+    try:
+      os.makedirs(os.path.join(tree, "tmp", "build"))
+      os.makedirs(os.path.join(tree, "etc"))
+      for name, size in [("tmp/build/a.o", 300), ("tmp/x", 100),
+                         ("etc/passwd", 10), ("etc/passwd~", 20)]:
+        open(os.path.join(tree, name), "w").write("x" * size)
+      self.mox.stubs.Set(self.module, "SOURCE_MOUNT", tree)
+      rules = self.module.ExclusionRules(["/tmp/*", "*~"])
+
+      index = self.module.ScanSource([(self.root_dev, "/")], 2)
+      excluded = self.module.FindExcludedFiles(index, rules)
+      # As with --mode block, where the root filesystem is copied whole
+      block_mode = self.module.FindExcludedFiles(index, rules, False)
+      index.Close()
+      self.assertEqual(excluded, [("/etc/passwd~", "*~", 20),
+                                  ("/tmp/build", "/tmp/*", 300),
+                                  ("/tmp/x", "/tmp/*", 100)])
+      self.assertEqual(block_mode, [])
+    finally:
+      shutil.rmtree(tree)
+
+  def testRsyncExcludeArgsAnchorsPathsAtTheJob(self):
+    src = self.module.SOURCE_MOUNT + "/var"
+    args, exclude_file = self.module._RsyncExcludeArgs(
+      src, ["/var/tmp/a", "/var/cache/b*c", "/varnish/d", "/etc/e"])
+    try:
+      self.assertEqual(args, ["--from0",
+                              "--exclude-from=%s" % exclude_file.name])
+      self.assertEqual(open(exclude_file.name).read(),
+                       "/tmp/a\0/cache/b\\*c")
+    finally:
+      exclude_file.close()
+    self.assertEqual(self.module._RsyncExcludeArgs(src, ["/etc/e"]),
+                     ([], None))
+
+  def testHashSourceFilesHashesEveryFile(self):
+    tree = tempfile.mkdtemp()
+    try:
+      os.makedirs(os.path.join(tree, "etc", "init.d"))
+      for name, data in [("vmlinuz", "kernel"), ("etc/passwd", "root"),
+                         ("etc/init.d/rc", ""), ("etc/back\\slash", "x")]:
+        open(os.path.join(tree, name), "w").write(data)
+      os.symlink("passwd", os.path.join(tree, "etc", "link"))
+      self.mox.stubs.Set(self.module, "SOURCE_MOUNT", tree)
+
+      index = self.module.ScanSource([(self.root_dev, "/")], 2)
+      digests = self.module.HashSourceFiles(index, 2)
+      index.Close()
+      self.assertEqual(digests, {
+        "./vmlinuz": hashlib.sha1("kernel").hexdigest(),
+        "./etc/passwd": hashlib.sha1("root").hexdigest(),
+        "./etc/init.d/rc": hashlib.sha1("").hexdigest(),
+        })
+    finally:
+      shutil.rmtree(tree)
+
+  def testHashTargetFilesSkipsEscapedNames(self):
+    stdin = _MockChannelFile(self.mox)
+    stdout = _MockChannelFile(self.mox)
+    stderr = _MockChannelFile(self.mox)
+    self.client.exec_command(mox.StrContains("sha1sum")).AndReturn(
+      (stdin, stdout, stderr))
+    stdin.channel.sendall("./etc/passwd\0./etc/back\\slash")
+    stdin.channel.shutdown_write()
+    self._MockWaitForCompletion(stdout.channel, output=[
+      "%s  ./etc/passwd\n" % ("a" * 40),
+      "\\%s  ./etc/back\\\\slash\n" % ("b" * 40)])
+    stdout.channel.recv_exit_status().AndReturn(123)
+
+    self.mox.ReplayAll()
+    self.assertEqual(self.module._HashTargetFiles(self.client,
+                                                  ["./etc/passwd",
+                                                   "./etc/back\\slash"]),
+                     {"./etc/passwd": "a" * 40})
+    self.mox.VerifyAll()
+
+  def testHashTargetFilesSendsPathsWhileReadingDigests(self):
+    stdin = _MockChannelFile(self.mox)
+    stdout = _MockChannelFile(self.mox)
+    stderr = _MockChannelFile(self.mox)
+    self.client.exec_command(mox.StrContains("sha1sum")).AndReturn(
+      (stdin, stdout, stderr))
+    stdin.channel.sendall("./a\0./b")
+    stdin.channel.shutdown_write()
+    self._MockWaitForCompletion(stdout.channel, output=[
+      "%s  ./a\n%s  ./b\n" % ("a" * 40, "b" * 40)])
+    stdout.channel.recv_exit_status().AndReturn(0)
+
+    self.mox.ReplayAll()
+    self.assertEqual(self.module._HashTargetFiles(self.client, ["./a", "./b"]),
+                     {"./a": "a" * 40, "./b": "b" * 40})
+    self.mox.VerifyAll()
+
+  def testVerifyTransferSendsDifferingFilesAgain(self):
+    journal = self.mox.CreateMock(self.module.CheckpointJournal)
+    self.mox.StubOutWithMock(self.module, "_HashTargetFiles")
+    self.mox.StubOutWithMock(self.module.subprocess, "call")
+    source = {"./a": "1" * 40, "./b": "2" * 40, "./c": "3" * 40}
+
+    journal.IsDone("verified").AndReturn(False)
+    # Only the files hashed on the source are hashed on the instance
+    self.module._HashTargetFiles(self.client,
+                                 ["./a", "./b", "./c"]).AndReturn(
+      {"./a": "1" * 40, "./b": "0" * 40})
+    self.module.subprocess.call(
+      mox.And(mox.In("-c"), mox.In("%s/" % self.module.SOURCE_MOUNT))
+      ).AndReturn(0)
+    self.module._HashTargetFiles(self.client, ["./b", "./c"]).AndReturn(
+      {"./b": "2" * 40, "./c": "3" * 40})
+    journal.MarkDone("verified")
+
+    self.mox.ReplayAll()
+    self.assertEqual(self.module.VerifyTransfer(self.client, self.user,
+                                                self.host, self.pkeyfile,
+                                                source, journal=journal), 2)
+    self.mox.VerifyAll()
+
+  def testVerifyTransferFailsWhenFilesStillDiffer(self):
+    self.mox.StubOutWithMock(self.module, "_HashTargetFiles")
+    self.mox.StubOutWithMock(self.module.subprocess, "call")
+    limiter = self.mox.CreateMock(self.module.BandwidthLimiter)
+    source = {"./a": "1" * 40}
+
+    self.module._HashTargetFiles(self.client, ["./a"]).AndReturn({})
+    limiter.CurrentRate().MultipleTimes().AndReturn(500)
+    self.module.subprocess.call(mox.In("--bwlimit=500")).AndReturn(0)
+    self.module._HashTargetFiles(self.client, ["./a"]).AndReturn(
+      {"./a": "0" * 40})
+
+    self.mox.ReplayAll()
+    self.assertRaises(self.module.P2VError, self.module.VerifyTransfer,
+                      self.client, self.user, self.host, self.pkeyfile,
+                      source, limiter=limiter)
+    self.mox.VerifyAll()
+
+  def testTarStreamUnpacksWithTar(self):
+    tree = tempfile.mkdtemp()
+    try:
+      src = os.path.join(tree, "src")
+      dest = os.path.join(tree, "dest")
+      long_name = "d" * 60 + "/" + "f" * 80
+      os.makedirs(os.path.join(src, "etc"))
+      os.makedirs(os.path.join(src, "d" * 60))
+      os.makedirs(os.path.join(src, "skipped"))
+      os.mkdir(dest)
+      open(os.path.join(src, "etc", "fstab"), "w").write("/dev/sda1 /\n")
+      open(os.path.join(src, "etc", "empty"), "w").close()
+      open(os.path.join(src, long_name), "w").write("x" * 1000)
+      open(os.path.join(src, "skipped", "file"), "w").write("x")
+      os.link(os.path.join(src, "etc", "fstab"), os.path.join(src, "fstab"))
+      os.symlink("etc/fstab", os.path.join(src, "link"))
+      os.mkfifo(os.path.join(src, "etc", "fifo"))
+      os.chmod(os.path.join(src, "etc", "empty"), 0604)
+      os.utime(os.path.join(src, "etc", "fstab"), (1000000000, 1000000000))
+
+      stream = "".join(self.module._TarStream(src, excludes=["skipped"]))
+      self.assertEqual(len(stream) % 512, 0)
+      tar = subprocess.Popen(["tar", "-xpf", "-", "-C", dest],
+                             stdin=subprocess.PIPE)
+      tar.communicate(stream)
+      self.assertEqual(tar.returncode, 0)
+
+      self.assertEqual(sorted(os.listdir(dest)),
+                       ["d" * 60, "etc", "fstab", "link"])
+      self.assertEqual(open(os.path.join(dest, "etc", "fstab")).read(),
+                       "/dev/sda1 /\n")
+      self.assertEqual(os.stat(os.path.join(dest, "etc", "fstab")).st_mtime,
+                       1000000000)
+      self.assertEqual(os.stat(os.path.join(dest, "fstab")).st_ino,
+                       os.stat(os.path.join(dest, "etc", "fstab")).st_ino)
+      self.assertEqual(os.readlink(os.path.join(dest, "link")), "etc/fstab")
+      self.assertEqual(open(os.path.join(dest, long_name)).read(), "x" * 1000)
+      self.assertEqual(
+        os.stat(os.path.join(dest, "etc", "empty")).st_mode & 0777, 0604)
+      self.assertTrue(self.module.stat.S_ISFIFO(
+        os.lstat(os.path.join(dest, "etc", "fifo")).st_mode))
+    finally:
+      shutil.rmtree(tree)
+
+  def _MakeSparseFile(self, path):
+    """Create a 1MB file with data at 64KB and 512KB, and a zero block."""
+    sparse = open(path, "wb")
+    sparse.seek(65536)
+    sparse.write("x" * 100)
+    sparse.seek(131072)
+    sparse.write("\0" * 4096)
+    sparse.seek(524288)
+    sparse.write("y" * 5000)
+    sparse.truncate(1048576)
+    sparse.close()
+
+  def testSparseRegionsSkipsHolesAndZeros(self):
+    handle, fname = tempfile.mkstemp()
+    os.close(handle)
+    try:
+      self._MakeSparseFile(fname)
+      source = open(fname, "rb")
+      regions = self.module._SparseRegions(source, 1048576)
+      self.assertEqual(source.tell(), 0)
+      source.close()
+    finally:
+      os.remove(fname)
+
+    # Data regions are reported in whole filesystem blocks at least
+    self.assertEqual(len(regions), 2)
+    self.assertTrue(regions[0][0] <= 65536 and sum(regions[0]) >= 65636)
+    self.assertTrue(regions[1][0] <= 524288 and sum(regions[1]) >= 529288)
+    self.assertTrue(sum([length for _, length in regions]) < 65536)
+
+  def testSparseMapEndsWithFileSize(self):
+    sparse_map = self.module._SparseMap([(0, 10), (4096, 5)], 8192)
+    self.assertEqual(len(sparse_map), 512)
+    self.assertEqual(sparse_map.rstrip("\0"), "3\n0\n10\n4096\n5\n8192\n0\n")
+    sparse_map = self.module._SparseMap([(4096, 4096)], 8192)
+    self.assertEqual(sparse_map.rstrip("\0"), "1\n4096\n4096\n")
+
+  def testTarStreamKeepsFilesSparse(self):
+    tree = tempfile.mkdtemp()
+    try:
+      src = os.path.join(tree, "src")
+      dest = os.path.join(tree, "dest")
+      os.makedirs(os.path.join(src, "var"))
+      os.mkdir(dest)
+      self._MakeSparseFile(os.path.join(src, "var", "image"))
+      original = open(os.path.join(src, "var", "image"), "rb").read()
+      progress = self.module.ProgressReporter()
+
+      stream = "".join(self.module._TarStream(src, progress=progress))
+      self.assertTrue(len(stream) < 65536)
+      self.assertTrue(progress.sparse_bytes > 1048576 - 65536)
+      tar = subprocess.Popen(["tar", "-xpf", "-", "-C", dest],
+                             stdin=subprocess.PIPE)
+      tar.communicate(stream)
+      self.assertEqual(tar.returncode, 0)
+
+      self.assertEqual(os.listdir(os.path.join(dest, "var")), ["image"])
+      image = os.path.join(dest, "var", "image")
+      self.assertEqual(open(image, "rb").read(), original)
+      self.assertTrue(os.stat(image).st_blocks * 512 < 65536)
+    finally:
+      shutil.rmtree(tree)
+
+  def testCountHolesAddsUpSparseFiles(self):
+    tree = tempfile.mkdtemp()
+    try:
+      os.mkdir(os.path.join(tree, "tmp"))
+      self._MakeSparseFile(os.path.join(tree, "image"))
+      os.link(os.path.join(tree, "image"), os.path.join(tree, "link"))
+      self._MakeSparseFile(os.path.join(tree, "tmp", "excluded"))
+      open(os.path.join(tree, "full"), "w").write("x" * 10000)
+      self.mox.stubs.Set(self.module, "SOURCE_MOUNT", tree)
+      index = self.module.ScanSource([(self.root_dev, "/")], 2)
+      try:
+        # The hard link is counted once, and the excluded file not at all
+        holes = self.module._CountHoles(index, [(self.root_dev, "/")],
+                                        ["/tmp"])
+        others = self.module._CountHoles(index, [("/dev/sda2", "/home")])
+      finally:
+        index.Close()
+    finally:
+      shutil.rmtree(tree)
+    self.assertTrue(1048576 - 65536 < holes < 1048576)
+    self.assertEqual(others, 0)
+
+  def testTarHeaderStoresExtendedAttributes(self):
+    tree = tempfile.mkdtemp()
+    try:
+      os.utime(tree, (1300000000, 1300000000))
+      stats = os.stat(tree)
+    finally:
+      shutil.rmtree(tree)
+    header = self.module._TarHeader("file", stats, "0", size=10,
+                                    xattrs=[("user.test", "a\nb=\0c")])
+    self.assertEqual(len(header), 3 * 512)
+    self.assertEqual(header[156], "x")
+    self.assertEqual(header[512:512 + 33],
+                     "33 SCHILY.xattr.user.test=a\nb=\0c\n")
+    self.assertEqual(header[1024:1028], "file")
+    self.assertEqual(header[1024 + 124:1024 + 136], "%011o\0" % 10)
+
+  def testTarHeaderKeepsFractionalModificationTime(self):
+    tree = tempfile.mkdtemp()
+    try:
+      src = os.path.join(tree, "src")
+      dest = os.path.join(tree, "dest")
+      os.mkdir(src)
+      os.mkdir(dest)
+      open(os.path.join(src, "file"), "w").write("x")
+      os.utime(os.path.join(src, "file"), (1300000000.25, 1300000000.25))
+
+      stream = "".join(self.module._TarStream(src))
+      tar = subprocess.Popen(["tar", "-xpf", "-", "-C", dest],
+                             stdin=subprocess.PIPE)
+      tar.communicate(stream)
+      self.assertEqual(tar.returncode, 0)
+
+      self.assertEqual(os.stat(os.path.join(dest, "file")).st_mtime,
+                       1300000000.25)
+    finally:
+      shutil.rmtree(tree)
+
+  def testPaxRecordLengthIncludesItself(self):
+    self.assertEqual(self.module._PaxRecord("path", "a" * 90),
+                     "99 path=%s\n" % ("a" * 90))
+    self.assertEqual(self.module._PaxRecord("path", "a" * 91),
+                     "101 path=%s\n" % ("a" * 91))
+
+  def testSendTreeStreamsArchiveToTar(self):
+    self.mox.StubOutWithMock(self.module, "_TarStream")
+    stdin = _MockChannelFile(self.mox)
+    stdout = _MockChannelFile(self.mox)
+    stderr = _MockChannelFile(self.mox)
+    dest = self.module.TARGET_MOUNT + "/usr"
+    limiter = self.mox.CreateMock(self.module.BandwidthLimiter)
+
+    self.client.exec_command("mkdir -p %s && %s" %
+                             (dest, self.module._TAR_EXTRACT % ("", dest))
+                             ).AndReturn((stdin, stdout, stderr))
+    self.module._TarStream("/source/usr", [], True, None, ()).AndReturn(
+      iter(["a", "bc"]))
+    limiter.Throttle(1)
+    stdin.channel.sendall("a")
+    limiter.Throttle(2)
+    stdin.channel.sendall("bc")
+    stdin.channel.shutdown_write()
+    self._MockWaitForCompletion(stdout.channel)
+    stdout.channel.recv_exit_status().AndReturn(0)
+
+    self.mox.ReplayAll()
+    self.module._SendTree(self.client, "/source/usr", dest, [], True, limiter)
+    self.mox.VerifyAll()
+
+  def testTransferNativeSendsJobsInParallel(self):
+    self.mox.StubOutWithMock(self.module, "_GetTransferJobs")
+    self.mox.StubOutWithMock(self.module, "_SendTree")
+    journal = self.mox.CreateMock(self.module.CheckpointJournal)
+    src = self.module.SOURCE_MOUNT
+    dest = self.module.TARGET_MOUNT
+    fs_devs = [("/dev/sda1", "/"), ("/dev/sda2", "/usr")]
+    jobs = [(src, dest, []), (src + "/usr", dest + "/usr", [])]
+
+    journal.IsDone("files").AndReturn(False)
+    journal.IsDone("warm").AndReturn(False)
+    self.module._GetTransferJobs(fs_devs, False).AndReturn(jobs)
+    journal.IsDone("files %s" % dest).AndReturn(True)
+    journal.IsDone("files %s/usr" % dest).AndReturn(False)
+    self.module._SendTree(self.client, src + "/usr", dest + "/usr", [], True,
+                          None, 6, None, set())
+    journal.MarkDone("files %s/usr" % dest)
+
+    self.mox.ReplayAll()
+    self.module.TransferNative(self.client, fs_devs, 2, journal=journal,
+                               compress_level=6)
+    self.mox.VerifyAll()
+
+  def testSmallFileSegmentsGroupsSmallFiles(self):
+    tree = tempfile.mkdtemp()
+    try:
+      os.makedirs(os.path.join(tree, "var", "spool"))
+      os.makedirs(os.path.join(tree, "var", "cache"))
+      for name, size in [("spool/a", 10), ("spool/b", 20), ("spool/c", 30),
+                         ("spool/large", 5000), ("cache/d", 5)]:
+        open(os.path.join(tree, "var", name), "w").write("x" * size)
+      os.link(os.path.join(tree, "var", "spool", "a"),
+              os.path.join(tree, "var", "linked"))
+      self.mox.stubs.Set(self.module, "SOURCE_MOUNT", tree)
+
+      index = self.module.ScanSource([(self.root_dev, "/")], 2)
+      try:
+        segments = list(self.module._SmallFileSegments(
+          index, 1000, excluded=["/var/cache"], segment_bytes=25))
+        by_count = list(self.module._SmallFileSegments(
+          index, 1000, segment_files=2))
+        other_fs = list(self.module._SmallFileSegments(index, 1000, ["/usr"]))
+      finally:
+        index.Close()
+    finally:
+      shutil.rmtree(tree)
+
+    # Hard links and large files are left to rsync
+    self.assertEqual(sorted([sorted(segment) for segment in segments]),
+                     [["/var/spool/b", "/var/spool/c"]])
+    self.assertEqual(sorted(sum(by_count, [])),
+                     ["/var/cache/d", "/var/spool/b", "/var/spool/c"])
+    self.assertEqual(max([len(segment) for segment in by_count]), 2)
+    self.assertEqual(other_fs, [])
+
+  def testSendSmallFilesUnpacksSegmentsWithTar(self):
+    tree = tempfile.mkdtemp()
+    try:
+      src = os.path.join(tree, "src")
+      dest = os.path.join(tree, "dest")
+      os.makedirs(os.path.join(src, "home", "user"))
+      os.mkdir(dest)
+      for number in range(5):
+        open(os.path.join(src, "home", "user", "mail%d" % number),
+             "w").write("message %d" % number)
+      os.chmod(os.path.join(src, "home", "user", "mail0"), 0600)
+      os.utime(os.path.join(src, "home", "user", "mail1"),
+               (1000000000, 1000000000))
+      self.mox.stubs.Set(self.module, "SOURCE_MOUNT", src)
+      journal = self.mox.CreateMock(self.module.CheckpointJournal)
+      archives = []
+
+      def _FakeSendArchive(client, target, stream, limiter, compress_level):
+        self.assertEqual(target, self.module.TARGET_MOUNT)
+        tar = subprocess.Popen(["tar", "-xpf", "-", "-C", dest],
+                               stdin=subprocess.PIPE)
+        tar.communicate("".join(stream))
+        self.assertEqual(tar.returncode, 0)
+        archives.append(target)
+      self.mox.stubs.Set(self.module, "_SendArchive", _FakeSendArchive)
+      self.mox.stubs.Set(self.module, "_BATCH_SEGMENT_FILES", 2)
+
+      journal.IsDone("small_files").AndReturn(False)
+      journal.IsDone("files").AndReturn(False)
+      journal.IsDone("warm").AndReturn(False)
+      journal.MarkDone("small_files")
+      self.mox.ReplayAll()
+
+      index = self.module.ScanSource([(self.root_dev, "/")], 2)
+      try:
+        sent = self.module.SendSmallFiles(self.client, index, 1024, 2,
+                                          journal=journal)
+      finally:
+        index.Close()
+      self.mox.VerifyAll()
+
+      self.assertEqual(sent, 5)
+      self.assertEqual(len(archives), 3)
+      mail_dir = os.path.join(dest, "home", "user")
+      self.assertEqual(sorted(os.listdir(mail_dir)),
+                       ["mail%d" % number for number in range(5)])
+      self.assertEqual(open(os.path.join(mail_dir, "mail3")).read(),
+                       "message 3")
+      self.assertEqual(os.stat(os.path.join(mail_dir, "mail0")).st_mode &
+                       0777, 0600)
+      self.assertEqual(os.stat(os.path.join(mail_dir, "mail1")).st_mtime,
+                       1000000000)
+    finally:
+      shutil.rmtree(tree)
+
+  def testRangeStreamWritesWithExtentWriter(self):
+    tree = tempfile.mkdtemp()
+    try:
+      source_name = os.path.join(tree, "image")
+      target_name = os.path.join(tree, "copy")
+      self._MakeSparseFile(source_name)
+      original = open(source_name, "rb").read()
+      target = open(target_name, "wb")
+      target.truncate(len(original))
+      target.close()
+      self.mox.stubs.Set(self.module, "_STREAM_BUFFER_BYTES", 4096)
+
+      source = open(source_name, "rb")
+      try:
+        records = []
+        for offset in range(0, len(original), 300000):
+          records.append("".join(self.module._RangeStream(
+            source, offset, min(300000, len(original) - offset))))
+      finally:
+        source.close()
+      # Ranges are written in any order
+      for stream in reversed(records):
+        writer = subprocess.Popen([sys.executable, "-c",
+                                   self.module._EXTENT_WRITER, target_name],
+                                  stdin=subprocess.PIPE)
+        writer.communicate(stream)
+        self.assertEqual(writer.returncode, 0)
+
+      self.assertTrue(sum([len(stream) for stream in records]) < 65536)
+      self.assertEqual(open(target_name, "rb").read(), original)
+    finally:
+      shutil.rmtree(tree)
+
+  def testRunScriptSendsCommandsToOneShell(self):
+    stdin = _MockChannelFile(self.mox)
+    stdout = _MockChannelFile(self.mox)
+    stderr = _MockChannelFile(self.mox)
+    self.client.exec_command("sh -e").AndReturn((stdin, stdout, stderr))
+    stdin.channel.sendall("mkdir -p /target/a\n: > /target/a/b\n")
+    stdin.channel.shutdown_write()
+    self._MockWaitForCompletion(stdout.channel)
+    stdout.channel.recv_exit_status().AndReturn(1)
+
+    self.mox.ReplayAll()
+    self.assertRaises(self.module.P2VError, self.module._RunScript,
+                      self.client, ["mkdir -p /target/a", ": > /target/a/b"])
+    self.mox.VerifyAll()
+
+  def testSendLargeFilesResumesFromJournal(self):
+    tree = tempfile.mkdtemp()
+    try:
+      os.makedirs(os.path.join(tree, "var", "lib"))
+      open(os.path.join(tree, "var", "lib", "disk.img"), "w").write("x" * 10)
+      open(os.path.join(tree, "var", "lib", "new.img"), "w").write("x" * 8)
+      open(os.path.join(tree, "var", "lib", "small"), "w").write("x" * 5)
+      os.utime(os.path.join(tree, "var", "lib", "new.img"), (1000, 1000))
+      mtime = os.lstat(os.path.join(tree, "var", "lib", "disk.img")).st_mtime
+      self.mox.stubs.Set(self.module, "SOURCE_MOUNT", tree)
+      index = self.module.ScanSource([(self.root_dev, "/")], 2)
+    finally:
+      shutil.rmtree(tree)
+    sent_ranges = []
+    self.mox.stubs.Set(self.module, "_SendRange",
+                       lambda client, entry, offset, length, limiter:
+                       sent_ranges.append((entry.path, offset, length)))
+    self.mox.StubOutWithMock(self.module, "_RunScript")
+    journal = self.mox.CreateMock(self.module.CheckpointJournal)
+    key = "10 %r /var/lib/disk.img" % mtime
+    new_key = "8 1000.0 /var/lib/new.img"
+    target = self.module.TARGET_MOUNT + "/var/lib"
+
+    journal.IsDone("files").AndReturn(False)
+    journal.IsDone("warm").AndReturn(False)
+    journal.Values("range").AndReturn(["4 %s" % key])
+    journal.Values("large_file").AndReturn([])
+    # Only the file that wasn't started is created, in one go with any others
+    self.module._RunScript(self.client, [
+      "mkdir -p %s" % target, ": > %s/new.img" % target,
+      "truncate -s 8 %s/new.img" % target])
+    for entry in ["range 0 %s" % key, "range 8 %s" % key,
+                  "range 0 %s" % new_key, "range 4 %s" % new_key,
+                  "large_file %s" % key, "large_file %s" % new_key]:
+      journal.MarkDone(entry).InAnyOrder()
+    self.module._RunScript(self.client, mox.SameElementsAs([
+      "touch -m -d @%.9f %s/disk.img" % (mtime, target),
+      "touch -m -d @1000.000000000 %s/new.img" % target]))
+
+    self.mox.ReplayAll()
+    try:
+      sent = self.module.SendLargeFiles(self.client, index, 8, 1,
+                                        journal=journal, range_bytes=4)
+    finally:
+      index.Close()
+    self.mox.VerifyAll()
+    self.assertEqual(sent, 4)
+    self.assertEqual(sorted(sent_ranges),
+                     [("/var/lib/disk.img", 0, 4), ("/var/lib/disk.img", 8, 2),
+                      ("/var/lib/new.img", 0, 4), ("/var/lib/new.img", 4, 4)])
+
+  def testRunInThreadsStopsAfterFailure(self):
+    def _Check(item):
+      if item == 2:
+        raise self.module.P2VError("meep")
+
+    results = self.module._RunInThreads(_Check, [1, 2, 3], 1)
+    self.assertEqual(len(results), 2)
+    self.assertEqual(results[0], (1, None))
+    self.assertEqual(results[1][0], 2)
+    self.assertTrue(isinstance(results[1][1], self.module.P2VError))
+
+  def testTransferFilesSkipsJobsInJournal(self):
+    self.mox.StubOutWithMock(self.module, "_GetTransferJobs")
+    self.mox.StubOutWithMock(self.module, "_RunCommandsInParallel")
+    journal = self.mox.CreateMock(self.module.CheckpointJournal)
+    src = self.module.SOURCE_MOUNT
+    dest = self.module.TARGET_MOUNT
+    jobs = [(src, dest, []), (src + "/usr", dest + "/usr", [])]
+    command = ["rsync", "-aHAXS", "-z", "--partial", "-x", "-e",
+               "ssh -i keyfile", "--rsync-path=mkdir -p %s/usr && rsync" % dest,
+               "%s/usr/" % src, "root@instance:%s/usr" % dest]
+
+    journal.IsDone("files").AndReturn(False)
+    journal.IsDone("warm").AndReturn(False)
+    self.module._GetTransferJobs(self.fs_devs, False).AndReturn(jobs)
+    journal.IsDone("files %s" % dest).AndReturn(True)
+    journal.IsDone("files %s/usr" % dest).AndReturn(False)
+    call = self.module._RunCommandsInParallel([command], 2,
+                                              done_callback=mox.IgnoreArg(),
+                                              args_callback=mox.IgnoreArg())
+    call.AndReturn([(command, 0)])
+
+    self.mox.ReplayAll()
+    self.module.TransferFiles("root", "instance", "keyfile", self.fs_devs, 2,
+                              journal=journal)
+    self.mox.VerifyAll()
+
+  def testTransferFilesDeletesAfterWarmCopy(self):
+    journal = self.mox.CreateMock(self.module.CheckpointJournal)
+    command_list = ["rsync", "-aHAXS", "-z", "--partial", "--delete", "-e",
+                    "ssh -i keyfile", "%s/" % self.module.SOURCE_MOUNT,
+                    "root@instance:%s" % self.module.TARGET_MOUNT]
+
+    journal.IsDone("files").AndReturn(False)
+    journal.IsDone("warm").AndReturn(True)
+    self._MockSubprocessCallSuccess(command_list)
+    journal.MarkDone("files")
+
+    self.mox.ReplayAll()
+    self.module.TransferFiles("root", "instance", "keyfile", journal=journal)
+    self.mox.VerifyAll()
+
+  def testCheckpointJournalResumesFromInstanceCopy(self):
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "journal")
+    remote = "/var/lib/p2v-transfer/journal"
+    data = "p2v-transfer /dev/sda1 host\npartitioned\nfiles /target/usr\n"
+
+    # Local copy is missing, so it is fetched from the instance
+    self._ExecCommandWithOutput("cat %s" % remote, data)
+    stdin = self.mox.CreateMockAnything()
+    stdout = _MockChannelFile(self.mox)
+    call = self.client.exec_command("mkdir -p /var/lib/p2v-transfer && "
+                                    "cat > %s && sync" % remote)
+    call.AndReturn((stdin, stdout, None))
+    stdin.write(data)
+    stdin.flush()
+    stdin.channel = self.mox.CreateMock(paramiko.Channel)
+    stdin.channel.shutdown_write()
+    stdout.channel.recv_exit_status().AndReturn(0)
+
+    self.mox.ReplayAll()
+    journal = self.module.CheckpointJournal(path,
+                                            "p2v-transfer /dev/sda1 host",
+                                            client=self.client,
+                                            remote_path=remote)
+    try:
+      journal.Load()
+      self.assertEqual(open(path).read(), data)
+    finally:
+      os.remove(path)
+      os.rmdir(tmpdir)
+    self.assertTrue(journal.IsDone("partitioned"))
+    self.assertTrue(journal.IsDone("files /target/usr"))
+    self.assertFalse(journal.IsDone("files /target"))
+    self.mox.VerifyAll()
+
+  def testCheckpointJournalRejectsOtherTransfer(self):
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "journal")
+    journal = self.module.CheckpointJournal(path, "p2v-transfer /dev/sdb1 h")
+    try:
+      journal_file = open(path, "w")
+      journal_file.write("p2v-transfer /dev/sda1 h\npartitioned\n")
+      journal_file.close()
+      self.assertRaises(self.module.P2VError, journal.Load)
+      journal.Reset()
+      journal.MarkDone("partitioned")
+      self.assertEqual(open(path).read(),
+                       "p2v-transfer /dev/sdb1 h\npartitioned\n")
+    finally:
+      os.remove(path)
+      os.rmdir(tmpdir)
+
   def testUnmountSourceFilesystemsExitsOnError(self):
+    self.module._source_mounts.add(self.module.SOURCE_MOUNT)
     self.mox.StubOutWithMock(self.module.os.path, "exists")
     self.mox.StubOutWithMock(self.module.os.path, "ismount")
     self.mox.StubOutWithMock(self.module.time, "sleep")
@@ -314,11 +1800,11 @@ EOF
       self.module.time.sleep(0.5)
 
     self.mox.ReplayAll()
-    self.assertRaises(SystemExit, self.module.UnmountSourceFilesystems,
-                      self.fs_devs)
+    self.assertRaises(SystemExit, self.module.UnmountSourceFilesystems)
     self.mox.VerifyAll()
 
   def testUnmountSourceFilesystemsCallsUmount(self):
+    self.module._source_mounts.add(self.module.SOURCE_MOUNT)
     self.mox.StubOutWithMock(self.module.os.path, "exists")
     self.mox.StubOutWithMock(self.module.os.path, "ismount")
 
@@ -327,8 +1813,29 @@ EOF
     command_list = ["umount", self.module.SOURCE_MOUNT]
     self._MockSubprocessCallSuccess(command_list)
     self.mox.ReplayAll()
-    self.module.UnmountSourceFilesystems(self.fs_devs)
+    self.module.UnmountSourceFilesystems()
+    self.mox.VerifyAll()
+
+  def testUnmountSourceFilesystemsUnmountsChildrenFirst(self):
+    source = self.module.SOURCE_MOUNT
+    for path in [source, source + "/var", source + "/var/log",
+                 source + "/home"]:
+      self.module._source_mounts.add(path)
+    self.mox.StubOutWithMock(self.module.os.path, "exists")
+    self.mox.StubOutWithMock(self.module.os.path, "ismount")
+    self.mox.StubOutWithMock(self.module.subprocess, "call")
+
+    # Deepest first, and / only once /var and /home are unmounted
+    for path in [source + "/var/log", source + "/home", source + "/var",
+                 source]:
+      self.module.os.path.exists(path).AndReturn(True)
+      self.module.os.path.ismount(path).AndReturn(True)
+      self.module.subprocess.call(["umount", path]).AndReturn(0)
+
+    self.mox.ReplayAll()
+    self.module.UnmountSourceFilesystems()
     self.mox.VerifyAll()
+    self.assertEqual(self.module._source_mounts, set())
 
   def testMainRunsAllFunctions(self):
     self.mox.StubOutWithMock(self.module.os, "getuid")
@@ -340,26 +1847,321 @@ EOF
     self.module.LoadSSHKey(self.pkeyfile).AndReturn(self.pkey)
     self.module.EstablishConnection("root",
                                     self.host,
-                                    self.pkey).AndReturn(self.client)
-    call = self.module.MountSourceFilesystems(self.root_dev)
+                                    self.pkey, True).AndReturn(self.client)
+    call = self.module.MountSourceFilesystems(self.root_dev,
+                                                check=False)
     call.AndReturn((self.fs_devs, self.swap_devs))
-    self.module.FindTargetHardDrive(self.client).AndReturn(self.target_hd)
-    self.module.VerifyKernelMatches(self.client).AndReturn(True)
-    self.module.GetDiskSize(self.client, self.swap_devs,
-                            self.target_hd).AndReturn((self.totsize,
+    call = self.module.GetTargetInventory(self.client, mox.IgnoreArg())
+    call.AndReturn(self.inventory)
+    call = self.module.FindTargetHardDrive(self.client, self.inventory)
+    call.AndReturn(self.target_hd)
+    self.module.VerifyKernelMatches(self.client,
+                                    self.inventory).AndReturn(True)
+    journal = self._MockOpenJournal()
+    self.module.GetDiskSize(self.client, self.swap_devs, self.target_hd,
+                            self.inventory).AndReturn((self.totsize,
                                                        self.swapsize))
-    self.module.PartitionTargetDisks(self.client, self.totsize, self.swapsize,
-                                     self.target_hd)
-    self.module.TransferFiles("root", self.host, self.pkeyfile)
+    journal.IsDone("partitioned").AndReturn(False)
+    self.module.PlanCapacity(self.fs_devs, self.totsize, self.swapsize,
+                             scan=mox.IgnoreArg()).AndReturn(self.swapsize)
+    call = self.module.PartitionTargetDisks(self.client, self.totsize,
+                                            self.swapsize, self.target_hd,
+                                            wait=False, lazy_init=False)
+    call.AndReturn("formatting")
+    call = self.module.ChooseCompression(self.client, "zlib", self.inventory)
+    call.AndReturn(["-z"])
+    self.module.WaitForFormatting("formatting")
+    journal.MarkDone("partitioned")
+    monitor = self._MockStartTargetUsageMonitor()
+    self.module.TransferFiles("root", self.host, self.pkeyfile, self.fs_devs,
+                              1, False, ["-z"], include_root=True,
+                              journal=journal, limiter=mox.IsA(
+                                self.module.BandwidthLimiter),
+                              progress=mox.IsA(self.module.ProgressReporter),
+                              excluded=[], index=mox.IgnoreArg())
+    monitor.Stop()
     self.module.RunFixScripts(self.client)
     self.module.ShutDownTarget(self.client)
-    self.module.UnmountSourceFilesystems(self.fs_devs)
+    journal.Remove()
+    self.module.UnmountSourceFilesystems()
     # Don't call CleanUpTarget, the target is shut down
 
     self.mox.ReplayAll()
     self.module.main(self.test_argv)
     self.mox.VerifyAll()
 
+  def testMainMirrorLayoutCopiesPartitionsInParallel(self):
+    self.mox.StubOutWithMock(self.module.os, "getuid")
+    self._StubOutAllModuleFunctions()
+    self.mox.StubOutWithMock(self.module, "PlanLayout")
+    self.opts.layout = "mirror"
+    self.opts.parallel = None
+    fs_devs = [(self.root_dev, "/"), ("/dev/sda2", "/var")]
+    layout = [(1, "/", "ext4", 50000), (3, "/var", "ext4", 50000)]
+
+    call = self.module.ParseOptions(self.test_argv)
+    call.AndReturn((self.opts, (self.root_dev, self.host, self.pkeyfile)))
+    self.module.os.getuid().AndReturn(0)
+    self.module.LoadSSHKey(self.pkeyfile).AndReturn(self.pkey)
+    self.module.EstablishConnection("root",
+                                    self.host,
+                                    self.pkey, True).AndReturn(self.client)
+    call = self.module.MountSourceFilesystems(self.root_dev,
+                                                check=False)
+    call.AndReturn((fs_devs, self.swap_devs))
+    call = self.module.GetTargetInventory(self.client, mox.IgnoreArg())
+    call.AndReturn(self.inventory)
+    call = self.module.FindTargetHardDrive(self.client, self.inventory)
+    call.AndReturn(self.target_hd)
+    self.module.VerifyKernelMatches(self.client,
+                                    self.inventory).AndReturn(True)
+    journal = self._MockOpenJournal()
+    self.module.GetDiskSize(self.client, self.swap_devs, self.target_hd,
+                            self.inventory).AndReturn((self.totsize,
+                                                       self.swapsize))
+    journal.IsDone("partitioned").AndReturn(False)
+    self.module.PlanLayout(fs_devs, self.totsize, self.swapsize,
+                           self.inventory).AndReturn(layout)
+    call = self.module.PartitionTargetDisks(self.client, self.totsize,
+                                            self.swapsize, self.target_hd,
+                                            layout=layout, wait=False,
+                                            lazy_init=False)
+    call.AndReturn("formatting")
+    call = self.module.ChooseCompression(self.client, "zlib", self.inventory)
+    call.AndReturn(["-z"])
+    self.module.WaitForFormatting("formatting")
+    journal.MarkDone("layout 1 ext4 /")
+    journal.MarkDone("layout 3 ext4 /var")
+    journal.MarkDone("partitioned")
+    self.module.GetSourceUsage(fs_devs).AndReturn((1 << 30, 20000))
+    monitor = self.mox.CreateMock(self.module.TargetUsageMonitor)
+    call = self.module.StartTargetUsageMonitor(
+      self.client, mox.IsA(self.module.ProgressReporter), layout)
+    call.AndReturn(monitor)
+    self.module.TransferFiles("root", self.host, self.pkeyfile, fs_devs,
+                              2, False, ["-z"], include_root=True,
+                              journal=journal, limiter=mox.IsA(
+                                self.module.BandwidthLimiter),
+                              progress=mox.IsA(self.module.ProgressReporter),
+                              excluded=[], index=mox.IgnoreArg())
+    monitor.Stop()
+    self.module.RunFixScripts(self.client)
+    self.module.ShutDownTarget(self.client)
+    journal.Remove()
+    self.module.UnmountSourceFilesystems()
+
+    self.mox.ReplayAll()
+    self.module.main(self.test_argv)
+    self.mox.VerifyAll()
+
+  def testMainBlockModeCopiesBlocks(self):
+    self.mox.StubOutWithMock(self.module.os, "getuid")
+    self._StubOutAllModuleFunctions()
+    self.mox.StubOutWithMock(self.module, "TransferBlocks")
+    self.opts.mode = "block"
+
+    call = self.module.ParseOptions(self.test_argv)
+    call.AndReturn((self.opts, (self.root_dev, self.host, self.pkeyfile)))
+    self.module.os.getuid().AndReturn(0)
+    self.module.LoadSSHKey(self.pkeyfile).AndReturn(self.pkey)
+    self.module.EstablishConnection("root",
+                                    self.host,
+                                    self.pkey, True).AndReturn(self.client)
+    call = self.module.MountSourceFilesystems(self.root_dev,
+                                                check=False)
+    call.AndReturn((self.fs_devs, self.swap_devs))
+    call = self.module.GetTargetInventory(self.client, mox.IgnoreArg())
+    call.AndReturn(self.inventory)
+    call = self.module.FindTargetHardDrive(self.client, self.inventory)
+    call.AndReturn(self.target_hd)
+    self.module.VerifyKernelMatches(self.client,
+                                    self.inventory).AndReturn(True)
+    journal = self._MockOpenJournal()
+    self.module.GetDiskSize(self.client, self.swap_devs, self.target_hd,
+                            self.inventory).AndReturn((self.totsize,
+                                                       self.swapsize))
+    journal.IsDone("partitioned").AndReturn(False)
+    self.module.PartitionTargetDisks(self.client, self.totsize, self.swapsize,
+                                     self.target_hd, make_fs=False)
+    self.module.TransferBlocks(self.client, self.root_dev, self.target_hd,
+                               limiter=mox.IsA(self.module.BandwidthLimiter),
+                               progress=mox.IsA(self.module.ProgressReporter))
+    journal.MarkDone("partitioned")
+    call = self.module.ChooseCompression(self.client, "zlib", self.inventory)
+    call.AndReturn(["-z"])
+    monitor = self._MockStartTargetUsageMonitor()
+    self.module.TransferFiles("root", self.host, self.pkeyfile, self.fs_devs,
+                              1, False, ["-z"], include_root=False,
+                              journal=journal, limiter=mox.IsA(
+                                self.module.BandwidthLimiter),
+                              progress=mox.IsA(self.module.ProgressReporter),
+                              excluded=[], index=mox.IgnoreArg())
+    monitor.Stop()
+    self.module.RunFixScripts(self.client)
+    self.module.ShutDownTarget(self.client)
+    journal.Remove()
+    self.module.UnmountSourceFilesystems()
+
+    self.mox.ReplayAll()
+    self.module.main(self.test_argv)
+    self.mox.VerifyAll()
+
+  def testMainResumeSkipsPartitioning(self):
+    self.mox.StubOutWithMock(self.module.os, "getuid")
+    self._StubOutAllModuleFunctions()
+    self.opts.resume = True
+
+    call = self.module.ParseOptions(self.test_argv)
+    call.AndReturn((self.opts, (self.root_dev, self.host, self.pkeyfile)))
+    self.module.os.getuid().AndReturn(0)
+    self.module.LoadSSHKey(self.pkeyfile).AndReturn(self.pkey)
+    self.module.EstablishConnection("root",
+                                    self.host,
+                                    self.pkey, True).AndReturn(self.client)
+    call = self.module.MountSourceFilesystems(self.root_dev,
+                                                check=False)
+    call.AndReturn((self.fs_devs, self.swap_devs))
+    call = self.module.GetTargetInventory(self.client, mox.IgnoreArg())
+    call.AndReturn(self.inventory)
+    call = self.module.FindTargetHardDrive(self.client, self.inventory)
+    call.AndReturn(self.target_hd)
+    self.module.VerifyKernelMatches(self.client,
+                                    self.inventory).AndReturn(True)
+    journal = self._MockOpenJournal()
+    self.module.GetDiskSize(self.client, self.swap_devs, self.target_hd,
+                            self.inventory).AndReturn((self.totsize,
+                                                       self.swapsize))
+    journal.IsDone("partitioned").AndReturn(True)
+    journal.Values("layout").AndReturn([])
+    self.module.MountTargetFilesystem(self.client, self.target_hd,
+                                      layout=None)
+    call = self.module.ChooseCompression(self.client, "zlib", self.inventory)
+    call.AndReturn(["-z"])
+    monitor = self._MockStartTargetUsageMonitor()
+    self.module.TransferFiles("root", self.host, self.pkeyfile, self.fs_devs,
+                              1, False, ["-z"], include_root=True,
+                              journal=journal, limiter=mox.IsA(
+                                self.module.BandwidthLimiter),
+                              progress=mox.IsA(self.module.ProgressReporter),
+                              excluded=[], index=mox.IgnoreArg())
+    monitor.Stop()
+    self.module.RunFixScripts(self.client)
+    self.module.ShutDownTarget(self.client)
+    journal.Remove()
+    self.module.UnmountSourceFilesystems()
+
+    self.mox.ReplayAll()
+    self.module.main(self.test_argv)
+    self.mox.VerifyAll()
+
+  def testMainResumeMountsPartitionsFromJournal(self):
+    self.mox.StubOutWithMock(self.module.os, "getuid")
+    self._StubOutAllModuleFunctions()
+    self.opts.resume = True
+    # --layout isn't repeated, so the journal decides
+    self.opts.layout = None
+    self.opts.parallel = None
+    layout = [(1, "/", "ext4", None), (5, "/var", "ext3", None)]
+
+    call = self.module.ParseOptions(self.test_argv)
+    call.AndReturn((self.opts, (self.root_dev, self.host, self.pkeyfile)))
+    self.module.os.getuid().AndReturn(0)
+    self.module.LoadSSHKey(self.pkeyfile).AndReturn(self.pkey)
+    self.module.EstablishConnection("root",
+                                    self.host,
+                                    self.pkey, True).AndReturn(self.client)
+    call = self.module.MountSourceFilesystems(self.root_dev,
+                                                check=False)
+    call.AndReturn((self.fs_devs, self.swap_devs))
+    call = self.module.GetTargetInventory(self.client, mox.IgnoreArg())
+    call.AndReturn(self.inventory)
+    call = self.module.FindTargetHardDrive(self.client, self.inventory)
+    call.AndReturn(self.target_hd)
+    self.module.VerifyKernelMatches(self.client,
+                                    self.inventory).AndReturn(True)
+    journal = self._MockOpenJournal()
+    self.module.GetDiskSize(self.client, self.swap_devs, self.target_hd,
+                            self.inventory).AndReturn((self.totsize,
+                                                       self.swapsize))
+    journal.IsDone("partitioned").AndReturn(True)
+    journal.Values("layout").AndReturn(["1 ext4 /", "5 ext3 /var"])
+    self.module.MountTargetFilesystem(self.client, self.target_hd,
+                                      layout=layout)
+    call = self.module.ChooseCompression(self.client, "zlib", self.inventory)
+    call.AndReturn(["-z"])
+    self.module.GetSourceUsage(self.fs_devs).AndReturn((1 << 30, 20000))
+    monitor = self.mox.CreateMock(self.module.TargetUsageMonitor)
+    call = self.module.StartTargetUsageMonitor(
+      self.client, mox.IsA(self.module.ProgressReporter), layout)
+    call.AndReturn(monitor)
+    self.module.TransferFiles("root", self.host, self.pkeyfile, self.fs_devs,
+                              2, False, ["-z"], include_root=True,
+                              journal=journal, limiter=mox.IsA(
+                                self.module.BandwidthLimiter),
+                              progress=mox.IsA(self.module.ProgressReporter),
+                              excluded=[], index=mox.IgnoreArg())
+    monitor.Stop()
+    self.module.RunFixScripts(self.client)
+    self.module.ShutDownTarget(self.client)
+    journal.Remove()
+    self.module.UnmountSourceFilesystems()
+
+    self.mox.ReplayAll()
+    self.module.main(self.test_argv)
+    self.mox.VerifyAll()
+
+  def testMainWarmCopyLeavesInstanceRunning(self):
+    self.mox.StubOutWithMock(self.module.os, "getuid")
+    self._StubOutAllModuleFunctions()
+    self.opts.warm = True
+
+    call = self.module.ParseOptions(self.test_argv)
+    call.AndReturn((self.opts, (self.root_dev, self.host, self.pkeyfile)))
+    self.module.os.getuid().AndReturn(0)
+    self.module.LoadSSHKey(self.pkeyfile).AndReturn(self.pkey)
+    self.module.EstablishConnection("root",
+                                    self.host,
+                                    self.pkey, True).AndReturn(self.client)
+    call = self.module.MountSourceFilesystems(self.root_dev,
+                                                check=False)
+    call.AndReturn((self.fs_devs, self.swap_devs))
+    call = self.module.GetTargetInventory(self.client, mox.IgnoreArg())
+    call.AndReturn(self.inventory)
+    call = self.module.FindTargetHardDrive(self.client, self.inventory)
+    call.AndReturn(self.target_hd)
+    self.module.VerifyKernelMatches(self.client,
+                                    self.inventory).AndReturn(True)
+    journal = self._MockOpenJournal()
+    self.module.GetDiskSize(self.client, self.swap_devs, self.target_hd,
+                            self.inventory).AndReturn((self.totsize,
+                                                       self.swapsize))
+    journal.IsDone("partitioned").AndReturn(False)
+    self.module.PlanCapacity(self.fs_devs, self.totsize, self.swapsize,
+                             scan=mox.IgnoreArg()).AndReturn(self.swapsize)
+    call = self.module.PartitionTargetDisks(self.client, self.totsize,
+                                            self.swapsize, self.target_hd,
+                                            wait=False, lazy_init=False)
+    call.AndReturn("formatting")
+    call = self.module.ChooseCompression(self.client, "zlib", self.inventory)
+    call.AndReturn(["-z"])
+    self.module.WaitForFormatting("formatting")
+    journal.MarkDone("partitioned")
+    monitor = self._MockStartTargetUsageMonitor()
+    self.module.TransferFiles("root", self.host, self.pkeyfile, self.fs_devs,
+                              1, False, ["-z"], limiter=mox.IsA(
+                                self.module.BandwidthLimiter),
+                              excluded=[], index=mox.IgnoreArg())
+    monitor.Stop()
+    journal.MarkDone("warm")
+    journal.Remove()
+    # No fix scripts or shutdown until the final pass
+    self.module.UnmountSourceFilesystems()
+    self.module.CleanUpTarget(self.client)
+
+    self.mox.ReplayAll()
+    self.module.main(self.test_argv)
+    self.mox.VerifyAll()
+
   def testMainQuitsIfNotRunAsRoot(self):
     self.mox.StubOutWithMock(self.module.os, "getuid")
     self._StubOutAllModuleFunctions()
@@ -372,6 +2174,45 @@ EOF
     self.assertRaises(SystemExit, self.module.main, self.test_argv)
     self.mox.VerifyAll()
 
+  def testRunCommandAndWaitCollectsOutput(self):
+    stdin = _MockChannelFile(self.mox)
+    stdout = _MockChannelFile(self.mox)
+    self.client.exec_command("ls").AndReturn((stdin, stdout, None))
+    self._MockWaitForCompletion(stdout.channel, output=["a\n", "b\n", "c\n"])
+    stdout.channel.recv_exit_status().AndReturn(0)
+
+    self.mox.ReplayAll()
+    out, err = self.module._RunCommandAndWait(self.client, "ls")
+    self.assertEqual(out, "a\nb\nc\n")
+    self.assertEqual(err, "")
+    self.mox.VerifyAll()
+
+  def testWaitForCompletionTimesOut(self):
+    self.mox.StubOutWithMock(self.module.time, "time")
+    channel = self.mox.CreateMock(paramiko.Channel)
+
+    self.module.time.time().AndReturn(1000.0)
+    channel.exit_status_ready().AndReturn(False)
+    channel.recv_ready().AndReturn(False)
+    channel.recv_stderr_ready().AndReturn(False)
+    self.module.time.time().AndReturn(1011.0)
+    channel.close()
+
+    self.mox.ReplayAll()
+    self.assertRaises(self.module.P2VError, self.module._WaitForCompletion,
+                      channel, timeout=10)
+    self.mox.VerifyAll()
+
+  def testWaitForCompletionClosesChannelOnInterrupt(self):
+    channel = self.mox.CreateMock(paramiko.Channel)
+    channel.exit_status_ready().AndRaise(KeyboardInterrupt())
+    channel.close()
+
+    self.mox.ReplayAll()
+    self.assertRaises(self.module.P2VError, self.module._WaitForCompletion,
+                      channel)
+    self.mox.VerifyAll()
+
   def testRunFixScriptsReportsFailure(self):
     # Run the command, but have it exit with error
     self._MockRunCommandAndWait("run-parts /usr/lib/ganeti/fixes", 1)
@@ -392,30 +2233,314 @@ EOF
     self.module.LoadSSHKey(self.pkeyfile).AndReturn(self.pkey)
     self.module.EstablishConnection("root",
                                     self.host,
-                                    self.pkey).AndReturn(self.client)
-    call = self.module.MountSourceFilesystems(self.root_dev)
+                                    self.pkey, True).AndReturn(self.client)
+    call = self.module.MountSourceFilesystems(self.root_dev,
+                                                check=False)
     call.AndReturn((self.fs_devs, self.swap_devs))
-    self.module.FindTargetHardDrive(self.client).AndReturn(self.target_hd)
-    self.module.VerifyKernelMatches(self.client).AndReturn(True)
-    self.module.GetDiskSize(self.client, self.swap_devs,
-                            self.target_hd).AndReturn((self.totsize,
+    call = self.module.GetTargetInventory(self.client, mox.IgnoreArg())
+    call.AndReturn(self.inventory)
+    call = self.module.FindTargetHardDrive(self.client, self.inventory)
+    call.AndReturn(self.target_hd)
+    self.module.VerifyKernelMatches(self.client,
+                                    self.inventory).AndReturn(True)
+    journal = self._MockOpenJournal()
+    self.module.GetDiskSize(self.client, self.swap_devs, self.target_hd,
+                            self.inventory).AndReturn((self.totsize,
                                                        self.swapsize))
+    journal.IsDone("partitioned").AndReturn(False)
+    self.module.PlanCapacity(self.fs_devs, self.totsize, self.swapsize,
+                             scan=mox.IgnoreArg()).AndReturn(self.swapsize)
     call = self.module.PartitionTargetDisks(self.client, self.totsize,
-                                            self.swapsize, self.target_hd)
+                                            self.swapsize, self.target_hd,
+                                            wait=False, lazy_init=False)
     call.AndRaise(self.module.P2VError("meep"))
     # Transfer is cancelled because of the error, but still we have:
-    self.module.UnmountSourceFilesystems(self.fs_devs)
+    self.module.UnmountSourceFilesystems()
     self.module.CleanUpTarget(self.client)
 
     self.mox.ReplayAll()
     self.assertRaises(SystemExit, self.module.main, self.test_argv)
     self.mox.VerifyAll()
 
+  def testRunPhaseRecordsTimings(self):
+    self.mox.StubOutWithMock(self.module.time, "time")
+    log_dir = tempfile.mkdtemp()
+    try:
+      log_path = os.path.join(log_dir, "progress.log")
+      progress = self.module.ProgressReporter(log_path)
+      for when in [100.0, 100.0, 102.5, 102.5, 103.0, 103.0, 104.0, 104.0]:
+        self.module.time.time().AndReturn(when)
+
+      def _Fail():
+        raise self.module.P2VError("meep")
+
+      self.mox.ReplayAll()
+      self.assertEqual(self.module._RunPhase(progress, "connect", max, 2, 3),
+                       3)
+      self.assertRaises(self.module.P2VError, self.module._RunPhase, progress,
+                        "partition", _Fail)
+      progress.Close()
+      self.mox.VerifyAll()
+
+      self.assertEqual(progress.timings, [("connect", 2.5, "done"),
+                                          ("partition", 1.0, "failed")])
+      events = [self.module.json.loads(line) for line in open(log_path)]
+      self.assertEqual([(event["event"], event["phase"]) for event in events],
+                       [("phase_start", "connect"), ("phase_end", "connect"),
+                        ("phase_start", "partition"),
+                        ("phase_end", "partition")])
+      self.assertEqual(events[3]["status"], "failed")
+    finally:
+      shutil.rmtree(log_dir)
+
+  def testProgressReporterComputesThroughput(self):
+    self.mox.StubOutWithMock(self.module.time, "time")
+    self.mox.StubOutWithMock(self.module, "_ReadCpuTimes")
+    self.mox.StubOutWithMock(self.module, "DisplayCommandProgress")
+    log_dir = tempfile.mkdtemp()
+    try:
+      log_path = os.path.join(log_dir, "progress.log")
+      progress = self.module.ProgressReporter(log_path, interval=10)
+      progress.SetTotals(1000000, 100)
+
+      self.module.time.time().AndReturn(100.0)
+      self.module._ReadCpuTimes().AndReturn((100, 1000))
+      # Too soon after the previous update to report anything
+      self.module.time.time().AndReturn(105.0)
+      self.module.time.time().AndReturn(110.0)
+      self.module._ReadCpuTimes().AndReturn((350, 1500))
+      self.module.time.time().AndReturn(110.0)
+      self.module.DisplayCommandProgress(mox.StrContains("40%"))
+      self.module.time.time().AndReturn(120.0)
+      self.module._ReadCpuTimes().AndReturn((400, 2000))
+      self.module.time.time().AndReturn(120.0)
+      self.module.DisplayCommandProgress(mox.StrContains("0:00:05 left"))
+
+      self.mox.ReplayAll()
+      progress.Update(0, 0)
+      progress.Update(200000, 20)
+      progress.Update(400000, 40)
+      progress.Update(800000, 80)
+      progress.Close()
+      self.mox.VerifyAll()
+
+      events = [self.module.json.loads(line) for line in open(log_path)]
+      self.assertEqual(len(events), 2)
+      self.assertEqual(events[0]["rate"], 40000.0)
+      self.assertEqual(events[0]["cpu"], 50.0)
+      self.assertEqual(events[1]["rate"], 40000.0)
+      self.assertEqual(events[1]["avg_rate"], 40000.0)
+      self.assertEqual(events[1]["eta"], 5.0)
+      self.assertEqual(events[1]["files"], 80)
+      self.assertEqual(events[1]["total_files"], 100)
+      self.assertEqual(events[1]["cpu"], 10.0)
+    finally:
+      shutil.rmtree(log_dir)
+
+  def testProgressReporterProfilesPhases(self):
+    self.mox.StubOutWithMock(self.module.time, "time")
+    self.mox.StubOutWithMock(self.module, "_SampleResources")
+    client = self.mox.CreateMock(paramiko.SSHClient)
+    report_dir = tempfile.mkdtemp()
+    try:
+      report_path = os.path.join(report_dir, "profile.json")
+      progress = self.module.ProgressReporter(profile=True)
+
+      def _Sample(cpu, read_bytes, sent):
+        return {"cpu_user": cpu, "cpu_system": 0.5, "children_user": 0.0,
+                "children_system": 0.0, "disk_read_bytes": read_bytes,
+                "net_sent_bytes": sent, "net_received_bytes": None}
+
+      self.module.time.time().AndReturn(100.0)
+      self.module._SampleResources().AndReturn(_Sample(1.0, 4096, 1000))
+      self.module.time.time().AndReturn(100.0)
+      client.exec_command("true").AndReturn((None, None, None))
+      self.module.time.time().AndReturn(100.25)
+      self.module.time.time().AndReturn(100.5)
+      client.exec_command("false").AndReturn((None, None, None))
+      self.module.time.time().AndReturn(101.25)
+      self.module.time.time().AndReturn(110.0)
+      self.module._SampleResources().AndReturn(_Sample(3.0, 8192, 6000))
+
+      self.mox.ReplayAll()
+      progress.TimeRemoteCommands(client)
+      progress.StartPhase("partition")
+      client.exec_command("true")
+      client.exec_command("false")
+      progress.EndPhase("partition")
+      progress.WriteProfile(report_path, {"host": "instance"})
+      self.mox.VerifyAll()
+
+      report = self.module.json.load(open(report_path))
+      self.assertEqual(report["host"], "instance")
+      self.assertEqual(len(report["phases"]), 1)
+      phase = report["phases"][0]
+      self.assertEqual(phase["phase"], "partition")
+      self.assertEqual(phase["seconds"], 10.0)
+      self.assertEqual(phase["cpu_user"], 2.0)
+      self.assertEqual(phase["cpu_system"], 0.0)
+      self.assertEqual(phase["disk_read_bytes"], 4096)
+      self.assertEqual(phase["net_sent_bytes"], 5000)
+      self.assertEqual(phase["net_received_bytes"], None)
+      self.assertEqual(phase["remote_commands"], 2)
+      self.assertEqual(phase["remote_latency_avg"], 0.5)
+      self.assertEqual(phase["remote_latency_max"], 0.75)
+    finally:
+      shutil.rmtree(report_dir)
+
+  def testPhaseSchedulerRunsIndependentStepsAtOnce(self):
+    reporter = self.module.ProgressReporter()
+    phases = self.module.PhaseScheduler(reporter, max_running=2)
+    other_started = self.module.threading.Event()
+
+    def _WaitForOther():
+      # Only returns if the other step runs at the same time
+      other_started.wait(5)
+      return other_started.isSet()
+
+    def _Other():
+      other_started.set()
+      return 2
+
+    phases.Add("first", _WaitForOther)
+    phases.Add("other", _Other)
+    phases.Add("sum", lambda first, other: first + other, ["first", "other"])
+    self.assertEqual(phases.Result("sum"), 3)
+    self.assertEqual(sorted([name for name, _, _ in reporter.timings]),
+                     ["first", "other", "sum"])
+
+  def testPhaseSchedulerStopsAfterFailure(self):
+    phases = self.module.PhaseScheduler(self.module.ProgressReporter(),
+                                        max_running=1)
+    ran = []
+
+    def _Fail():
+      raise self.module.P2VError("meep")
+
+    phases.Add("fails", _Fail)
+    phases.Add("independent", lambda: ran.append("independent"))
+    phases.Add("dependent", lambda _: ran.append("dependent"), ["fails"])
+    self.assertRaises(self.module.P2VError, phases.Wait, ["dependent"])
+    self.assertRaises(self.module.P2VError, phases.Result, "independent")
+    self.assertEqual(ran, [])
+    self.assertEqual(phases.Get("independent", "none"), "none")
+
+  def testTargetUsageMonitorReadsUsage(self):
+    stdin = _MockChannelFile(self.mox)
+    stdout = _MockChannelFile(self.mox)
+    stderr = _MockChannelFile(self.mox)
+    command = "stat -f -c '%%S %%b %%f %%c %%d' %s" % self.module.TARGET_MOUNT
+    self.client.exec_command(command).AndReturn((stdin, stdout, stderr))
+    self._MockWaitForCompletion(stdout.channel,
+                                output=["4096 1000 600 500 100\n"])
+    stdout.channel.recv_exit_status().AndReturn(0)
+
+    self.mox.ReplayAll()
+    monitor = self.module.TargetUsageMonitor(self.client, None)
+    self.assertEqual(monitor.ReadUsage(), (4096 * 400, 400))
+    self.mox.VerifyAll()
+
+  def testTargetUsageMonitorAddsUpPartitions(self):
+    stdin = _MockChannelFile(self.mox)
+    stdout = _MockChannelFile(self.mox)
+    stderr = _MockChannelFile(self.mox)
+    target = self.module.TARGET_MOUNT
+    command = "stat -f -c '%%S %%b %%f %%c %%d' %s %s/var" % (target, target)
+    self.client.exec_command(command).AndReturn((stdin, stdout, stderr))
+    self._MockWaitForCompletion(stdout.channel,
+                                output=["4096 1000 600 500 100\n"
+                                        "1024 100 50 20 10\n"])
+    stdout.channel.recv_exit_status().AndReturn(0)
+
+    self.mox.ReplayAll()
+    monitor = self.module.TargetUsageMonitor(self.client, None,
+                                             [target, target + "/var"])
+    self.assertEqual(monitor.ReadUsage(), (4096 * 400 + 1024 * 50, 410))
+    self.mox.VerifyAll()
+
+  def testGetSourceUsageSkipsUnmountedFilesystems(self):
+    self.mox.StubOutWithMock(self.module.os, "statvfs")
+    self.mox.StubOutWithMock(self.module.os.path, "ismount")
+    src = self.module.SOURCE_MOUNT
+    fs_devs = [("/dev/sda1", "/"), ("/dev/sda2", "/usr"),
+               ("/dev/sda3", "/home")]
+
+    def _Stats(blocks, bfree, files, ffree):
+      stats = self.mox.CreateMockAnything()
+      stats.f_frsize = 4096
+      stats.f_blocks = blocks
+      stats.f_bfree = bfree
+      stats.f_files = files
+      stats.f_ffree = ffree
+      return stats
+
+    self.module.os.statvfs(src).AndReturn(_Stats(1000, 800, 100, 50))
+    self.module.os.path.ismount(src + "/usr").AndReturn(True)
+    self.module.os.statvfs(src + "/usr").AndReturn(_Stats(500, 400, 80, 20))
+    self.module.os.path.ismount(src + "/home").AndReturn(False)
+
+    self.mox.ReplayAll()
+    self.assertEqual(self.module.GetSourceUsage(fs_devs), (300 * 4096, 110))
+    self.mox.VerifyAll()
+
   def _ExecCommandWithOutput(self, command, output):
     stdout = _MockChannelFile(self.mox)
     stdout._SetOutput(output)
     self.client.exec_command(command).AndReturn((None, stdout, None))
 
+  def testGetTargetInventoryParsesReport(self):
+    output = ["disk /dev/vda 10737418240\n"
+              "disk /dev/sda 1073741824\n"
+              "kernel 2.6.32-5-xen-amd64\n"
+              "tool sfdisk\ntool mkswap\ntool rsync\n"
+              "rsync_compressors zstd lz4 zlib none\n"
+              "mem_free_kb 524288\n"
+              "root_free_kb\n"
+              "mkfs_lazy_init\n"]
+    stdout = _MockChannelFile(self.mox)
+    self.client.exec_command(mox.IsA(str)).AndReturn((None, stdout, None))
+    self._MockWaitForCompletion(stdout.channel, output=output)
+    stdout.channel.recv_exit_status().AndReturn(0)
+
+    self.mox.ReplayAll()
+    inventory = self.module.GetTargetInventory(self.client, ["sfdisk"])
+    self.mox.VerifyAll()
+
+    self.assertEqual(inventory["disks"], [("/dev/vda", 10737418240),
+                                          ("/dev/sda", 1073741824)])
+    self.assertEqual(inventory["kernel"], "2.6.32-5-xen-amd64")
+    self.assertEqual(inventory["tools"], ["sfdisk", "mkswap", "rsync"])
+    self.assertEqual(inventory["rsync_compressors"],
+                     ["zstd", "lz4", "zlib", "none"])
+    self.assertEqual(inventory["mem_free_kb"], 524288)
+    self.assertEqual(inventory["root_free_kb"], 0)
+    self.assertTrue(inventory["mkfs_lazy_init"])
+    self.assertEqual(self.module.FindTargetHardDrive(self.client, inventory),
+                     "/dev/vda")
+
+  def testGetTargetInventoryChecksTools(self):
+    stdout = _MockChannelFile(self.mox)
+    self.client.exec_command(mox.IsA(str)).AndReturn((None, stdout, None))
+    self._MockWaitForCompletion(stdout.channel, output=["tool sfdisk\n"])
+    stdout.channel.recv_exit_status().AndReturn(0)
+
+    self.mox.ReplayAll()
+    self.assertRaises(self.module.P2VError, self.module.GetTargetInventory,
+                      self.client, ["sfdisk", "resize2fs"])
+    self.mox.VerifyAll()
+
+  def testVerifyKernelMatchesUsesInventory(self):
+    self.mox.StubOutWithMock(self.module.os.path, "exists")
+    kernel = "2.6.32-5-xen-amd64"
+    moduledir = self.module.os.path.join(self.module.SOURCE_MOUNT, "lib",
+                                         "modules", kernel)
+    self.module.os.path.exists(moduledir).AndReturn(True)
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.module.VerifyKernelMatches(self.client,
+                                                    {"kernel": kernel}))
+    self.mox.VerifyAll()
+
   def testVerifyKernelMatchesDetectsMatch(self):
     self.mox.StubOutWithMock(self.module.os.path, "exists")
     kernel = "2.6.32-5-xen-amd64"
@@ -462,6 +2587,102 @@ EOF
     self.assertTrue(res is self.client)
     self.mox.VerifyAll()
 
+  def testEstablishConnectionCanAcceptHostKey(self):
+    self.mox.StubOutWithMock(self.module.paramiko, "SSHClient",
+                             use_mock_anything=True)
+    self.mox.StubOutWithMock(self.module.os.path, 'expanduser')
+
+    known_hosts = "/root/.ssh/known_hosts"
+
+    self.module.paramiko.SSHClient().AndReturn(self.client)
+    call = self.module.os.path.expanduser("~root/.ssh/known_hosts")
+    call.AndReturn(known_hosts)
+    call = self.client.set_missing_host_key_policy(
+      mox.IsA(self.module.paramiko.AutoAddPolicy))
+    call.WithSideEffects(lambda policy: self.assertFalse(
+      isinstance(policy, self.module.AskAddPolicy)))
+    self.client.load_host_keys(known_hosts)
+    self.client.connect(self.host, username=self.user, pkey=self.pkey,
+                        allow_agent=False, look_for_keys=False)
+
+    self.mox.ReplayAll()
+    self.module.EstablishConnection(self.user, self.host, self.pkey, False)
+    self.mox.VerifyAll()
+
+  def testMountSourceFilesystemsMountsParentsFirst(self):
+    self.mox.StubOutWithMock(self.module.os.path, "isdir")
+    self.mox.StubOutWithMock(self.module, "ParseFstab")
+    self.mox.StubOutWithMock(self.module, "_ReadSourceFstab")
+    self.mox.StubOutWithMock(self.module.subprocess, "call")
+    source = self.module.SOURCE_MOUNT
+    fs_devs = [("/dev/sda1", "/"), ("/dev/sda5", "/var/log"),
+               ("/dev/sda2", "/var"), ("/dev/sda3", "/home")]
+
+    self.module.os.path.isdir(source).AndReturn(True)
+    # The fstab is read from the root filesystem mounted read-only, and then
+    # every filesystem is checked before any is mounted
+    self.module.subprocess.call(["mount", "-o", "ro", "/dev/sda1",
+                                 source]).AndReturn(0)
+    self.module._ReadSourceFstab().AndReturn(self.fstab_data)
+    self.module.subprocess.call(["umount", source]).AndReturn(0)
+    self.module.ParseFstab(self.fstab_data).AndReturn((fs_devs,
+                                                       self.swap_devs))
+    for dev, errcode in [("/dev/sda1", 1), ("/dev/sda5", 0), ("/dev/sda2", 0),
+                         ("/dev/sda3", 0)]:
+      self.module.subprocess.call(["fsck", "-p", dev]).AndReturn(errcode)
+    self.module.subprocess.call(["mount", "/dev/sda1", source]).AndReturn(0)
+    self.module.subprocess.call(["mount", "/dev/sda2",
+                                 source + "/var"]).AndReturn(0)
+    self.module.subprocess.call(["mount", "/dev/sda3",
+                                 source + "/home"]).AndReturn(1)
+    self.module.subprocess.call(["mount", "/dev/sda5",
+                                 source + "/var/log"]).AndReturn(0)
+
+    self.mox.ReplayAll()
+    self.module.MountSourceFilesystems(self.root_dev, check=True)
+    self.mox.VerifyAll()
+    # /home could not be mounted, so it isn't unmounted afterwards
+    self.assertEqual(self.module._source_mounts,
+                     set([source, source + "/var", source + "/var/log"]))
+
+  def testMountSourceFilesystemsStopsOnFsckErrors(self):
+    self.mox.StubOutWithMock(self.module, "ParseFstab")
+    self.mox.StubOutWithMock(self.module.subprocess, "call")
+    source = self.module.SOURCE_MOUNT
+    fs_devs = [("/dev/sda1", "/"), ("/dev/sda2", "/var"),
+               ("/dev/sda5", "/var/log")]
+
+    self.module.ParseFstab(self.fstab_data).AndReturn((fs_devs,
+                                                       self.swap_devs))
+    self.module.subprocess.call(["fsck", "-p", "/dev/sda1"]).AndReturn(0)
+    self.module.subprocess.call(["fsck", "-p", "/dev/sda2"]).AndReturn(4)
+    # One check at a time here, so /var/log is never checked, and nothing is
+    # mounted once the check of /var failed
+
+    self.mox.ReplayAll()
+    self.assertRaises(self.module.P2VError,
+                      self.module.MountSourceFilesystems, self.root_dev,
+                      fstab_data=self.fstab_data, check=True)
+    self.mox.VerifyAll()
+    self.assertEqual(self.module._source_mounts, set())
+
+  def testCheckSourceFilesystemOnlyStopsOnUncorrectedErrors(self):
+    self.mox.StubOutWithMock(self.module.subprocess, "call")
+    self.module.subprocess.call(["fsck", "-p", "/dev/sda1"]).AndReturn(1)
+    # No fsck.vfat on the transfer OS
+    self.module.subprocess.call(["fsck", "-p", "/dev/sda2"]).AndReturn(8)
+    self.module.subprocess.call(["fsck", "-p", "/dev/sda3"]).AndReturn(12)
+    self.module.subprocess.call(["fsck", "-p", "/dev/sda5"]).AndReturn(32)
+
+    self.mox.ReplayAll()
+    self.module._CheckSourceFilesystem("/dev/sda1")
+    self.module._CheckSourceFilesystem("/dev/sda2")
+    self.assertRaises(self.module.P2VError,
+                      self.module._CheckSourceFilesystem, "/dev/sda3")
+    self.assertRaises(self.module.P2VError,
+                      self.module._CheckSourceFilesystem, "/dev/sda5")
+    self.mox.VerifyAll()
+
   def testMountSourceFilesystemsMountsFilesystemsInOrder(self):
     self.mox.StubOutWithMock(self.module.os.path, "isdir")
     self.mox.StubOutWithMock(self.module.os, "mkdir")
@@ -507,6 +2728,127 @@ EOF
                                        fstab_data=self.fstab_data)
     self.mox.VerifyAll()
 
+  def _MockStatvfs(self, used_bytes, used_inodes):
+    self.mox.StubOutWithMock(self.module.os, "statvfs")
+    stats = self.mox.CreateMockAnything()
+    stats.f_frsize = 4096
+    stats.f_blocks = 1000000
+    stats.f_bfree = stats.f_blocks - used_bytes / 4096
+    stats.f_files = 1000000
+    stats.f_ffree = stats.f_files - used_inodes
+    self.module.os.statvfs(self.module.SOURCE_MOUNT).AndReturn(stats)
+
+  def testPlanCapacityKeepsSwapWhenDataFits(self):
+    self._MockStatvfs(500 << 20, 1000)
+    self.mox.ReplayAll()
+    swap = self.module.PlanCapacity(self.fs_devs, 2048, 256)
+    self.mox.VerifyAll()
+    self.assertEqual(swap, 256)
+
+  def testPlanCapacityShrinksSwap(self):
+    self._MockStatvfs(1800 << 20, 1000)
+    self.mox.StubOutWithMock(self.module, "_ScanUsage")
+    self.module._ScanUsage(self.fs_devs, mox.IgnoreArg()).AndReturn(
+      [("/", 1800 << 20, 1000)])
+    self.mox.ReplayAll()
+    swap = self.module.PlanCapacity(self.fs_devs, 2048, 256)
+    self.mox.VerifyAll()
+    # 1800 MB plus 5% overhead leaves 153 MB
+    self.assertEqual(swap, 153)
+
+  def testPlanCapacityUsesEarlierScan(self):
+    self._MockStatvfs(1800 << 20, 1000)
+    self.mox.ReplayAll()
+    swap = self.module.PlanCapacity(self.fs_devs, 2048, 256,
+                                    scan=lambda: [("/", 1800 << 20, 1000)])
+    self.mox.VerifyAll()
+    self.assertEqual(swap, 153)
+
+  def testPlanCapacityFailsWhenDataCannotFit(self):
+    self._MockStatvfs(4000 << 20, 1000)
+    self.mox.StubOutWithMock(self.module, "_ScanUsage")
+    self.module._ScanUsage(self.fs_devs, mox.IgnoreArg()).AndReturn(
+      [("/", 3000 << 20, 1000)])
+    self.mox.ReplayAll()
+    self.assertRaises(self.module.P2VError, self.module.PlanCapacity,
+                      self.fs_devs, 2048, 256)
+    self.mox.VerifyAll()
+
+  def testPlanCapacityCountsInodes(self):
+    # 200000 inodes need 3125 MB at mke2fs's default density
+    self._MockStatvfs(10 << 20, 200000)
+    self.mox.StubOutWithMock(self.module, "_ScanUsage")
+    self.module._ScanUsage(self.fs_devs, mox.IgnoreArg()).AndReturn(
+      [("/", 10 << 20, 200000)])
+    self.mox.ReplayAll()
+    self.assertRaises(self.module.P2VError, self.module.PlanCapacity,
+                      self.fs_devs, 2048, 256)
+    self.mox.VerifyAll()
+
+  def testScanSourceListsDirectoriesBeforeTheirContents(self):
+    tree = tempfile.mkdtemp()
+    state = tempfile.mkdtemp()
+    try:
+      os.makedirs(os.path.join(tree, "usr", "lib", "x"))
+      os.makedirs(os.path.join(tree, "etc"))
+      open(os.path.join(tree, "usr", "lib", "x", "a.so"), "w").write("x" * 10)
+      open(os.path.join(tree, "vmlinuz"), "w").write("")
+      self.mox.stubs.Set(self.module, "SOURCE_MOUNT", tree)
+      index_dir = os.path.join(state, "p2v-transfer")
+
+      index = self.module.ScanSource([(self.root_dev, "/")], 2,
+                                     index_dir)
+      try:
+        # Created if needed, rather than using the temporary directory
+        self.assertEqual(os.path.dirname(index.directory), index_dir)
+        entries = list(index.Entries())
+        paths = [entry.path for entry in entries]
+        self.assertEqual(sorted(paths),
+                         ["/etc", "/usr", "/usr/lib", "/usr/lib/x",
+                          "/usr/lib/x/a.so", "/vmlinuz"])
+        for path in paths:
+          if path.count("/") > 1:
+            self.assertTrue(paths.index(os.path.dirname(path)) <
+                            paths.index(path))
+        library = entries[paths.index("/usr/lib/x/a.so")]
+        self.assertEqual(library.mount_point, "/")
+        self.assertEqual(library.st_size, 10)
+        self.assertTrue(self.module.stat.S_ISREG(library.st_mode))
+        # The top level, etc and usr
+        self.assertEqual(len(index.parts), 3)
+      finally:
+        index.Close()
+      self.assertFalse(os.path.exists(index.directory))
+    finally:
+      shutil.rmtree(tree)
+      shutil.rmtree(state)
+
+  def testScanUsageCountsHardLinksOnce(self):
+    tree = tempfile.mkdtemp()
+    self.mox.StubOutWithMock(self.module, "_SourcePath")
+    self.module._SourcePath("/").AndReturn(tree)
+    self.mox.StubOutWithMock(self.module.os.path, "ismount")
+    self.module.os.path.ismount(tree).AndReturn(True)
+    self.mox.ReplayAll()
+    try:
+      for name in ["a", "b", "c"]:
+        os.mkdir(os.path.join(tree, name))
+      open(os.path.join(tree, "a", "file"), "w").write("x" * 100000)
+      os.link(os.path.join(tree, "a", "file"), os.path.join(tree, "b", "link"))
+      os.link(os.path.join(tree, "a", "file"), os.path.join(tree, "top"))
+      open(os.path.join(tree, "c", "other"), "w").write("y")
+      file_bytes = os.stat(os.path.join(tree, "a", "file")).st_blocks * 512
+      other_bytes = os.stat(os.path.join(tree, "c", "other")).st_blocks * 512
+      dir_bytes = sum([os.stat(os.path.join(tree, name)).st_blocks * 512
+                       for name in ["a", "b", "c"]])
+      usage = self.module._ScanUsage([("/dev/sda1", "/")], 2)
+    finally:
+      shutil.rmtree(tree)
+    self.mox.VerifyAll()
+
+    # The root, three directories and two files
+    self.assertEqual(usage, [("/", file_bytes + other_bytes + dir_bytes, 6)])
+
   def testParseFstabReturnsFilesystemsAndSwap(self):
     fs_correct = [("UUID=00000000-0000-0000-0000-000000000000", "/"),
                   ("UUID=55555555-5555-5555-5555-555555555555", "/usr")]